@@ -105,6 +105,9 @@ python ./subroutines/dreq_mapping.py --multi
 
 # Create database
 python ./subroutines/database_manager.py
+
+# Build store of precomputed ancillary fields (only if ancillary files have changed)
+python ./subroutines/ancillary_store.py
 #exit
 
 # FOR TESTING
@@ -151,6 +154,7 @@ module purge
 set -a
 # pre
 EXP_TO_PROCESS=${EXP_TO_PROCESS}
+NUM_MEM=${NUM_MEM}
 OUTPUT_LOC=$OUTPUT_LOC
 MODE=$MODE
 CONTACT=$CONTACT
@@ -159,7 +163,6 @@ source ./subroutines/setup_env.sh
 # main
 python ./subroutines/app_wrapper.py
 # post
-python ${OUT_DIR}/database_updater.py
 sort ${SUCCESS_LISTS}/${EXP_TO_PROCESS}_success.csv \
     > ${SUCCESS_LISTS}/${EXP_TO_PROCESS}_success_sorted.csv
 mv ${SUCCESS_LISTS}/${EXP_TO_PROCESS}_success_sorted.csv \
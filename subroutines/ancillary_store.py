@@ -0,0 +1,103 @@
+# This script builds the store of precomputed ancillary fields used by the APP
+#
+# The ancillary fields (orography, land/ocean fractions, tile fractions, basin masks,
+# OM2 grid fields and ocean/ice grid vertices) are read from ANCILLARY_FILES with the
+# functions in app_functions.py, and written as uncompressed .npy files to a versioned
+# directory under ANCILLARY_NPY_DIR. The app memory-maps these files, so all the
+# processes on a node share one copy and no netCDF decoding is needed at startup.
+#
+# The store is only rebuilt if the ancillary files, the list of fields or the code of
+# app_functions.py (some fields, e.g. the tile and basin weights, are calculated) have changed
+# since it was built. The app doesn't use a store built by other code.
+#
+import os
+import glob
+import json
+import shutil
+import traceback
+import datetime
+import app_functions
+from app_functions import *
+
+npy_dir=os.environ.get('ANCILLARY_NPY_DIR')
+#build from the netCDF files, not from an existing store
+app_functions.ancillary_npy_dir=None
+
+#size and modification time of each of the ancillary files
+def sourceFiles():
+    sources=dict()
+    for fname in sorted(glob.glob(ancillary_path+'*.nc')):
+        sources[os.path.basename(fname)]=[os.path.getsize(fname),int(os.path.getmtime(fname))]
+    return sources
+
+#ancillary fields used by the app: (function, arguments)
+def ancillaryFields():
+    fields=[(getOrog,()),(areacella,(144,)),(areacella,(145,)),(landFrac,(144,)),(landFrac,(145,)),
+        (tileFraci317,()),(tileWeights,('317',0)),(tileWeights,('317',1)),(oceanFrac,()),(oceanFrac_025,()),
+        (getBasinMask,()),(getBasinMask_025,()),(basinWeights,(1,)),(basinWeights,(025,)),
+        (iceEdgeLength,('x',)),(iceEdgeLength,('y',)),
+        (calc_areacello_om2,(1,)),(calc_areacello_om2,(025,)),(getdeptho,(1,)),(getdeptho,(025,)),
+        (om2GridLat,(ancillary_path+'om2_grid.nc',)),(om2GridLat,(ancillary_path+'om2-025_grid.nc',))]
+    for name in ['geolon_t','geolat_t','geolon_c','geolat_c','TLON','TLAT','ULON','ULAT']:
+        fields.append((get_vertices,(name,)))
+        fields.append((get_vertices_025,(name,)))
+    for name in ['geolon_t','geolon_c','TLON','ULON']:
+        fields.append((get_lon_vertices,(name,)))
+        fields.append((get_lon_vertices_025,(name,)))
+    return fields
+
+#names of the fields, as recorded in the manifest
+def fieldList(fields):
+    return ['{}{}'.format(function.__name__,args) for function, args in fields]
+
+#read all the ancillary fields used by the app into the ancillary cache
+def loadFields(fields):
+    for function, args in fields:
+        try:
+            function(*args)
+        except Exception, e:
+            print 'W: unable to load {}{}: {}'.format(function.__name__,args,e)
+
+def main():
+    if not npy_dir:
+        print 'ANCILLARY_NPY_DIR is not set, no ancillary store built'
+        return
+    store='{}/v{}'.format(npy_dir,ancillary_npy_version)
+    sources=sourceFiles()
+    fields=ancillaryFields()
+    code=ancillaryCodeDigest()
+    try:
+        with open(store+'/manifest.json') as f:
+            manifest=json.load(f)
+        if manifest['sources'] != sources:
+            print 'ancillary files have changed, rebuilding store'
+        elif manifest['field_list'] != fieldList(fields) or manifest['code'] != code:
+            print 'ancillary fields or the code calculating them have changed, rebuilding store'
+        else:
+            print 'ancillary store is up to date: {}'.format(store)
+            return
+    except (IOError,ValueError,KeyError):
+        print 'building ancillary store: {}'.format(store)
+    loadFields(fields)
+    #write to a temporary directory, and move it into place once complete
+    tmp_store='{}.tmp{}'.format(store,os.getpid())
+    if not os.path.exists(tmp_store): os.makedirs(tmp_store)
+    try:
+        names=saveAncillaryNpy(tmp_store)
+        manifest={'version':ancillary_npy_version,'built':datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'ancillary_path':ancillary_path,'sources':sources,'field_list':fieldList(fields),'code':code,
+            'fields':names}
+        with open(tmp_store+'/manifest.json','w') as f:
+            json.dump(manifest,f,indent=1)
+        for name in os.listdir(tmp_store): os.chmod('{}/{}'.format(tmp_store,name),0644)
+        if os.path.exists(store): shutil.rmtree(store)
+        os.rename(tmp_store,store)
+        os.chmod(store,0755)
+    except:
+        traceback.print_exc()
+        shutil.rmtree(tmp_store,ignore_errors=True)
+        raise
+    print 'ancillary store built with {} fields: {}'.format(len(names),store)
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,19 @@
 # Version 4 March 2022
 #
 from optparse import OptionParser
-import netCDF4
 import numpy as np
 import string
 import glob
 import datetime
 import re
 from app_functions import *
+from file_catalog import readCatalog,catalogEntry,catalogStamp,findTimeDimension
+from app_calendar import timeComponents,monthBounds,dateToTimes,dateToDayNumber,fromDayNumber,monthLength
+from app_accumulators import newAccumulator,accumulate,finishAccumulator
+from app_calculations import parseCalculation,checkCalculation
+from app_files import openFile,releaseFile,fileStats
+from app_cmor import cmorSession,cmorDataset,cmorTable,sessionVariable,resetSession,sessionStats
 import os,sys
-import cdms2
 import cdtime
 #import cmorx as cmor
 import cmor
@@ -22,38 +26,169 @@ import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=UserWarning)
 import time as timetime
+import threading
+import Queue
+import traceback
 import psutil
-import calendar
 
 cmorlogs=os.environ.get('CMOR_LOGS')
+#memory budget (Gb) for the data values each worker holds at one time:
+#input files are read, calculated and written in time slabs that fit within it
+try: mem_budget=float(os.environ.get('APP_MEM_BUDGET'))*1e9
+except: mem_budget=None
+#pipelined processing of the normal case: input files are read ahead in a reader thread and
+#written behind in a writer thread, while the values are calculated. pipeline_depth is the
+#number of time slabs waiting between each stage
+try: pipeline=os.environ.get('APP_PIPELINE').lower() in ['true','yes']
+except: pipeline=False
+try: pipeline_depth=max(1,int(os.environ.get('APP_PIPELINE_DEPTH')))
+except: pipeline_depth=2
+
+#
+#check the options passed for a variable against the default options,
+#returning a new set of options for this variable
+#
+def checkOptions(option_dictionary):
+    var_opts=dict(opts)
+    var_opts.update(option_dictionary) 
+    if(len(var_opts) != len(opts)): 
+        #new parameters don't match old ones 
+        raise ValueError('Error: {} input parameters don\'t match valid variable names'.format(str(len(var_opts)-len(opts))))
+    return var_opts
+
+#
+#set up cmor for a variable, or set of variables processed together
+#
+def cmorSetup(opts):
+    cdtime.DefaultCalendar=cdtime.GregorianCalendar
+    #
+    #the session of the previous variables is reused if it can be (see app_cmor.py)
+    cmorSession(opts['cmip_table_path'],'{}/log'.format(cmorlogs))
 
 #
 #main function to post-process files
 #
 def app(option_dictionary):
+    cmorSetup(checkOptions(option_dictionary))
+    try:
+        info=app_setup(option_dictionary)
+        if info == 0:
+            return 0
+        if app_write(info) == -1:
+            resetSession()
+            return -1
+        return app_close(info)
+    except:
+        resetSession()
+        raise
+
+#
+#process a group of variables which use the same input files (e.g. one infile pattern and
+#range of years), opening and reading each input file only once for all variables written
+#with the normal case. Other variables are written one after the other.
+#Returns a list with the app return value, or the exception raised, for each variable
+#
+def app_group(option_dictionaries):
+    print '\nstarting grouped app function for {} variables...'.format(len(option_dictionaries))
+    results=[None]*len(option_dictionaries)
+    infos=[None]*len(option_dictionaries)
+    cmorSetup(checkOptions(option_dictionaries[0]))
+    for n, option_dictionary in enumerate(option_dictionaries):
+        try:
+            info=app_setup(option_dictionary)
+            if info == 0: results[n]=0
+            else: infos[n]=info
+        except Exception, e:
+            print 'E: Unable to set up variable {}: {}'.format(option_dictionary['vcmip'],e)
+            traceback.print_exc()
+            results[n]=e
+    shared=[]
+    for n, info in enumerate(infos):
+        if info == None: continue
+        if writeCase(info['opts']) == 'normal':
+            shared.append(n)
+            continue
+        try:
+            if app_write(info) == -1: results[n]=-1
+        except Exception, e:
+            print 'E: Unable to write variable {}: {}'.format(info['opts']['vcmip'],e)
+            traceback.print_exc()
+            results[n]=e
+    #all input files needed by the shared variables, in chronological order
+    group_files=[]
+    for n in shared:
+        for input_file in infos[n]['inrange_access_files']:
+            if input_file not in group_files: group_files.append(input_file)
+    group_files.sort()
+    print 'writing {} variables from {} files...'.format(len(shared),len(group_files))
+    for input_file in group_files:
+        access_file=openFile(input_file)
+        print 'processing file: {}'.format(input_file)
+        file_vars=[n for n in shared if input_file in infos[n]['inrange_access_files']]
+        #read the file in time slabs that fit within the memory budget of all the variables,
+        #variables that need the whole file at once are read with the first slab
+        lengths=[]
+        for n in file_vars:
+            try: lengths.append(slabLength(infos[n],access_file))
+            except: lengths.append(None)
+        slab_lengths=[length for length in lengths if length != None]
+        var_tslices=dict()
+        for n, length in zip(file_vars,lengths):
+            if length != None: length=min(slab_lengths)
+            try: var_tslices[n]=timeSlabs(access_file,infos[n]['opts']['vin'][0],length)
+            except: var_tslices[n]=[None]
+        for i in range(max([len(tslices) for tslices in var_tslices.values()]+[0])):
+            #values read from this slab of the file, shared by all variables
+            cache=dict()
+            for n in file_vars:
+                info=infos[n]
+                if results[n] != None or i >= len(var_tslices[n]): continue
+                print '{}, {}:'.format(info['opts']['cmip_table'],info['opts']['vcmip'])
+                try:
+                    data_vals=normalVals(info,access_file,cache,var_tslices[n][i])
+                    if data_vals is None:
+                        results[n]=-1
+                        continue
+                    #the notes attribute is added to the file when the variable is first written
+                    cmor.set_cur_dataset_attribute('notes',info['opts']['notes'])
+                    normalWrite(info,data_vals)
+                    del data_vals
+                except Exception, e:
+                    print 'E: Unable to process data from {} {}'.format(input_file,e)
+                    traceback.print_exc()
+                    results[n]=e
+            del cache
+        releaseFile(access_file)
+    for n, info in enumerate(infos):
+        if info == None or results[n] != None: continue
+        try:
+            results[n]=app_close(info)
+        except Exception, e:
+            results[n]=e
+    if [result for result in results if result == -1 or isinstance(result,Exception)] != []:
+        resetSession()
+    return results
+
+#
+#set up the input files, axes and cmor variable for a variable
+#returns the information needed to write the variable, or 0 if there is no data
+#
+def app_setup(option_dictionary):
     start_time=timetime.time()
     print '\nstarting main app function...'
     #check the options passed to the function:    
-    len0=len(opts)
-    opts.update(option_dictionary) 
     #overwrite default parameters with new parameters
-    len1=len(opts)
-    if(len0 != len1): 
-        #new parameters don't match old ones 
-        raise ValueError('Error: {} input parameters don\'t match valid variable names'.format(str(len1-len0)))
-    #
-    cdtime.DefaultCalendar=cdtime.GregorianCalendar
-    #
-    cmor.setup(inpath=opts['cmip_table_path'],
-        netcdf_file_action=cmor.CMOR_REPLACE_4,
-        set_verbosity=cmor.CMOR_NORMAL,
-        exit_control=cmor.CMOR_NORMAL,
-        #exit_control=cmor.CMOR_EXIT_ON_MAJOR,
-        logfile='{}/log'.format(cmorlogs),create_subdirectories=1)
+    opts=checkOptions(option_dictionary)
+    startyear=opts['tstart']
+    endyear=opts['tend']
+    #check the calculation before any files are read
+    problems=checkCalculation(opts['calculation'],len(opts['vin']),calculationNames())
+    if problems != []:
+        raise Exception('E: {}'.format('; '.join(problems)))
     #
     #Define the dataset.
     #
-    cmor.dataset_json(opts['json_file_path'])
+    cmorDataset(opts['json_file_path'])
     #
     #Write a global variable called version_number which is used for CSIRO purposes.
     #
@@ -72,11 +207,12 @@ def app(option_dictionary):
     cmor.set_cur_dataset_attribute('exp_description',opts['exp_description'])
     cmor.set_cur_dataset_attribute('contact',os.environ.get('CONTACT'))
     #
-    #Load the CMIP tables into memory.
+    #Load the CMIP tables into memory (once per worker).
     #
     tables=[]
-    tables.append(cmor.load_table('{}/CMIP6_grids.json'.format(opts['cmip_table_path'])))
-    tables.append(cmor.load_table('{}/{}.json'.format(opts['cmip_table_path'],opts['cmip_table'])))
+    tables.append(cmorTable('{}/CMIP6_grids.json'.format(opts['cmip_table_path'])))
+    tables.append(cmorTable('{}/{}.json'.format(opts['cmip_table_path'],opts['cmip_table'])))
+    sessionVariable()
     #
     #Find all the ACCESS file names which match the "glob" pattern.
     #Sort the filenames, assuming that the sorted filenames will
@@ -88,29 +224,27 @@ def app(option_dictionary):
     tmp=opts['infile'].split()
     #if there are two different files used make a list of extra access files
     if len(tmp)>1:
-        extra_access_files=glob.glob(tmp[1])
-        extra_access_files.sort()
+        extra_catalog=readCatalog(opts['database'],tmp[1])
+        if extra_catalog != None:
+            extra_access_files=sorted(extra_catalog.keys())
+        else:
+            extra_access_files=glob.glob(tmp[1])
+            extra_access_files.sort()
         opts['infile']=tmp[0]
     else: extra_access_files=None
-    #set normal set of files
-    all_access_files=glob.glob(opts['infile'])
-    all_access_files.sort()
+    #set normal set of files, from the input file catalog if one exists for this pattern
+    catalog=readCatalog(opts['database'],opts['infile'])
+    if catalog != None:
+        print 'using input file catalog: {} files'.format(len(catalog))
+        all_access_files=sorted(catalog.keys())
+    else:
+        catalog=dict()
+        all_access_files=glob.glob(opts['infile'])
+        all_access_files.sort()
     #hack to remove files not in time range
     tmp=[]
     for fn in all_access_files:
-        if os.path.basename(fn).startswith('ice'):
-            #tstamp=int(os.path.basename(fn).split('.')[1][0:3])
-            tstamp=int(re.search("\d{4}",os.path.basename(fn)).group())
-        elif os.path.basename(fn).startswith('ocean'):
-            #tstamp=int(os.path.basename(fn).split('.')[1][3:6])
-            tstamp=int(re.search("\d{4}",os.path.basename(fn)).group())
-        else:
-            if opts['access_version'].find('CM2') != -1:
-                tstamp=int(os.path.basename(fn).split('.')[1][2:6])
-            elif opts['access_version'].find('ESM') != -1:
-                tstamp=int(os.path.basename(fn).split('.')[1][3:7])
-            else:
-                raise Exception('E: ACCESS_version not identified')
+        tstamp,monstamp=catalogStamp(catalog,fn,opts['access_version'])
         if opts['tstart'] <= tstamp and tstamp <= opts['tend']:
             tmp.append(fn)
     all_access_files=tmp
@@ -131,37 +265,30 @@ def app(option_dictionary):
     i=0
     while True:
         try:
-            temp_file=netCDF4.Dataset(all_access_files[i],'r')
+            entry=catalogEntry(catalog,all_access_files[i])
         except IndexError: 
             #gone through all files and haven't found variable
             raise Exception('Error! Variable missing from files: {}'.format(opts['vin'][0]))
-        try:
-            #see if the variable is in the file
-            var=temp_file.variables[opts['vin'][0]]
+        if opts['vin'][0] in entry['variables']:
+            #the variable is in the file
+            var=entry['variables'][opts['vin'][0]]
             break
-        except:
+        else:
             #try next file
-            temp_file.close()
             i+=1
             continue
     print 'using file: {}'.format(all_access_files[i])
-    try:
-        print "variable '{}' has units in ACCESS file: {}".format(opts['vin'][0],var.units)
-    except:
+    if var['units'] != None:
+        print "variable '{}' has units in ACCESS file: {}".format(opts['vin'][0],var['units'])
+    else:
         print "variable '{}' has no units listed in ACCESS file".format(opts['vin'][0])
     #
     time_dimension=None
     #find time info: time axis, reference time and set tstart and tend
     #    
-    try:
-        if  (opts['axes_modifier'].find('dropT') == -1) and (opts['cmip_table'].find('fx') == -1):
-            #try to find and set the correct time axis:
-            for var_dim in var.dimensions:
-                if var_dim.find('time') != -1 or temp_file.variables[var_dim].axis == 'T':
-                    time_dimension=var_dim
-    except:
-        #use the default time dimension 'time'
-        pass 
+    if  (opts['axes_modifier'].find('dropT') == -1) and (opts['cmip_table'].find('fx') == -1):
+        #try to find and set the correct time axis:
+        time_dimension=findTimeDimension(entry,opts['vin'][0])
     if opts['axes_modifier'].find('tMonOverride') != -1:
         #if we want to override dodgey units in the input files
         print 'overriding time axis...'
@@ -183,12 +310,11 @@ def app(option_dictionary):
             #We cannot handle negative reference dates (ie. BC dates); maybe we will encounter these
             #in some climate runs?
             #
-            time=temp_file.variables[time_dimension]
-            refString=time.units
+            refString=entry['times'][time_dimension]['units']
+            if refString == None: raise Exception
         except:
             refString="days since 0001-01-01"
             print 'W: Unable to extract a reference date: assuming it is 0001'
-        temp_file.close()
         try:
             #set to very end of the year
             startyear=opts['tstart']
@@ -215,15 +341,12 @@ def app(option_dictionary):
     if (time_dimension != None) and (opts['axes_modifier'].find('tMonOverride') == -1):
         for i, input_file in enumerate(all_access_files):
             try:
-                access_file=netCDF4.Dataset(input_file,'r')
                 #
                 #Read the time information.
                 #
-                tvals=access_file.variables[time_dimension]
-                #print opts['tend']
-                #print float(tvals[0])
+                times=catalogEntry(catalog,input_file)['times'][time_dimension]
+                tvals=times['values']
                 #test each file to see if it contains time values within the time range from tstart to tend
-                #if (opts['tend'] == None or float(tvals[0]) < float(opts['tend'])) and (opts['tstart'] == None or float(tvals[-1]) > float(opts['tstart'])):
                 if (opts['tend'] == None or float(tvals[0]) <= float(opts['tend'])) and (opts['tstart'] == None or float(tvals[-1]) >= float(opts['tstart'])):
                     inrange_access_files.append(input_file)
                     if opts['axes_modifier'].find('firsttime') != -1:
@@ -232,17 +355,12 @@ def app(option_dictionary):
                         inrange_access_times.append(tvals[0])
                         exit=True
                     else:
-                        irefString=access_file.variables[time_dimension].units
+                        irefString=times['units']
                         if irefString != refString: 
-                            #print 'WRONG refString ', irefString, refString
                             tvals=np.array(tvals) + cdtime.reltime(0,irefString).torel(refString,cdtime.DefaultCalendar).value
                         inrange_access_times.extend(tvals[:])
-                #
-                #Close the file.
-                #
-                access_file.close()
             except Exception, e:
-                print 'Cannot open file: {}'.format(e)
+                print 'Cannot read time values from file: {} {}'.format(input_file,e)
             if exit:
                 break
     else:
@@ -252,18 +370,14 @@ def app(option_dictionary):
         else:
             for i, input_file in enumerate(all_access_files):
                 try:
-                    access_file=netCDF4.Dataset(input_file,'r')
-                    tvals=access_file.variables[time_dimension]
-                    #print opts['tend']
-                    #print float(tvals[0])
-                    irefString=access_file.variables[time_dimension].units
+                    times=catalogEntry(catalog,input_file)['times'][time_dimension]
+                    tvals=times['values']
+                    irefString=times['units']
                     if irefString != refString: 
-                        #print 'WRONG refString ', irefString, refString
                         tvals=np.array(tvals) + cdtime.reltime(0,irefString).torel(refString,cdtime.DefaultCalendar).value
                     inrange_access_times.extend(tvals[:])
-                    access_file.close()
                 except Exception, e:
-                    print 'Cannot open file: {}'.format(e)
+                    print 'Cannot read time values from file: {} {}'.format(input_file,e)
                 if exit:
                     break
     print 'number of files in time range: {}'.format(len(inrange_access_files))
@@ -274,7 +388,9 @@ def app(option_dictionary):
     #
     #Load the first ACCESS NetCDF data file, and get the required information about the dimensions and so on.
     #
-    access_file=netCDF4.Dataset(inrange_access_files[0],'r')
+    access_file=openFile(inrange_access_files[0],'netCDF4')
+    #ancillary grid files opened for the coordinates
+    ancil_files=[]
     print 'opened input netCDF file: {}'.format(inrange_access_files[0])
     print 'checking axes...'
     sys.stdout.flush()
@@ -309,18 +425,21 @@ def app(option_dictionary):
                     if os.path.basename(inrange_access_files[0]).startswith('ocean'):
                         if opts['access_version'] == 'OM2-025':
                             acnfile=ancillary_path+'grid_spec.auscom.20150514.nc'
-                            acndata=netCDF4.Dataset(acnfile,'r')
+                            acndata=openFile(acnfile,'netCDF4')
+                            ancil_files.append(acndata)
                             lon_vals=acndata.variables['geolon_t']
                         else:
                             acnfile=ancillary_path+'grid_spec.auscom.20110618.nc'
-                            acndata=netCDF4.Dataset(acnfile,'r')
+                            acndata=openFile(acnfile,'netCDF4')
+                            ancil_files.append(acndata)
                             lon_vals=acndata.variables['x_T']
                     if os.path.basename(inrange_access_files[0]).startswith('ice'):
                         if opts['access_version'] == 'OM2-025':
                             acnfile=ancillary_path+'cice_grid_20150514.nc'
                         else:
                             acnfile=ancillary_path+'cice_grid_20101208.nc'
-                        acndata=netCDF4.Dataset(acnfile,'r')
+                        acndata=openFile(acnfile,'netCDF4')
+                        ancil_files.append(acndata)
                         lon_vals=acndata.variables[coord]
             elif coord.lower().find('lat') != -1:
                 print coord
@@ -333,18 +452,21 @@ def app(option_dictionary):
                     if os.path.basename(inrange_access_files[0]).startswith('ocean'):
                         if opts['access_version'] == 'OM2-025':
                             acnfile=ancillary_path+'grid_spec.auscom.20150514.nc'
-                            acndata=netCDF4.Dataset(acnfile,'r')
+                            acndata=openFile(acnfile,'netCDF4')
+                            ancil_files.append(acndata)
                             lat_vals=acndata.variables['geolat_t']
                         else:
                             acnfile=ancillary_path+'grid_spec.auscom.20110618.nc'
-                            acndata=netCDF4.Dataset(acnfile,'r')
+                            acndata=openFile(acnfile,'netCDF4')
+                            ancil_files.append(acndata)
                             lat_vals=acndata.variables['y_T']
                     if os.path.basename(inrange_access_files[0]).startswith('ice'):
                         if opts['access_version'] == 'OM2-025':
                             acnfile=ancillary_path+'cice_grid_20150514.nc'
                         else:
                             acnfile=ancillary_path+'cice_grid_20101208.nc'
-                        acndata=netCDF4.Dataset(acnfile,'r')
+                        acndata=openFile(acnfile,'netCDF4')
+                        ancil_files.append(acndata)
                         lat_vals=acndata.variables[coord]
         #create a list of dimensions
         dim_list=data_vals.dimensions
@@ -455,13 +577,8 @@ def app(option_dictionary):
                         print 'time values converted to days since 01,01,{r:04d}: {a}...{b}'.format(r=opts['reference_date'],a=tvals[0:5],b=tvals[-5:-1])
                         if opts['cmip_table'].find('A10day') != -1:
                             print('Aday10: selecting 1st, 11th, 21st days')
-                            a10_tvals=[]
-                            for a10 in tvals:
-                                a10_comp=cdtime.reltime(a10,'days since {r:04d}-01-01'.format(r=opts['reference_date'])).tocomp(cdtime.DefaultCalendar)
-                                #print(a10, a10_comp, a10_comp.day)
-                                if a10_comp.day in [1,11,21]:
-                                    a10_tvals.append(a10)
-                            tvals=a10_tvals
+                            a10_y,a10_m,a10_d,a10_frac=timeComponents(tvals,'days since {r:04d}-01-01'.format(r=opts['reference_date']))
+                            tvals=tvals[np.in1d(a10_d,[1,11,21])]
                     else:
                         print 'manually create time axis'
                         tvals=[]
@@ -521,22 +638,16 @@ def app(option_dictionary):
                                 raise Exception('unable to compute time bounds')
                         elif (((tvals[1]-tvals[0]) >= 28) and ((tvals[1]-tvals[0]) <= 31)): # and (len(tvals) != 1):
                             print 'monthly time bounds'
-                            for i,ordinaldate in enumerate(tvals):
-                                if (os.path.basename(all_access_files[0]).startswith('ice')) or (dim.find('time1') != -1 or dim.find('time_0') != -1):
-                                    ordinaldate=ordinaldate-0.5
-                                model_date=cdtime.reltime(int(ordinaldate),refString).tocomp(cdtime.DefaultCalendar)
-                                #min bound is first day of month
-                                model_date.day=1
-                                min_tvals.append(model_date.torel(refString,cdtime.DefaultCalendar).value)
-                                #max_bound is first day of next month
-                                model_date.year=model_date.year+model_date.month/12
-                                model_date.month=model_date.month%12+1                                
-                                max_tvals.append(model_date.torel(refString,cdtime.DefaultCalendar).value)
-                                #if opts['axes_modifier'].find('tMonOverride') != -1:
-                                if os.path.basename(all_access_files[0]).startswith('ice') or (dim.find('time1') != -1):
-                                    #correct date to middle of month
-                                    mid=(max_tvals[i]-min_tvals[i])/2.
-                                    tvals[i]=min_tvals[i]+mid
+                            tvals=np.asarray(tvals)
+                            ordinaldates=tvals
+                            if (os.path.basename(all_access_files[0]).startswith('ice')) or (dim.find('time1') != -1 or dim.find('time_0') != -1):
+                                ordinaldates=tvals-0.5
+                            #min bound is first day of month, max_bound is first day of next month
+                            min_tvals,max_tvals=monthBounds(np.trunc(ordinaldates),refString)
+                            #if opts['axes_modifier'].find('tMonOverride') != -1:
+                            if os.path.basename(all_access_files[0]).startswith('ice') or (dim.find('time1') != -1):
+                                #correct date to middle of month
+                                tvals=min_tvals+(max_tvals-min_tvals)/2.
                         else:
                             print 'default time bounds'
                             if os.path.basename(all_access_files[0]).startswith('ice'):
@@ -563,21 +674,10 @@ def app(option_dictionary):
                         if os.path.basename(all_access_files[0]).startswith('ice'):
                             if (len(tvals) <= 1) or (((tvals[1]-tvals[0]) >= 28) and ((tvals[1]-tvals[0]) <= 31)):
                                 print 'monthly time bounds'
-                                for i,ordinaldate in enumerate(tvals):
-                                    ordinaldate=ordinaldate-0.5
-                                    model_date=cdtime.reltime(int(ordinaldate),refString).tocomp(cdtime.DefaultCalendar)
-                                    #min bound is first day of month
-                                    model_date.day=1
-                                    min_tvals.append(model_date.torel(refString,cdtime.DefaultCalendar).value)
-                                    #max_bound is first day of next month
-                                    model_date.year=model_date.year+model_date.month/12
-                                    model_date.month=model_date.month%12+1                                
-                                    max_tvals.append(model_date.torel(refString,cdtime.DefaultCalendar).value)
-                                    #if opts['axes_modifier'].find('tMonOverride') != -1:
-                                    if os.path.basename(all_access_files[0]).startswith('ice'):
-                                        #correct date to middle of month
-                                        mid=(max_tvals[i]-min_tvals[i])/2.
-                                        tvals[i]=min_tvals[i]+mid
+                                #min bound is first day of month, max_bound is first day of next month
+                                min_tvals,max_tvals=monthBounds(np.trunc(np.asarray(tvals)-0.5),refString)
+                                #correct date to middle of month
+                                tvals=min_tvals+(max_tvals-min_tvals)/2.
                             else:    
                                 tvals=tvals-0.5
                         elif opts['mode'] == 'ccmi' and tvals[0].is_integer():
@@ -596,25 +696,15 @@ def app(option_dictionary):
                         print 'setup of time dimension complete - W: no cell bounds'
                     elif cmor_tName == 'time2':
                         #compute start and end bounds of whole time region
-                        tstarts=[]
-                        tends=[]
-                        tmids=[]
-                        for n in range(12):
-                            tstart=int(tvals[0])
-                            tend=int(tvals[-1])
-                            tstart=cdtime.reltime(tstart,refString).tocomp(cdtime.DefaultCalendar)
-                            tstart.day=1
-                            tstart.month=n+1
-                            tstart=tstart.torel(refString,cdtime.DefaultCalendar).value
-                            tstarts.append(tstart)
-                            tend=cdtime.reltime(tend,refString).tocomp(cdtime.DefaultCalendar)
-                            tend.month=n+1
-                            tend=tend.add(1,cdtime.Month)
-                            tend=tend.add(-1,cdtime.Day)
-                            tend=tend.torel(refString,cdtime.DefaultCalendar).value
-                            tends.append(tend)
-                            tmid=tstart+(tend-tstart)/2
-                            tmids.append(tmid)
+                        months=np.arange(1,13)
+                        start_y,start_m,start_d,start_frac=timeComponents(int(tvals[0]),refString)
+                        end_y,end_m,end_d,end_frac=timeComponents(int(tvals[-1]),refString)
+                        #first day of each month in the first year
+                        tstarts=dateToTimes(start_y,months,1,refString)
+                        #the day before the same day of the next month in the last year
+                        end_days=dateToDayNumber(end_y+months/12,months%12+1,end_d)-1
+                        tends=fromDayNumber(end_days,refString)
+                        tmids=tstarts+(tends-tstarts)/2
                         tval_bounds=np.column_stack((tstarts,tends))
                         tvals=tmids
                         cmor.set_table(tables[1])
@@ -677,11 +767,12 @@ def app(option_dictionary):
                     z_len=len(dim_values)
                     units=dim_vals.units
                     #test different z axis names:
-                    if opts['axes_modifier'].find('mod2plev19') != -1:
-                        lev_name='plev19'
-                        z_len=19
+                    if re.search('mod2plev\d+',opts['axes_modifier']):
+                        #interpolated from model levels to pressure levels (plev19, plev39, plev8)
+                        lev_name=re.search('mod2(plev\d+)',opts['axes_modifier']).group(1)
                         units='Pa'
-                        dim_values,dim_val_bounds=plev19()
+                        dim_values,dim_val_bounds=plevLevels(lev_name)
+                        z_len=len(dim_values)
                     elif (dim == 'st_ocean') or (dim == 'sw_ocean'):
                         if opts['axes_modifier'].find('depth100') != -1:
                             lev_name='depth100m'
@@ -865,14 +956,14 @@ def app(option_dictionary):
             if opts['access_version'] == 'OM2-025':
                 print('1/4 degree grid')
                 lon_vals_360=np.mod(lon_vals[:],360)
-                lon_vertices=np.ma.asarray(np.mod(get_vertices_025(lon_name),360)).filled()
+                lon_vertices=get_lon_vertices_025(lon_name)
                 #lat_vals_360=np.mod(lat_vals[:],300)
                 lat_vertices=np.ma.asarray(get_vertices_025(lat_name)).filled()
                 #lat_vertices=np.mod(get_vertices_025(lat_name),300)
             else:
                 lon_vals_360=np.mod(lon_vals[:],360)
                 lat_vertices=get_vertices(lat_name)
-                lon_vertices=np.mod(get_vertices(lon_name),360)
+                lon_vertices=get_lon_vertices(lon_name)
             print(lat_name)
             #print(type(lat_vertices),lat_vertices[0])
             print(lon_name)
@@ -1007,8 +1098,191 @@ def app(option_dictionary):
     #
     #Close the ACCESS file.
     #
-    access_file.close()
+    releaseFile(access_file)
+    for acndata in ancil_files: releaseFile(acndata)
     print 'closed input netCDF file'    
+    return {'opts':opts,'variable_id':variable_id,'inrange_access_files':inrange_access_files,
+        'time_dimension':time_dimension,'in_missing':in_missing,'catalog':catalog,
+        'startyear':startyear,'endyear':endyear,'start_time':start_time}
+
+#calculations that are monthly means of daily values, e.g. monthAve(var[0],times)
+monthave_calculation=re.compile('^\s*monthAve\((.*),\s*times\s*\)\s*$')
+
+#
+#which case is used to write the data of a variable
+#
+def writeCase(opts):
+    if opts['axes_modifier'].find('time_integral') != -1:
+        return 'time_integral'
+    elif opts['timeshot'].find('clim') != -1:
+        return 'clim'
+    elif opts['axes_modifier'].find('mon2yr') != -1:
+        return 'mon2yr'
+    elif opts['axes_modifier'].find('yrpoint') != -1:
+        return 'yrpoint'
+    elif opts['cmip_table'].find('A10dayPt') != -1:
+        return 'A10dayPt'
+    elif opts['axes_modifier'].find('monsecs') != -1:
+        return 'monsecs'
+    elif opts['axes_modifier'].find('day2mon') != -1 and monthave_calculation.match(opts['calculation']):
+        return 'day2mon'
+    else:
+        return 'normal'
+
+#
+#number of time steps of an open ACCESS file to read at once for a variable, so that the data
+#values fit within the memory budget (shared by in_flight slabs held at the same time).
+#Returns None if the whole file has to be read at once
+#
+def slabLength(info,access_file,in_flight=1):
+    opts=info['opts']
+    if mem_budget == None or info['time_dimension'] == None:
+        return None
+    used=None
+    if opts['calculation'] != '':
+        parsed=parseCalculation(opts['calculation'])
+        #calculations and time axes that combine time steps need all the values in the file
+        if 'times' in parsed['coords']:
+            return None
+        used=parsed['vars']
+    if opts['axes_modifier'].find('day2mon') != -1:
+        return None
+    step_bytes=0.
+    fixed_bytes=0.
+    for i,v in enumerate(opts['vin']):
+        #input variables the calculation doesn't use aren't read
+        if used != None and i not in used: continue
+        try: var=access_file.variables[v]
+        except KeyError: continue
+        if var.getOrder().startswith('t'):
+            step_bytes+=np.prod(var.shape[1:])*np.dtype(var.typecode()).itemsize
+        else:
+            fixed_bytes+=np.prod(var.shape)*np.dtype(var.typecode()).itemsize
+    if step_bytes == 0:
+        return None
+    #allow for the mask, a copy of the values and temporary arrays used in calculations
+    if opts['calculation'] == '': step_bytes*=2
+    else: step_bytes*=4
+    return max(1,int((mem_budget-fixed_bytes)/in_flight/step_bytes))
+
+#
+#split the time axis of an open ACCESS file into slabs of the given length
+#
+def timeSlabs(access_file,vname,length):
+    ntimes=access_file.variables[vname].shape[0]
+    if length == None or length >= ntimes:
+        return [None]
+    print 'reading {} time steps in slabs of {}'.format(ntimes,length)
+    return [slice(i,min(i+length,ntimes)) for i in range(0,ntimes,length)]
+
+#
+#read (and calculate if needed) the data values of a variable from an open ACCESS file
+#(or only the time slab tslice of the file)
+#returns None if the values can't be worked out
+#
+def normalVals(info,access_file,cache=None,tslice=None):
+    opts=info['opts']
+    #only levels 9 and 10 are read for the depth100 modifier
+    levels=opts['axes_modifier'].find('depth100') != -1
+    if opts['calculation'] == '':
+        if len(opts['vin'])>1:
+            print 'error: multiple input variables are given without a description of the calculation'
+            return None
+        elif levels:
+            data_vals=LazyVariable(access_file,opts['vin'][0],cache,tslice)
+        else: 
+            data_vals=readVariable(access_file,opts['vin'][0],cache,tslice)
+    else:
+        print 'calculating...'
+        data_vals=calculateVals((access_file,),opts['vin'],opts['calculation'],cache,tslice,lazy=levels)
+    if levels:
+        #the mean is masked where d105 is, so missing values are filled after it
+        data_vals=depth100(data_vals[:,9,:,:],data_vals[:,10,:,:])
+    if opts['calculation'] != '':
+        data_vals=fillMissing(info,data_vals)
+    return data_vals
+
+#convert the mask of calculated values to missing values
+def fillMissing(info,data_vals):
+    try: return data_vals.filled(info['in_missing'])
+    except:
+        #if values aren't in a masked array
+        return data_vals
+
+#
+#write the data values of a variable to the CMOR file
+#
+def normalWrite(info,data_vals):
+    with netcdf_lock:
+        cmorWrite(info,data_vals)
+
+def cmorWrite(info,data_vals):
+    try:
+        #print 'writing...'
+        print 'started writing @ ',timetime.time()-info['start_time']
+        if info['time_dimension'] != None:
+            #assuming time is the first dimension
+            print np.shape(data_vals)
+            cmor.write(info['variable_id'],data_vals,ntimes_passed=np.shape(data_vals)[0])
+        else:
+            cmor.write(info['variable_id'],data_vals,ntimes_passed=0)
+        print 'finished writing @ ',timetime.time()-info['start_time']
+    except Exception, e:
+        print 'E: Unable to write the CMOR variable to file {}'.format(e)
+        raise
+
+#
+#read (and calculate if needed) the data values of a variable from an open ACCESS file
+#for the cases that accumulate values over time. The mask is kept, so that masked values
+#aren't included in the means: missing values are filled when the values are written
+#
+def periodVals(info,access_file,tslice=None):
+    opts=info['opts']
+    if opts['calculation'] == '':
+        if len(opts['vin'])>1:
+            raise Exception('multiple input variables are given without a description of the calculation')
+        return readVariable(access_file,opts['vin'][0],tslice=tslice)
+    print 'calculating...'
+    return calculateVals((access_file,),opts['vin'],opts['calculation'],tslice=tslice)
+
+#
+#write the completed periods returned by an accumulator to the CMOR file, checking
+#each has ntimes time steps if given. The values of each period are one time, unless
+#stacked (values already have time as the first axis)
+#returns the number of periods written
+#
+def writePeriods(info,completed,ntimes=None,stacked=False):
+    if completed == []:
+        return 0
+    for period,vals,count in completed:
+        if ntimes != None and count != ntimes:
+            raise Exception('WARNING: data for period {} contains {} time steps, not {}'.format(period,count,ntimes))
+    if stacked:
+        data_vals=np.ma.concatenate([vals for period,vals,count in completed])
+    else:
+        data_vals=np.ma.stack([vals for period,vals,count in completed])
+    print 'writing {} periods with cmor...'.format(np.shape(data_vals)[0])
+    try:
+        cmor.write(info['variable_id'],data_vals.filled(info['in_missing']),ntimes_passed=np.shape(data_vals)[0])
+    except Exception, e:
+        print 'E: Unable to write the CMOR variable to file {}'.format(e)
+        raise
+    return len(completed)
+
+#
+#write the data of a variable set up by app_setup
+#returns -1 if the data can't be worked out
+#
+def app_write(info):
+    opts=info['opts']
+    variable_id=info['variable_id']
+    inrange_access_files=info['inrange_access_files']
+    time_dimension=info['time_dimension']
+    in_missing=info['in_missing']
+    catalog=info['catalog']
+    startyear=info['startyear']
+    endyear=info['endyear']
+    case=writeCase(opts)
     #Loop over all the in time range ACCESS files, and process those which we need to.
     #
     print 'writing data, and calculating if needed...'
@@ -1020,14 +1294,14 @@ def app(option_dictionary):
     #
     #calculate time integral of the first variable (possibly adding a second variable to each time)
     #
-    if opts['axes_modifier'].find('time_integral') != -1:
+    if case == 'time_integral':
         try:    
             run=np.float32(opts['calculation'])
         except:        
             run=np.float32(0.0)
         for input_file in inrange_access_files:
             #If the data is a climatology, store the values in a running sum
-            access_file=cdms2.open(input_file,'r')
+            access_file=openFile(input_file)
             var=access_file.variables[opts['vin'][0]]
             t=var.getTime()
             tbox=daysInMonth(t)
@@ -1036,161 +1310,121 @@ def app(option_dictionary):
             #if we have a second variable, just add this to the output (not included in the integration)
             if len(opts['vin']) == 2:
                 varout+=access_file.variables[opts['vin'][1]][:]
-            access_file.close()
+            releaseFile(access_file)
             cmor.write(variable_id,(varout),ntimes_passed=np.shape(varout)[0])
     #
     #Monthly Climatology case
     #
-    elif opts['timeshot'].find('clim') != -1:
+    elif case == 'clim':
+        acc=newAccumulator('clim',12)
         for input_file in inrange_access_files:
-            access_file=cdms2.open(input_file,'r')
+            access_file=openFile(input_file)
+            print 'processing file: {}'.format(input_file)
             t=access_file.variables[opts['vin'][0]].getTime()
-            #Set var to be sum of variables in 'vin' (can modify to use calculation if needed)
-            var=None
-            for v in opts['vin']:
-                try:        
-                    var+=(access_file.variables[v][:])
-                    print 'added extra variable'
-                except:        
-                    var=access_file.variables[v][:]
-            try: 
-                vals_wsum,clim_days=monthClim(var,t,vals_wsum,clim_days)
-            except:
-                #first time
-                tmp=var[0,:].shape
-                out_shape=(12,)+tmp
-                vals_wsum=np.ma.zeros(out_shape,dtype=np.float32)
-                print 'first time, data shape: {}'.format(np.shape(vals_wsum))
-                clim_days=np.zeros([12],dtype=int)#sum of number of days in the month
-                vals_wsum,clim_days=monthClim(var,t,vals_wsum,clim_days)
-            access_file.close()
-        #calculate the climatological average for each month from the running sum (vals_wsum)
-        #and the total number of days for each month (clim_days)
-        for j in range(12):
-            print 'month: {}, sum of days: {}'.format(j+1,clim_days[j])
-            #average vals_wsum using the total number of days summed for each month
-            vals_wsum[j,:]=vals_wsum[j,:]/clim_days[j]
-        cmor.write(variable_id,(vals_wsum),ntimes_passed=12)
+            years,months,days,frac=timeComponents(t[:],t.units,axisCalendar(t))
+            #weight each time by the number of days in its month
+            mdays=monthLength(years,months,axisCalendar(t))
+            for tslice in timeSlabs(access_file,opts['vin'][0],slabLength(info,access_file)):
+                if tslice == None: tslice=slice(None)
+                #Set var to be sum of variables in 'vin' (can modify to use calculation if needed)
+                var=None
+                for v in opts['vin']:
+                    if var is None:
+                        var=readVariable(access_file,v,tslice=tslice)
+                    else:
+                        var+=readVariable(access_file,v,tslice=tslice)
+                        print 'added extra variable'
+                accumulate(acc,var,months[tslice]-1,mdays[tslice])
+                del var
+            releaseFile(access_file)
+        #the climatological average for each month is the sum of the values weighted by
+        #the number of days, divided by the total number of days for that month
+        for months,vals,counts in finishAccumulator(acc):
+            for j in months:
+                print 'month: {}, time steps: {}'.format(j+1,counts[j])
+            writePeriods(info,[(None,vals,counts.sum())],stacked=True)
     #
     #Annual means - Oyr / Eyr tables
     #
-    elif (opts['axes_modifier'].find('mon2yr') != -1):
-        access_file0=cdms2.open(inrange_access_files[0],'r')
-        #access_file0=netCDF4.Dataset(inrange_access_files[0])
-        if opts['calculation'] == '':
-            data_val0=access_file0.variables[opts['vin'][0]][:]
-        else:
-            data_val0=calculateVals((access_file0,),opts['vin'],opts['calculation'])
-        vshape=np.shape(data_val0)
-        print(vshape)
-        for year in range(startyear,endyear+1):
-            print 'processing year {}'.format(year)
-            count=0
-            vsum=np.ma.zeros(vshape[1:],dtype=np.float32)
-            for input_file in inrange_access_files:
-                if opts['axes_modifier'].find('tMonOverride') != -1:
-                    print('reading date info from file name')
-                    if os.path.basename(input_file).startswith('ocean'):
-                        yearstamp=int(os.path.basename(input_file).split('.')[1][3:7])
-                    else:
-                        if opts['access_version'].find('CM2') != -1:
-                            yearstamp=int(os.path.basename(input_file).split('.')[1][2:6])
-                        elif opts['access_version'].find('ESM') != -1:
-                            yearstamp=int(os.path.basename(input_file).split('.')[1][3:7])
-                    access_file=cdms2.open(input_file,'r')
-                    t=access_file.variables[opts['vin'][0]].getTime()
-                    datelist=t.asComponentTime()
-                    if yearstamp == year: yearinside=True
-                    else: yearinside=False
-                else:
-                    print('reading date info from time dimension')
-                    access_file=cdms2.open(input_file,'r')
-                    t=access_file.variables[opts['vin'][0]].getTime()
-                    datelist=t.asComponentTime()
-                    yearinside=False
-                    for date in datelist:
-                        if date.year == year: yearinside=True
-                #try: print year, yearstamp, yearinside, input_file
-                #except: print year, yearinside, input_file
-                if yearinside:
-                    print 'found data in file {}'.format(input_file)
-                    for index, d in enumerate(datelist[:]):
-                        if (d.year == year) or (opts['axes_modifier'].find('tMonOverride') != -1):
-                            if opts['calculation'] == '':
-                                data_vals=access_file.variables[opts['vin'][0]][:]
-                            else:
-                                data_vals=calculateVals((access_file,),opts['vin'],opts['calculation'])
-                            try: data_vals=data_vals.filled(in_missing)
-                            except: pass
-                            print 'shape: {}'.format(np.shape(data_vals))
-                            print 'time index: {}, date: {}'.format(index,d)
-                            try: 
-                                vsum+=data_vals[index,:,:]
-                                count+=1
-                            except: 
-                                vsum+=data_vals[index,:,:,:]
-                                count+=1
-                access_file.close()
-            if count == 12:
-                vyr=vsum/12
-                print 'writing with cmor...'
-                cmor.write(variable_id,vyr,ntimes_passed=1)
+    elif case == 'mon2yr':
+        acc=newAccumulator('mean')
+        nyears=0
+        for input_file in inrange_access_files:
+            access_file=openFile(input_file)
+            print 'processing file: {}'.format(input_file)
+            t=access_file.variables[opts['vin'][0]].getTime()
+            if opts['axes_modifier'].find('tMonOverride') != -1:
+                print('reading date info from file name')
+                yearstamp,monstamp=catalogStamp(catalog,input_file,opts['access_version'])
+                years=np.zeros(len(t),dtype=int)+yearstamp
             else:
-                print count
-                raise Exception('WARNING: annual data contains {} months of data'.format(count))    
+                print('reading date info from time dimension')
+                years,months,days,frac=timeComponents(t[:],t.units,axisCalendar(t))
+            for tslice in timeSlabs(access_file,opts['vin'][0],slabLength(info,access_file)):
+                if tslice == None: tslice=slice(None)
+                inrange=(years[tslice] >= startyear) & (years[tslice] <= endyear)
+                if not inrange.any(): continue
+                data_vals=periodVals(info,access_file,tslice)
+                nyears+=writePeriods(info,accumulate(acc,data_vals[inrange],years[tslice][inrange]),ntimes=12)
+                del data_vals
+            releaseFile(access_file)
+        nyears+=writePeriods(info,finishAccumulator(acc),ntimes=12)
+        if nyears != endyear-startyear+1:
+            raise Exception('WARNING: annual data found for {} of {} years'.format(nyears,endyear-startyear+1))
     #
     #Annual point values - landUse variables
     #
-    elif opts['axes_modifier'].find('yrpoint') != -1:
-        for year in range(startyear,endyear+1):
-            for input_file in inrange_access_files:
-                if opts['access_version'].find('CM2') != -1:
-                    yearstamp=int(os.path.basename(input_file).split('.')[1][2:6])
-                    monstamp=int(os.path.basename(input_file).split('.')[1][6:8])
-                elif opts['access_version'].find('ESM') != -1:
-                    try:
-                        yearstamp=int(os.path.basename(input_file).split('.')[1][3:7])
-                        monstamp=int(os.path.basename(input_file).split('.')[1][8:10])
-                    except:
-                        yearstamp=int(os.path.basename(input_file).split('.')[1][3:7])
-                        monstamp=int(os.path.basename(input_file).split('.')[1][7:9])
-                if not monstamp == 12 or not yearstamp == year: continue
-                access_file=cdms2.open(input_file,'r')
-                t=access_file.variables[opts['vin'][0]].getTime()
-                datelist=t.asComponentTime()
-                yearcurrent=datelist[0].year
-                if yearcurrent == year:
-                    print 'processing year {}, file {}'.format(year,input_file)
-                    for index, d in enumerate(datelist[:]):
-                        if d.month == 12:
-                            if opts['calculation'] == '':
-                                data_vals=access_file.variables[opts['vin'][0]][:]
-                            else:
-                                data_vals=calculateVals((access_file,),opts['vin'],opts['calculation'])
-                            try: data_vals=data_vals.filled(in_missing)
-                            except:
-                                #if values aren't in a masked array
-                                pass 
-                            print 'shape: {}'.format(np.shape(data_vals))
-                            print 'time index: {}, date: {}'.format(index,d)
-                        else: pass
-                access_file.close()
-            print 'writing with cmor...'
-            print np.shape(data_vals)
-            cmor.write(variable_id,data_vals[0,:,:,:],ntimes_passed=1)
+    elif case == 'yrpoint':
+        acc=newAccumulator('last')
+        nyears=0
+        for input_file in inrange_access_files:
+            #only the December values are used
+            yearstamp,monstamp=catalogStamp(catalog,input_file,opts['access_version'])
+            if monstamp not in (None,12) or yearstamp < startyear or yearstamp > endyear: continue
+            access_file=openFile(input_file)
+            t=access_file.variables[opts['vin'][0]].getTime()
+            years,months,days,frac=timeComponents(t[:],t.units,axisCalendar(t))
+            for index in np.nonzero((months == 12) & (years >= startyear) & (years <= endyear))[0]:
+                print 'processing year {}, file {}'.format(years[index],input_file)
+                data_vals=periodVals(info,access_file,slice(index,index+1))
+                nyears+=writePeriods(info,accumulate(acc,data_vals,years[index:index+1]))
+            releaseFile(access_file)
+        nyears+=writePeriods(info,finishAccumulator(acc))
+        if nyears != endyear-startyear+1:
+            raise Exception('WARNING: December data found for {} of {} years'.format(nyears,endyear-startyear+1))
+    #
+    #Monthly means of daily data (monthAve calculations with the day2mon axis modifier)
+    #
+    elif case == 'day2mon':
+        #calculate the values averaged by monthAve, and average them over each month
+        #(months can be split across files and time slabs)
+        day_info=dict(info)
+        day_info['opts']=dict(opts,calculation=monthave_calculation.match(opts['calculation']).group(1),
+            axes_modifier=opts['axes_modifier'].replace('day2mon',''))
+        acc=newAccumulator('mean')
+        for input_file in inrange_access_files:
+            access_file=openFile(input_file)
+            print 'processing file: {}'.format(input_file)
+            t=access_file.variables[opts['vin'][0]].getTime()
+            years,months,days,frac=timeComponents(t[:],t.units,axisCalendar(t))
+            for tslice in timeSlabs(access_file,opts['vin'][0],slabLength(day_info,access_file)):
+                if tslice == None: tslice=slice(None)
+                data_vals=periodVals(day_info,access_file,tslice)
+                writePeriods(info,accumulate(acc,data_vals,years[tslice]*12+months[tslice]-1))
+                del data_vals
+            releaseFile(access_file)
+        writePeriods(info,finishAccumulator(acc))
     #
     #Aday10Pt processing for CCMI2022
     #
-    elif opts['cmip_table'].find('A10dayPt') != -1:
+    elif case == 'A10dayPt':
         for i, input_file in enumerate(inrange_access_files):
             print 'processing file: {}'.format(input_file)
-            access_file=cdms2.open(input_file,'r')
+            access_file=openFile(input_file)
             t=access_file.variables[opts['vin'][0]].getTime()
-            datelist=t.asdatetime()
+            years,months,days,frac=timeComponents(t[:],t.units,axisCalendar(t))
             print('ONLY 1st, 11th, 21st days to be used')
-            a10_idxlist=[]
-            for idx, date in enumerate(datelist):
-                if date.day in [1,11,21]: a10_idxlist.append(idx)
+            a10_idxlist=list(np.nonzero(np.in1d(days,[1,11,21]))[0])
             print(a10_idxlist)
             a10_datavals=[]
             try:
@@ -1201,7 +1435,7 @@ def app(option_dictionary):
                     else: 
                         for a10 in a10_idxlist:
                             a10_datavals.append(access_file.variables[opts['vin'][0]][a10])
-                        access_file.close()
+                        releaseFile(access_file)
                 else: 
                     print 'calculating...'
                     data_vals=calculateVals((access_file,),opts['vin'],opts['calculation'])
@@ -1211,7 +1445,7 @@ def app(option_dictionary):
                     except:
                         #if values aren't in a masked array
                         pass 
-                    access_file.close()
+                    releaseFile(access_file)
             except Exception, e:
                 print 'E: Unable to process data from {} {}'.format(input_file,e)
                 raise
@@ -1229,14 +1463,13 @@ def app(option_dictionary):
     #
     #Convert monthly integral to rate (e.g. K to K s-1, as in tntrl)
     #
-    elif opts['axes_modifier'].find('monsecs') != -1:
+    elif case == 'monsecs':
         for i, input_file in enumerate(inrange_access_files):
             print 'processing file: {}'.format(input_file)
-            access_file=cdms2.open(input_file,'r')
+            access_file=openFile(input_file)
             t=access_file.variables[opts['vin'][0]].getTime()
-            datelist=t.asdatetime()
-            #print(calendar.monthrange(datelist[0].year,datelist[0].month)[1])
-            monsecs=calendar.monthrange(datelist[0].year,datelist[0].month)[1]*86400
+            years,months,days,frac=timeComponents(t[0:1],t.units,axisCalendar(t))
+            monsecs=monthLength(years,months,axisCalendar(t))[0]*86400
             try:
                 if opts['calculation'] == '':
                     if len(opts['vin'])>1:
@@ -1246,7 +1479,7 @@ def app(option_dictionary):
                         data_vals=access_file.variables[opts['vin'][0]][:]
                         data_vals=data_vals/monsecs
                         #print data_vals
-                        access_file.close()
+                        releaseFile(access_file)
                 else:
                     print 'calculating...'
                     data_vals=calculateVals((access_file,),opts['vin'],opts['calculation'])
@@ -1256,7 +1489,7 @@ def app(option_dictionary):
                     except:
                         #if values aren't in a masked array
                         pass 
-                    access_file.close()
+                    releaseFile(access_file)
             except Exception, e:
                 print 'E: Unable to process data from {} {}'.format(input_file,e)
                 raise
@@ -1274,63 +1507,167 @@ def app(option_dictionary):
     #
     #normal case
     #
+    elif pipeline:
+        return pipelinedWrite(info)
     else:
         for i, input_file in enumerate(inrange_access_files):
             #
             #Load the ACCESS NetCDF data.
             #
-            access_file=cdms2.open(input_file,'r')
+            access_file=openFile(input_file)
             #access_file=netCDF4.Dataset(input_file)
             print 'processing file: {}'.format(input_file)
-            try:
-                if opts['calculation'] == '':
-                    if len(opts['vin'])>1:
-                        print 'error: multiple input variables are given without a description of the calculation'
+            #read, calculate and write the data in time slabs within the memory budget
+            for tslice in timeSlabs(access_file,opts['vin'][0],slabLength(info,access_file)):
+                try:
+                    data_vals=normalVals(info,access_file,tslice=tslice)
+                    if data_vals is None:
+                        releaseFile(access_file)
                         return -1
-                    else: 
-                        data_vals=access_file.variables[opts['vin'][0]][:]
-                        #print data_vals
-                        access_file.close()
+                except Exception, e:
+                    print 'E: Unable to process data from {} {}'.format(input_file,e)
+                    raise
+                #
+                #If the data is not a climatology:
+                #Write the data to the CMOR file.
+                #
                 else:
-                    print 'calculating...'
-                    data_vals=calculateVals((access_file,),opts['vin'],opts['calculation'])
-                    #convert mask to missing values
-                    try: data_vals=data_vals.filled(in_missing)
-                    except:
-                        #if values aren't in a masked array
-                        pass 
-                    access_file.close()
-                if opts['axes_modifier'].find('depth100') != -1:
-                    data_vals=depth100(data_vals[:,9,:,:],data_vals[:,10,:,:])
+                    normalWrite(info,data_vals)
+                    del data_vals
+            releaseFile(access_file)
+
+#
+#read (without calculating) the input variables a variable needs from a time slab of an open
+#ACCESS file, into a cache that is handed over to the calculation (see readVariable)
+#inputs that are read lazily (only some levels) are left to the calculation
+#
+def prefetchVals(info,access_file,tslice=None):
+    opts=info['opts']
+    cache=dict()
+    if opts['calculation'] == '':
+        used=[0]
+        if opts['axes_modifier'].find('depth100') != -1: used=[]
+    else:
+        parsed=parseCalculation(opts['calculation'])
+        used=parsed['vars']
+        if used == None: used=range(len(opts['vin']))
+        if parsed['arithmetic'] == None and parsed['lazy'] == None: used=[]
+        elif parsed['arithmetic'] == None: used=[i for i in used if i not in parsed['lazy']]
+    for i in used:
+        v=opts['vin'][i]
+        if v in access_file.variables:
+            cache[cacheKey(access_file,v,tslice)]=readVariable(access_file,v,tslice=tslice)
+    cache['handover']=True
+    return cache
+
+#
+#normal case in three stages: a reader thread opens the input files and reads the time slabs
+#ahead, the values are calculated in this thread, and a writer thread writes them with CMOR.
+#The stages are linked by queues of pipeline_depth slabs, so a stage waits when the next one
+#falls behind. The time each stage is busy and waiting is reported at the end
+#
+def pipelinedWrite(info):
+    opts=info['opts']
+    read_queue=Queue.Queue(pipeline_depth)
+    write_queue=Queue.Queue(pipeline_depth)
+    #busy and waiting time (s) of each stage
+    times={'read':[0.,0.],'calculate':[0.,0.],'write':[0.,0.]}
+    errors=[]
+    #slabs held at once: one in each stage, and the slabs in the queues
+    in_flight=2*pipeline_depth+3
+    def put(queue,item,stage):
+        start=timetime.time()
+        queue.put(item)
+        times[stage][1]+=timetime.time()-start
+    def get(queue,stage):
+        start=timetime.time()
+        item=queue.get()
+        times[stage][1]+=timetime.time()-start
+        return item
+    def reader():
+        try:
+            for input_file in info['inrange_access_files']:
+                start=timetime.time()
+                with netcdf_lock:
+                    access_file=openFile(input_file)
+                    tslices=timeSlabs(access_file,opts['vin'][0],slabLength(info,access_file,in_flight))
+                times['read'][0]+=timetime.time()-start
+                for n, tslice in enumerate(tslices):
+                    if errors: break
+                    start=timetime.time()
+                    cache=prefetchVals(info,access_file,tslice)
+                    times['read'][0]+=timetime.time()-start
+                    put(read_queue,(input_file,access_file,tslice,cache,n == len(tslices)-1),'read')
+                if errors: break
+        except Exception, e:
+            print 'E: Unable to read data from {} {}'.format(input_file,e)
+            traceback.print_exc()
+            errors.append(e)
+        put(read_queue,None,'read')
+    def writer():
+        while True:
+            data_vals=get(write_queue,'write')
+            if data_vals is None: break
+            if errors: continue
+            start=timetime.time()
+            try: normalWrite(info,data_vals)
+            except Exception, e: errors.append(e)
+            times['write'][0]+=timetime.time()-start
+    threads=[threading.Thread(target=reader),threading.Thread(target=writer)]
+    for thread in threads: thread.start()
+    first=True
+    #files are closed here, after their last slab has been calculated
+    open_files=[]
+    while True:
+        item=get(read_queue,'calculate')
+        if item is None: break
+        input_file,access_file,tslice,cache,last=item
+        if access_file not in open_files: open_files.append(access_file)
+        data_vals=None
+        if not errors:
+            print 'processing file: {}'.format(input_file)
+            start=timetime.time()
+            try:
+                #the first slab is calculated holding the netCDF lock, as calculations
+                #read the ancillary files they need then
+                if first:
+                    with netcdf_lock: data_vals=normalVals(info,access_file,cache,tslice)
+                    first=False
+                else:
+                    data_vals=normalVals(info,access_file,cache,tslice)
+                if data_vals is None: errors.append(-1)
             except Exception, e:
                 print 'E: Unable to process data from {} {}'.format(input_file,e)
-                raise
-            #
-            #If the data is not a climatology:
-            #Write the data to the CMOR file.
-            #
-            else:
-                try:
-                    #print 'writing...'
-                    print 'started writing @ ',timetime.time()-start_time
-                    if time_dimension != None:
-                        #assuming time is the first dimension
-                        print np.shape(data_vals)
-                        cmor.write(variable_id,data_vals,ntimes_passed=np.shape(data_vals)[0])
-                    else:
-                        cmor.write(variable_id,data_vals,ntimes_passed=0)
-                    print 'finished writing @ ',timetime.time()-start_time
-                except Exception, e:
-                    print 'E: Unable to write the CMOR variable to file {}'.format(e)
-                    raise
-    #
-    #Close the CMOR file.
-    #
+                traceback.print_exc()
+                errors.append(e)
+            times['calculate'][0]+=timetime.time()-start
+            if not errors:
+                put(write_queue,data_vals,'calculate')
+        del data_vals,cache
+        if last:
+            with netcdf_lock: releaseFile(access_file)
+            open_files.remove(access_file)
+    put(write_queue,None,'calculate')
+    for thread in threads: thread.join()
+    with netcdf_lock:
+        for access_file in open_files: releaseFile(access_file)
+    for stage in ['read','calculate','write']:
+        print 'pipeline {}: busy {:.1f}s, waiting {:.1f}s'.format(stage,times[stage][0],times[stage][1])
+    if errors:
+        if errors[0] == -1: return -1
+        raise errors[0]
+
+#
+#Close the CMOR file.
+#
+def app_close(info):
     try:
-        path=cmor.close(variable_id,file_name=True)
+        path=cmor.close(info['variable_id'],file_name=True)
     except:
         print 'E: We should not be here!'
         raise
+    print fileStats()
+    print sessionStats()
     return path
 
 #Read the command line, setting reasonable default values for most things.
@@ -1363,7 +1700,8 @@ parser.add_option('--axes_modifier',dest='axes_modifier',default='',
     monClim (monthly climatological averages), time1 (time snapshots),\
     day2mon (convert time from daily to monthly,\
     basin (add axes for basins),\
-    oline (add axis for ocean lines)')
+    oline (add axis for ocean lines),\
+    mod2plev19, mod2plev39, mod2plev8 (model levels interpolated to pressure levels)')
 parser.add_option('--positive',dest='positive',default='',
     help='string defining whether the variable has the positive attribute: possible values: up, down')
 parser.add_option('--notes',dest='notes',default='',
@@ -1380,6 +1718,8 @@ parser.add_option('--mode',dest='mode',default='cmip6',
     help='CMIP6, CCMI2022, or custom mode')
 parser.add_option('--exp_description',dest='exp_description',default='cmip6 standard experiment',
     help='Description of the experiment setup')
+parser.add_option('--database',dest='database',default=None,
+    help='Path to the APP database holding the input file catalog [default: search for input files]')
 (options, args)=parser.parse_args()
 opts=dict()
 #produce a dictionary out of the options object
@@ -1403,6 +1743,7 @@ opts['reference_date']=options.reference_date
 opts['frequency']=options.frequency
 opts['mode']=options.mode
 opts['exp_description']=options.exp_description
+opts['database']=options.database
 
 if __name__ == "__main__":
     app(opts)
@@ -0,0 +1,94 @@
+# Streaming accumulators for the ACCESS Post Processor
+#
+# Time means, point samples and climatologies are built up from the time steps of
+# the input files as they are read, so each input file (or time slab of a file) is
+# visited once, and each period is returned for writing as soon as it is complete.
+#
+# An accumulator is a dictionary created by newAccumulator. Kinds:
+#   'mean'  - (weighted) mean of the time steps in each period (e.g. annual, monthly means)
+#   'last'  - last time step in each period (e.g. December point values)
+#   'clim'  - (weighted) mean of the time steps for each key over all the data
+#             (e.g. monthly climatology, key is the month), returned by finishAccumulator
+#
+# For 'mean' and 'last', the periods of the time steps passed to accumulate must not
+# decrease: a period is complete when a time step from a later period is added.
+#
+import numpy as np
+from app_calendar import runStarts
+from app_functions import sumFirstAxis,timeWeights
+
+def newAccumulator(kind,nkeys=None):
+    if kind not in ('mean','last','clim'):
+        raise Exception('E: unknown accumulator: {}'.format(kind))
+    if kind == 'clim' and nkeys == None:
+        raise Exception('E: number of keys needed for a climatology accumulator')
+    return {'kind':kind,'nkeys':nkeys,'period':None,'vals':None,'weight':None,'count':None}
+
+#values of the current period of a mean or point accumulator, and start a new period
+def closePeriod(acc):
+    period,count=acc['period'],acc['count']
+    if acc['kind'] == 'mean':
+        vals=acc['vals']/acc['weight']
+    else:
+        vals=acc['vals']
+    acc['period'],acc['vals'],acc['weight'],acc['count']=None,None,None,None
+    return (period,vals,count)
+
+#add time steps (time is the first axis of vals) with the period (or key) of each step
+#and optional weights (default 1 for each step)
+#returns a list of (period,values,number of time steps) for the periods that are complete
+def accumulate(acc,vals,periods,weights=None):
+    periods=np.asarray(periods)
+    if len(periods) == 0:
+        return []
+    if np.shape(vals)[0] != len(periods):
+        raise Exception('E: {} time steps with {} periods'.format(np.shape(vals)[0],len(periods)))
+    if weights is None:
+        weights=np.ones(len(periods))
+    weights=np.asarray(weights,dtype=np.float64)
+    vals=np.ma.asarray(vals)
+    if acc['kind'] == 'clim':
+        if acc['vals'] is None:
+            acc['vals']=np.ma.zeros((acc['nkeys'],)+vals.shape[1:],dtype=vals.dtype)
+            acc['weight']=np.zeros(acc['nkeys'])
+            acc['count']=np.zeros(acc['nkeys'],dtype=int)
+        for key in np.unique(periods):
+            index=np.nonzero(periods == key)[0]
+            acc['vals'][key]+=sumFirstAxis(vals[index]*timeWeights(weights[index],vals))
+            acc['weight'][key]+=weights[index].sum()
+            acc['count'][key]+=len(index)
+        return []
+    completed=[]
+    starts=runStarts(periods)
+    ends=np.append(starts[1:],len(periods))
+    for start, end in zip(starts,ends):
+        period=periods[start]
+        if acc['period'] is not None and period != acc['period']:
+            if period < acc['period']:
+                raise Exception('E: period {} added after period {}'.format(period,acc['period']))
+            completed.append(closePeriod(acc))
+        if acc['kind'] == 'mean':
+            vsum=sumFirstAxis(vals[start:end]*timeWeights(weights[start:end],vals))
+            if acc['vals'] is None:
+                acc['vals'],acc['weight'],acc['count']=vsum,0.,0
+            else:
+                acc['vals']=acc['vals']+vsum
+        else:
+            acc['vals'],acc['weight']=vals[end-1].copy(),0.
+            if acc['count'] == None: acc['count']=0
+        acc['period']=period
+        acc['weight']+=weights[start:end].sum()
+        acc['count']+=end-start
+    return completed
+
+#returns (period,values,number of time steps) for the last period of a mean or point accumulator,
+#or (keys,values,number of time steps for each key) of a climatology
+def finishAccumulator(acc):
+    if acc['kind'] == 'clim':
+        if acc['vals'] is None:
+            return []
+        vals=acc['vals']/acc['weight'].reshape((-1,)+(1,)*(acc['vals'].ndim-1))
+        return [(np.arange(acc['nkeys']),vals.astype(acc['vals'].dtype),acc['count'])]
+    if acc['period'] == None:
+        return []
+    return [closePeriod(acc)]
@@ -0,0 +1,364 @@
+# Benchmarks for the ACCESS Post Processor
+#
+# Times calculations from app_functions.py on synthetic data of model size, against
+# the implementations they replaced, and checks that the results agree.
+# landmask and tos_3hr use the land fractions of ANCILLARY_FILES, or synthetic ones if the
+# files can't be read. depth100 is checked against the result it is meant to have, as the
+# implementation it replaced returned d105 (see benchDepth100), and through normalVals of
+# app.py, as for the rows of master_map.csv with a calculation.
+# The cmor benchmark times setting up cmor for a variable with and without the session of
+# app_cmor.py, with the tables of CMIP_TABLES and the json file of EXP_TO_PROCESS in OUT_DIR
+# (set by setup_env.sh).
+#
+# usage: python app_benchmarks.py [benchmark ...]   (default: run all benchmarks)
+#
+import os
+import sys
+import time
+import tempfile
+import cmor
+import numpy as np
+from scipy.interpolate import interp1d
+from app_functions import *
+import app
+import app_cmor
+
+#run a function, returning the time taken (s) and its result
+def timed(function,*args,**kwargs):
+    start=time.time()
+    result=function(*args,**kwargs)
+    return time.time()-start,result
+
+#plevinterp as it was, with an interp1d for each column
+def plevinterpColumns(var,pmod,heavy,lat,lat_v):
+    plev,bounds=plev19()
+    t,z,x,y=np.shape(var)
+    th,zh,xh,yh=np.shape(heavy)
+    hout=np.ma.zeros([th,zh,len(lat_v),yh],dtype=np.float32)
+    for k in range(th):
+        for i in range(zh):
+            for j in range(yh):
+                hint=interp1d(lat,heavy[k,i,:,j],kind="linear",fill_value="extrapolate")
+                hout[k,i,:,j]=hint(lat_v)
+    hout=np.where(hout<=0.5,0,hout)
+    hout=np.where(hout>0.5,1,hout)
+    vout=np.ma.zeros([t,len(plev),x,y],dtype=np.float32)
+    for k in range(t):
+        for i in range(x):
+            for j in range(y):
+                vint=interp1d(pmod[k,:,i,j],var[k,:,i,j],kind="linear",fill_value="extrapolate")
+                vout[k,:,i,j]=vint(plev)
+    return vout/hout
+
+#ESM1.5 atmosphere (N96, 38 levels) for one time step
+def benchPlevinterp(nt=1,nz=38,ny=145,nx=192):
+    random=np.random.RandomState(0)
+    lat_v=np.linspace(-90,90,ny)
+    lat=np.linspace(-90,90,ny+1)
+    psurf=100000+3000*random.randn(nt,1,ny,nx)
+    #pressure decreasing with height on hybrid height levels
+    height=np.linspace(20,40000,nz).reshape(1,nz,1,1)
+    pmod=np.float32(psurf*np.exp(-height/7000.))
+    var=np.float32(4e-4+1e-5*np.log(pmod)+1e-6*random.randn(nt,nz,ny,nx))
+    plev,bounds=plev19()
+    heavy=np.float32(plev.reshape(1,-1,1,1) < 100000+3000*random.randn(nt,1,ny+1,nx))
+    told,old=timed(plevinterpColumns,var,pmod,heavy,lat,lat_v)
+    tnew,new=timed(plevinterp,var,pmod,heavy,lat,lat_v)
+    both=~(np.ma.getmaskarray(old) | np.ma.getmaskarray(new))
+    diff=np.abs(np.ma.filled(old,0)-np.ma.filled(new,0))[both].max()
+    same_mask=(np.ma.getmaskarray(old) == np.ma.getmaskarray(new)).all()
+    print 'plevinterp {}: columns {:.2f}s, vectorised {:.2f}s ({:.0f}x), max difference {:.3g}, same mask: {}'.format(
+        var.shape,told,tnew,told/tnew,diff,same_mask)
+    return diff < 1e-6*np.abs(old).max() and same_mask
+
+#tropoz as it was, with an np.interp for each column
+def tropozColumns(o3plev,o3mod,troppres,plev):
+    t,z,y,x=np.shape(o3plev)
+    vout=np.ma.zeros([t,y,x],dtype=np.float32)
+    for k in range(t):
+        for i in range(x):
+            for j in range(y):
+                vint=np.interp(troppres[k,j,i],plev[::-1],o3plev[k,::-1,j,i])
+                vout[k,j,i]=np.max(o3mod[k,0,j,i])-vint
+    return vout
+
+#CCMI daily ozone (N96, 39 pressure levels) for one time step
+def benchTropoz(nt=1,ny=145,nx=192):
+    random=np.random.RandomState(0)
+    plev,bounds=plev39()
+    #levels from the surface up
+    plev=plev[::-1]
+    o3plev=np.float32(1e-6*random.rand(nt,len(plev),ny,nx))
+    o3mod=np.float32(1e-5*random.rand(nt,1,ny,nx))
+    #tropopause pressures within and beyond the levels
+    troppres=np.float32(random.uniform(0,110000,(nt,ny,nx)))
+    told,old=timed(tropozColumns,o3plev,o3mod,troppres,plev)
+    tnew,new=timed(tropoz,o3plev,o3mod,troppres,plev)
+    diff=np.abs(old-new).max()
+    print 'tropoz {}: columns {:.2f}s, vectorised {:.3f}s ({:.0f}x), max difference {:.3g}'.format(
+        o3plev.shape,told,tnew,told/tnew,diff)
+    return diff < 1e-6*np.abs(old).max()
+
+#land fraction of a grid (145 or 144 latitudes), synthetic (ocean, land and coastal points)
+#if the ancillary file can't be read
+def benchLandFrac(ny,nx=192):
+    try: return landFrac(ny)
+    except Exception, e:
+        print 'using a synthetic land fraction for {} latitudes ({})'.format(ny,e)
+        fName=ancillary_path+('esm_landfrac.nc' if ny == 145 else 'cm2_landfrac.nc')
+        frac=np.float32(np.clip(np.random.RandomState(ny).uniform(-1,2,(ny,nx)),0,1))
+        return ancillaryStore((fName,'fld_s03i395'),frac)
+
+#whether two (masked) results have the same mask and values where they aren't masked
+def sameMasked(old,new):
+    mask=np.ma.getmaskarray(old)
+    same_mask=(mask == np.ma.getmaskarray(new)).all()
+    diff=np.abs(np.ma.getdata(old)-np.ma.getdata(new))[~mask]
+    diff=diff.max() if diff.size > 0 else 0.
+    return same_mask,diff
+
+#masked values on an atmosphere grid, with some points masked
+def maskedField(shape,random,scale=1.,offset=0.):
+    vals=np.float32(offset+scale*random.rand(*shape))
+    return np.ma.array(vals,mask=random.rand(*shape) < 0.05)
+
+#variable of an input file, with synthetic values (t,z,lat,lon)
+class SyntheticVariable(object):
+    def __init__(self,vals):
+        self.vals=vals
+        self.shape=vals.shape
+
+    def getOrder(self):
+        return 'tzyx'
+
+    def __getitem__(self,index):
+        return self.vals[index]
+
+#input file of synthetic variables (name -> values), in place of a cdms2 file
+class SyntheticFile(object):
+    def __init__(self,variables):
+        self.variables=dict((name,SyntheticVariable(vals)) for name, vals in variables.items())
+
+#landmask as it was, masking each time step
+def landmaskSteps(var):
+    t,y,x=np.shape(var)
+    vout=np.ma.zeros([t,y,x],dtype=np.float32)
+    if var.shape[1] == 145:
+        landfrac=landFrac(145)
+    elif var.shape[1] == 144:
+        landfrac=landFrac(144)
+    for i in range(t):
+        vout[i,:,:]=np.ma.masked_where(landfrac == 0,var[i,:,:])
+    return vout
+
+#tos_3hr as it was, masking each time step
+def tos3hrSteps(var):
+    var=tos_degC(var)
+    t,y,x=np.shape(var)
+    vout=np.ma.zeros([t,y,x],dtype=np.float32)
+    if var.shape[1] == 145:
+        landfrac=landFrac(145)
+    elif var.shape[1] == 144:
+        landfrac=landFrac(144)
+    for i in range(t):
+         vout[i,:,:]=np.ma.masked_where(landfrac == 1,var[i,:,:])
+    return vout
+
+#a day of 3 hourly values on the ESM1.5 (145) and CM2 (144) grids
+def benchLandFracMask(name,function,reference,offset):
+    random=np.random.RandomState(0)
+    ok=True
+    for ny in [145,144]:
+        benchLandFrac(ny)
+        var=maskedField((8,ny,192),random,10.,offset)
+        told,old=timed(reference,var)
+        tnew,new=timed(function,var)
+        same_mask,diff=sameMasked(old,new)
+        print '{} {}: time steps {:.3f}s, vectorised {:.3f}s, max difference {:.3g}, same mask: {}'.format(
+            name,var.shape,told,tnew,diff,same_mask)
+        ok=ok and same_mask and diff == 0 and new.dtype == np.float32
+    return ok
+
+def benchLandmask():
+    return benchLandFracMask('landmask',landmask,landmaskSteps,0.)
+
+#sea surface temperatures in K, converted to degC
+def benchTos3hr():
+    return benchLandFracMask('tos_3hr',tos_3hr,tos3hrSteps,273.15)
+
+#mc_gravity as it was, dividing each level by its gravity
+def mcGravityLevels(var):
+    t,z,y,x=np.shape(var)
+    if z == 85:
+        a_theta,b_theta,dim_val_bounds_theta,b_bounds_theta=getHybridLevels('theta',85)
+    elif z == 38:
+        a_theta,b_theta,dim_val_bounds_theta,b_bounds_theta=getHybridLevels('theta',38)
+    else: sys.exit('levels undefined in mc_gravity')
+    R_e=6.378E+06
+    grav_h=np.ma.zeros([len(a_theta)],dtype=np.float32)
+    for i in range(len(a_theta)):
+        grav_h[i]=9.8*(R_e/(R_e+a_theta[i]))**2
+    mc=np.ma.zeros([t,z,y,x],dtype=np.float32)
+    for k in range(z):
+        mc[:,k,:,:]=var[:,k,:,:]/grav_h[k]
+    return mc
+
+#mcu_gravity as it was, dividing each level by its gravity
+def mcuGravityLevels(var):
+    t,z,y,x=np.shape(var)
+    a_theta_85,b_theta_85,dim_val_bounds_theta_85,b_bounds_theta_85=getHybridLevels('theta',85)
+    R_e=6.378E+06
+    grav_h=np.ma.zeros([len(a_theta_85)],dtype=np.float32)
+    for i in range(len(a_theta_85)):
+        grav_h[i]=9.8*(R_e/(R_e+a_theta_85[i]))**2
+    mcu=np.ma.zeros([t,z,y,x],dtype=np.float32)
+    for k in range(z):
+        mcu[:,k,:,:]=var[:,k,:,:]/grav_h[k]
+    return mcu
+
+#convective mass fluxes for one time step, on the 38 (ESM1.5) and 85 (CM2) levels
+def benchGravity(name,function,reference,levels):
+    random=np.random.RandomState(0)
+    ok=True
+    for nz in levels:
+        var=maskedField((1,nz,145,192),random,0.1)
+        told,old=timed(reference,var)
+        tnew,new=timed(function,var)
+        same_mask,diff=sameMasked(old,new)
+        print '{} {}: levels {:.3f}s, vectorised {:.3f}s, max difference {:.3g}, same mask: {}'.format(
+            name,var.shape,told,tnew,diff,same_mask)
+        ok=ok and same_mask and diff <= 1e-6*np.abs(old).max() and new.dtype == np.float32
+    return ok
+
+def benchMcGravity():
+    return benchGravity('mc_gravity',mc_gravity,mcGravityLevels,[38,85])
+
+def benchMcuGravity():
+    return benchGravity('mcu_gravity',mcu_gravity,mcuGravityLevels,[85])
+
+#optical_depth as it was, with a copy of each component
+def opticalDepthCopies(lbplev,var):
+    idx=lbplev-1
+    var0=np.array(var[0][:,idx,:,:])
+    var1=np.array(var[1][:,idx,:,:])
+    var2=np.array(var[2][:,idx,:,:])
+    try: 
+        var3=np.array(var[3][:,idx,:,:])
+    except:
+        pass
+    try:
+        var4=np.array(var[4][:,idx,:,:])
+    except:
+        pass
+    try:
+        var5=np.array(var[5][:,idx,:,:])
+    except: 
+        pass
+    if len(var) == 6: 
+        print('6 variables')
+        vout=var0+var1+var2+var3+var4+var5
+    elif len(var) == 5: 
+        print('5 variables')
+        vout=var0+var1+var2+var3+var4
+    elif len(var) == 4: 
+        print('4 variables')
+        vout=var0+var1+var2+var3
+    else:
+        print('3 variables')
+        vout=var0+var1+var2
+    return vout
+
+#a month of daily aerosol optical depths (6 pseudo levels) of 3 to 6 components
+def benchOpticalDepth(nt=30):
+    random=np.random.RandomState(0)
+    ok=True
+    for ncomponents in [3,4,5,6]:
+        var=[maskedField((nt,6,145,192),random,0.01) for n in range(ncomponents)]
+        told,old=timed(opticalDepthCopies,3,var)
+        tnew,new=timed(optical_depth,3,var)
+        diff=np.abs(old-new).max()
+        print 'optical_depth {} x {}: copies {:.3f}s, vectorised {:.3f}s, max difference {:.3g}'.format(
+            ncomponents,var[0].shape,told,tnew,diff)
+        ok=ok and diff == 0 and type(new) == type(old) and new.dtype == old.dtype
+    return ok
+
+#depth100 is meant to be the mean of the depths of the 95 and 105 m levels, masked where
+#d105 is masked (below the sea floor). The implementation it replaced computed the mean but
+#returned d105, fully masked if any point of d105 was masked, so it is checked against the
+#mean at each point instead
+def benchDepth100(nt=12):
+    random=np.random.RandomState(0)
+    d95=maskedField((nt,145,192),random,10.,90.)
+    d105=np.ma.array(np.float32(d95+10),mask=np.ma.getmaskarray(d95) | (random.rand(nt,145,192) < 0.2))
+    new=depth100(d95,d105)
+    expected=np.ma.masked_all(d105.shape,dtype=np.float32)
+    for index in np.ndindex(*d105.shape):
+        if d105.mask[index]: continue
+        expected[index]=(d95[index]+d105[index])/2
+    same_mask,diff=sameMasked(expected,new)
+    print 'depth100 {}: mean where d105 is defined, max difference {:.3g}, masked where d105 is: {}'.format(
+        d105.shape,diff,same_mask)
+    ok=same_mask and diff <= 1e-6*np.abs(expected).max()
+    #the row of eparag100 (caco3 with a calculation): the output is missing where d105 is
+    #masked, and the mean of the calculated levels elsewhere
+    vals=np.ma.masked_all((nt,12,145,192),dtype=np.float32)
+    vals[:,9,:,:]=d95
+    vals[:,10,:,:]=d105
+    info={'opts':{'axes_modifier':'depth100','calculation':'var[0]*6/86400','vin':['caco3']},'in_missing':1e20}
+    out=app.normalVals(info,SyntheticFile({'caco3':vals}))
+    missing=np.asarray(out) == info['in_missing']
+    same_missing=(missing == d105.mask).all()
+    diff=np.abs(np.asarray(out)-np.ma.filled(expected*6/86400,info['in_missing'])).max()
+    print 'depth100 through normalVals with a calculation: max difference {:.3g}, missing where d105 is masked: {}'.format(
+        diff,same_missing)
+    return ok and same_missing and diff <= 1e-6*np.abs(expected*6/86400).max()
+
+#cmor set up for each variable, as it was
+def cmorRow(table_path,logfile,json_file_path,table):
+    cmor.setup(inpath=table_path,netcdf_file_action=cmor.CMOR_REPLACE_4,set_verbosity=cmor.CMOR_NORMAL,
+        exit_control=cmor.CMOR_NORMAL,logfile=logfile,create_subdirectories=1)
+    cmor.dataset_json(json_file_path)
+    return [cmor.load_table('{}/CMIP6_grids.json'.format(table_path)),cmor.load_table(table)]
+
+#cmor set up for each variable, reusing the session
+def cmorSessionRow(table_path,logfile,json_file_path,table):
+    app_cmor.cmorSession(table_path,logfile)
+    app_cmor.cmorDataset(json_file_path)
+    tables=[app_cmor.cmorTable('{}/CMIP6_grids.json'.format(table_path)),app_cmor.cmorTable(table)]
+    app_cmor.sessionVariable()
+    return tables
+
+#a worker setting up 40 Amon variables
+def benchCmorSession(nrows=40,table='CMIP6_Amon'):
+    table_path=os.environ.get('CMIP_TABLES')
+    json_file_path='{}/{}.json'.format(os.environ.get('OUT_DIR'),os.environ.get('EXP_TO_PROCESS'))
+    if table_path == None or not os.path.exists(json_file_path):
+        print 'cmor: skipped, set up the environment with setup_env.sh first'
+        return True
+    table='{}/{}.json'.format(table_path,table)
+    logfile='{}/cmor.log'.format(tempfile.mkdtemp())
+    told=0
+    for n in range(nrows):
+        told+=timed(cmorRow,table_path,logfile,json_file_path,table)[0]
+    tnew=0
+    for n in range(nrows):
+        tnew+=timed(cmorSessionRow,table_path,logfile,json_file_path,table)[0]
+    print 'cmor {} variables: set up per variable {:.3f}s, session {:.3f}s, saved {:.1f}ms per variable ({})'.format(
+        nrows,told,tnew,1000*(told-tnew)/nrows,app_cmor.sessionStats())
+    return True
+
+benchmarks={'plevinterp':benchPlevinterp,'tropoz':benchTropoz,'cmor':benchCmorSession,
+    'landmask':benchLandmask,'tos_3hr':benchTos3hr,'mc_gravity':benchMcGravity,
+    'mcu_gravity':benchMcuGravity,'optical_depth':benchOpticalDepth,'depth100':benchDepth100}
+
+def main(names):
+    if names == []: names=sorted(benchmarks.keys())
+    ok=True
+    for name in names:
+        ok=benchmarks[name]() and ok
+    if not ok:
+        print 'E: benchmark results differ from the reference'
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,266 @@
+# Calculation strings for the ACCESS Post Processor
+#
+# The 'calculation' of a variable in the master map (e.g. 'var[0]-var[1]',
+# 'tropoz(var[0]*1e-5,var[1]*1e-5,var[2],var[3])') is parsed and compiled once per
+# process, and the parse tree is used to find which inputs it needs:
+#   var[i]  - the input variables (in the order of access_vars) that are used, so the
+#             others are never read. If var is used other than with a constant index
+#             (e.g. 'optical_depth(2,var)'), all the inputs are needed
+#   times, depth, lat, lon - the coordinates of the first input variable that are used
+#   lazy    - the inputs that are only passed (possibly multiplied, divided etc. by constants)
+#             to functions that use a slice of their levels (slicing_functions), or are the
+#             result of the calculation. These are read lazily, so only the hyperslabs that
+#             are used are read from the file
+#
+# Calculations that only add, subtract, multiply, divide or raise to powers inputs and constants
+# (e.g. 'var[0]+var[1]+var[2]', 'var[0]*917+var[1]*330') are run by evaluateArithmetic rather
+# than eval: each input is read when it is needed and released once it has been added to the
+# result, and the operations are done in place, in blocks of calc_block_size values shared over
+# calc_threads threads (APP_CALC_THREADS). An N-term sum needs the memory of about 2 inputs,
+# rather than N+1. Masks are combined as numpy.ma does.
+#
+# checkCalculation reports the problems with a calculation (syntax errors, inputs that
+# don't exist, unknown functions) when the variable maps are made, rather than when the
+# calculation is run.
+#
+import ast
+import os
+import operator
+import __builtin__
+import numpy as np
+from multiprocessing.pool import ThreadPool
+
+#coordinates of the first input variable that calculations can use
+coordinate_names=('times','depth','lat','lon')
+#parsed calculations (by calculation string)
+compiled_calculations=dict()
+#number of values in each block of the arithmetic operations (sized to stay in the cache)
+calc_block_size=2**16
+#number of threads for the arithmetic operations of each worker
+try: calc_threads=max(1,int(os.environ.get('APP_CALC_THREADS')))
+except: calc_threads=1
+calc_pool=None
+#operations of arithmetic calculations
+arithmetic_ops={ast.Add:np.add,ast.Sub:np.subtract,ast.Mult:np.multiply,ast.Div:np.divide,ast.Pow:np.power}
+scalar_ops={ast.Add:operator.add,ast.Sub:operator.sub,ast.Mult:operator.mul,ast.Div:operator.div,ast.Pow:operator.pow}
+#functions that only read some levels of one of their arguments (the position of the argument)
+slicing_functions={'extract_lvl':0,'ocean_surface':0,'topsoil':0,'topsoil_tsl':0,'toz':0,'optical_depth':1}
+
+#indexes of var used in an expression, or None if all of var is needed
+def varIndexes(tree):
+    indexes=set()
+    subscripted=set()
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Subscript) and isinstance(node.value,ast.Name) and node.value.id == 'var':
+            index=node.slice
+            if isinstance(index,ast.Index) and isinstance(index.value,ast.Num) \
+                    and isinstance(index.value.n,int) and index.value.n >= 0:
+                indexes.add(index.value.n)
+                subscripted.add(node.value)
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Name) and node.id == 'var' and node not in subscripted:
+            return None
+    return sorted(indexes)
+
+#expression of constants only (e.g. 106*0.012, -1)
+def isConstant(node):
+    if isinstance(node,ast.Num):
+        return True
+    if isinstance(node,ast.UnaryOp):
+        return isConstant(node.operand)
+    if isinstance(node,ast.BinOp):
+        return isConstant(node.left) and isConstant(node.right)
+    return False
+
+#whether a use of var (var[i] or var) can be read lazily: it is only combined with constants
+#before being passed to a slicing function, or being the result of the calculation
+def isLazyUse(node,parents):
+    while True:
+        parent=parents.get(node)
+        if parent == None or isinstance(parent,ast.Expression):
+            return True
+        if isinstance(parent,ast.BinOp):
+            other=parent.right if parent.left is node else parent.left
+            if not isConstant(other): return False
+        elif isinstance(parent,ast.UnaryOp):
+            pass
+        elif isinstance(parent,ast.Call):
+            position=slicing_functions.get(getattr(parent.func,'id',None))
+            return position != None and position < len(parent.args) and parent.args[position] is node
+        else:
+            return False
+        node=parent
+
+#indexes of var that can be read lazily, or None if all the inputs can be (when var is only
+#passed as a whole to slicing functions)
+def lazyIndexes(tree):
+    parents=dict()
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child]=node
+    uses=dict()
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Name) and node.id == 'var':
+            parent=parents.get(node)
+            if isinstance(parent,ast.Subscript) and isinstance(parent.slice,ast.Index) \
+                    and isinstance(parent.slice.value,ast.Num):
+                key=parent.slice.value.n
+                node=parent
+            else:
+                key='all'
+            uses[key]=uses.get(key,True) and isLazyUse(node,parents)
+    if 'all' in uses:
+        if uses['all'] and all(uses.values()): return None
+        return set()
+    return set(key for key in uses if uses[key])
+
+#constant index of var (var[i]), or None
+def varIndex(node):
+    if isinstance(node,ast.Subscript) and isinstance(node.value,ast.Name) and node.value.id == 'var' \
+            and isinstance(node.slice,ast.Index) and isinstance(node.slice.value,ast.Num) \
+            and isinstance(node.slice.value.n,int) and node.slice.value.n >= 0:
+        return node.slice.value.n
+    return None
+
+#whether an expression only uses arithmetic operations on var[i] and constants
+def isArithmetic(node):
+    if isinstance(node,ast.Num) or varIndex(node) != None:
+        return True
+    if isinstance(node,ast.UnaryOp):
+        return isinstance(node.op,(ast.USub,ast.UAdd)) and isArithmetic(node.operand)
+    if isinstance(node,ast.BinOp):
+        return type(node.op) in arithmetic_ops and isArithmetic(node.left) and isArithmetic(node.right)
+    return False
+
+#compiled calculation and the inputs it uses
+#returns a dictionary: 'code' (compiled expression), 'vars' (sorted indexes of var, or None
+#for all), 'lazy' (indexes of var that can be read lazily, or None for all), 'coords'
+#(coordinate names), 'names' (other names, e.g. functions) and 'arithmetic' (the expression,
+#if it can be run by evaluateArithmetic, otherwise None)
+def parseCalculation(calculation):
+    if calculation not in compiled_calculations:
+        try:
+            tree=ast.parse(calculation.strip(),mode='eval')
+        except SyntaxError, e:
+            raise Exception('E: unable to parse calculation: {} ({})'.format(calculation,e))
+        names=set(node.id for node in ast.walk(tree) if isinstance(node,ast.Name))
+        compiled_calculations[calculation]={'code':compile(tree,'<calculation>','eval'),
+            'vars':varIndexes(tree),
+            'lazy':lazyIndexes(tree),
+            'coords':set(names) & set(coordinate_names),
+            'names':names-set(coordinate_names)-set(['var']),
+            'arithmetic':tree.body if isArithmetic(tree.body) and 'var' in names else None}
+    return compiled_calculations[calculation]
+
+#problems with a calculation for a variable with nvars inputs: a list of messages,
+#empty if there are none. Names that aren't builtins are checked against known_names if given
+def checkCalculation(calculation,nvars,known_names=None):
+    calculation=calculation.strip().strip('"')
+    if calculation == '':
+        return []
+    try:
+        ast.parse(calculation,mode='eval')
+    except SyntaxError, e:
+        return ['unable to parse calculation: {} ({})'.format(calculation,e)]
+    parsed=parseCalculation(calculation)
+    problems=[]
+    if parsed['vars'] != None and parsed['vars'] != [] and parsed['vars'][-1] >= nvars:
+        problems.append('calculation {} uses var[{}], but only {} input variables are given'.format(
+            calculation,parsed['vars'][-1],nvars))
+    if known_names != None:
+        unknown=[name for name in parsed['names'] if name not in known_names and not hasattr(__builtin__,name)]
+        if unknown != []:
+            problems.append('calculation {} uses undefined names: {}'.format(calculation,', '.join(sorted(unknown))))
+    return problems
+
+#run an elementwise function on blocks of the values (all arrays are flat, of the same size)
+def blockwise(function,size):
+    global calc_pool
+    blocks=[slice(i,min(i+calc_block_size,size)) for i in range(0,size,calc_block_size)]
+    if calc_threads == 1 or len(blocks) == 1:
+        for block in blocks: function(block)
+        return
+    if calc_pool == None:
+        calc_pool=ThreadPool(calc_threads)
+    calc_pool.map(function,blocks)
+
+#apply an operation to arrays of different shapes (broadcast, not in place)
+def broadcastOperation(op,a,b):
+    left,right=a[0],b[0]
+    with np.errstate(all='ignore'):
+        data=np.ascontiguousarray(arithmetic_ops[type(op)](left,right))
+        mask=np.zeros(data.shape,dtype=bool)
+        for operand in (a,b):
+            if operand[1] is not None: mask|=operand[1]
+        if isinstance(op,ast.Div):
+            mask|=np.abs(left)*np.finfo(float).tiny >= np.abs(right)
+        if isinstance(op,(ast.Div,ast.Pow)):
+            mask|=~np.isfinite(data)
+    if not mask.any() and a[1] is None and b[1] is None:
+        mask=None
+    return [data,mask]
+
+#apply the operation of a BinOp to two operands (a number, or [data,mask] of an array that can
+#be changed in place, mask None if nothing is masked). Returns the result (one of the operands)
+def applyOperation(op,a,b):
+    function=arithmetic_ops[type(op)]
+    if not isinstance(a,list) and not isinstance(b,list):
+        return scalar_ops[type(op)](a,b)
+    #the result is written to the array operand (the first, if both are arrays)
+    out=a if isinstance(a,list) else b
+    other=b if out is a else a
+    if isinstance(other,list) and other[0].shape != out[0].shape:
+        return broadcastOperation(op,a,b)
+    dtype=np.result_type(a[0] if isinstance(a,list) else a,b[0] if isinstance(b,list) else b)
+    if out[0].dtype != dtype:
+        out[0]=out[0].astype(dtype)
+    if isinstance(other,list) and other[1] is not None:
+        if out[1] is None: out[1]=other[1]
+        else: np.logical_or(out[1],other[1],out=out[1])
+    #division masks values divided by (near) 0, division and powers mask invalid results
+    domain=isinstance(op,(ast.Div,ast.Pow))
+    if domain and out[1] is None:
+        out[1]=np.zeros(out[0].shape,dtype=bool)
+    odata=out[0].reshape(-1)
+    omask=out[1].reshape(-1) if out[1] is not None else None
+    if isinstance(other,list): other=other[0].reshape(-1)
+    left_out=out is a
+    tiny=np.finfo(float).tiny
+    def operate(block):
+        x=odata[block]
+        y=other[block] if isinstance(other,np.ndarray) else other
+        left,right=(x,y) if left_out else (y,x)
+        if isinstance(op,ast.Div):
+            omask[block]|=np.abs(left)*tiny >= np.abs(right)
+        function(left,right,out=x)
+        if domain:
+            omask[block]|=~np.isfinite(x)
+    with np.errstate(all='ignore'):
+        blockwise(operate,odata.size)
+    return out
+
+#evaluate an arithmetic expression (see isArithmetic). inputs is a list of functions that read
+#the values of each input variable (a new array, that can be changed); each is read when it is
+#used and released after it has been added to the result
+def evaluateArithmetic(node,inputs):
+    masked=[False]
+    def evaluate(node):
+        if isinstance(node,ast.Num):
+            return node.n
+        index=varIndex(node)
+        if index != None:
+            vals=inputs[index]()
+            masked[0]=masked[0] or isinstance(vals,np.ma.MaskedArray)
+            mask=np.ma.getmask(vals)
+            return [np.ascontiguousarray(np.ma.getdata(vals)),None if mask is np.ma.nomask else np.ascontiguousarray(mask)]
+        if isinstance(node,ast.UnaryOp):
+            vals=evaluate(node.operand)
+            if isinstance(node.op,ast.USub):
+                if isinstance(vals,list): np.negative(vals[0],out=vals[0])
+                else: vals=-vals
+            return vals
+        return applyOperation(node.op,evaluate(node.left),evaluate(node.right))
+    data,mask=evaluate(node)
+    if masked[0] or mask is not None:
+        return np.ma.array(data,mask=np.ma.nomask if mask is None else mask,copy=False)
+    return data
@@ -0,0 +1,139 @@
+# Calendar functions for the ACCESS Post Processor
+#
+# Converts whole arrays of time values between reference units ("days since 0001-01-01",
+# "hours since 1850-01-01 00:00:00", ...), and works out the year/month/day of each value
+# and the bounds of months and years, with numpy rather than one cdtime/datetime
+# conversion per time step.
+#
+# Supported calendars: proleptic_gregorian (also gregorian and standard, as the
+# cdtime.GregorianCalendar used by the APP is proleptic) and noleap (365_day).
+#
+import re
+import numpy as np
+
+calendars={'proleptic_gregorian':'gregorian','gregorian':'gregorian','standard':'gregorian',
+    'noleap':'noleap','365_day':'noleap'}
+#length of each unit in days
+unit_days={'second':1/86400.,'seconds':1/86400.,'sec':1/86400.,'s':1/86400.,
+    'minute':1/1440.,'minutes':1/1440.,'min':1/1440.,
+    'hour':1/24.,'hours':1/24.,'hr':1/24.,'h':1/24.,
+    'day':1.,'days':1.,'d':1.}
+#days before the start of each month in a noleap year
+noleap_cumdays=np.array([0,31,59,90,120,151,181,212,243,273,304,334])
+noleap_mdays=np.array([31,28,31,30,31,30,31,31,30,31,30,31])
+
+def calendarType(calendar):
+    try:
+        return calendars[calendar.lower()]
+    except KeyError:
+        raise Exception('E: calendar not supported: {}'.format(calendar))
+
+#days since 1970-01-01 in the proleptic gregorian calendar (valid for any year, including <= 0)
+def civilToDays(y,m,d):
+    y=np.asarray(y,dtype=np.int64)-(np.asarray(m)<=2)
+    era=y//400
+    yoe=y-era*400
+    mp=(np.asarray(m,dtype=np.int64)+9)%12
+    doy=(153*mp+2)//5+np.asarray(d,dtype=np.int64)-1
+    doe=yoe*365+yoe//4-yoe//100+doy
+    return era*146097+doe-719468
+
+#inverse of civilToDays
+def daysToCivil(z):
+    z=np.asarray(z,dtype=np.int64)+719468
+    era=z//146097
+    doe=z-era*146097
+    yoe=(doe-doe//1460+doe//36524-doe//146096)//365
+    doy=doe-(365*yoe+yoe//4-yoe//100)
+    mp=(5*doy+2)//153
+    d=doy-(153*mp+2)//5+1
+    m=np.where(mp<10,mp+3,mp-9)
+    y=yoe+era*400+(m<=2)
+    return y,m,d
+
+#day number (days since 0001-01-01) of dates
+def dateToDayNumber(y,m,d,calendar='proleptic_gregorian'):
+    if calendarType(calendar) == 'noleap':
+        return (np.asarray(y,dtype=np.int64)-1)*365+noleap_cumdays[np.asarray(m)-1]+np.asarray(d,dtype=np.int64)-1
+    return civilToDays(y,m,d)-civilToDays(1,1,1)
+
+#dates of day numbers (days since 0001-01-01)
+def dayNumberToDate(days,calendar='proleptic_gregorian'):
+    days=np.asarray(days,dtype=np.int64)
+    if calendarType(calendar) == 'noleap':
+        y=days//365
+        doy=days-y*365
+        m=np.searchsorted(noleap_cumdays,doy,side='right')
+        d=doy-noleap_cumdays[m-1]+1
+        return y+1,m,d
+    return daysToCivil(days+civilToDays(1,1,1))
+
+#number of days in months
+def monthLength(y,m,calendar='proleptic_gregorian'):
+    y=np.asarray(y)
+    m=np.asarray(m)
+    if calendarType(calendar) == 'noleap':
+        return noleap_mdays[m-1]+0*y
+    leap=((y%4 == 0) & (y%100 != 0)) | (y%400 == 0)
+    return noleap_mdays[m-1]+((m == 2) & leap)
+
+#length of the units (in days) and the day number of the reference time in a units string
+def parseUnits(units,calendar='proleptic_gregorian'):
+    match=re.match('\s*(\w+)\s+since\s+(-?\d+)-(\d+)-(\d+)(?:[ T]+(\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?',units)
+    if match == None:
+        raise Exception('E: unable to read time units: {}'.format(units))
+    try:
+        scale=unit_days[match.group(1).lower()]
+    except KeyError:
+        raise Exception('E: unknown time units: {}'.format(units))
+    y,m,d=[int(match.group(i)) for i in (2,3,4)]
+    ref=float(dateToDayNumber(y,m,d,calendar))
+    if match.group(5) != None:
+        ref+=int(match.group(5))/24.+int(match.group(6))/1440.
+        if match.group(7) != None: ref+=float(match.group(7))/86400.
+    return scale,ref
+
+#day numbers (days since 0001-01-01, with fraction of the day) of time values
+def toDayNumber(tvals,units,calendar='proleptic_gregorian'):
+    scale,ref=parseUnits(units,calendar)
+    return ref+np.asarray(tvals,dtype=np.float64)*scale
+
+#time values in the given units of day numbers
+def fromDayNumber(days,units,calendar='proleptic_gregorian'):
+    scale,ref=parseUnits(units,calendar)
+    return (np.asarray(days,dtype=np.float64)-ref)/scale
+
+#convert time values from one set of units to another
+def convertTimes(tvals,from_units,to_units,calendar='proleptic_gregorian'):
+    return fromDayNumber(toDayNumber(tvals,from_units,calendar),to_units,calendar)
+
+#year, month, day and fraction of the day of time values
+def timeComponents(tvals,units,calendar='proleptic_gregorian'):
+    days=toDayNumber(tvals,units,calendar)
+    #round to the nearest millisecond so that times at midnight aren't put in the previous day
+    days=np.round(days*86400000.)/86400000.
+    whole=np.floor(days)
+    y,m,d=dayNumberToDate(whole,calendar)
+    return y,m,d,days-whole
+
+#time values of the start of the given months (and days, hours)
+def dateToTimes(y,m,d,units,calendar='proleptic_gregorian',hours=0):
+    days=dateToDayNumber(y,m,d,calendar)+np.asarray(hours,dtype=np.float64)/24.
+    return fromDayNumber(days,units,calendar)
+
+#start of the month and start of the next month of time values
+def monthBounds(tvals,units,calendar='proleptic_gregorian'):
+    y,m,d,frac=timeComponents(tvals,units,calendar)
+    tmin=dateToTimes(y,m,1,units,calendar)
+    tmax=dateToTimes(y+m//12,m%12+1,1,units,calendar)
+    return tmin,tmax
+
+#start of the year and start of the next year of time values
+def yearBounds(tvals,units,calendar='proleptic_gregorian'):
+    y,m,d,frac=timeComponents(tvals,units,calendar)
+    return dateToTimes(y,1,1,units,calendar),dateToTimes(y+1,1,1,units,calendar)
+
+#index of the first value of each run of equal values in an array
+def runStarts(vals):
+    vals=np.asarray(vals)
+    return np.concatenate(([0],np.nonzero(vals[1:] != vals[:-1])[0]+1))
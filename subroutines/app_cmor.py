@@ -0,0 +1,72 @@
+# CMOR session of a worker for the ACCESS Post Processor
+#
+# cmor.setup, cmor.dataset_json and cmor.load_table were run for each variable, so a worker
+# processing 40 Amon variables parsed the (multi-megabyte) Amon table 40 times. The session
+# is now set up once and kept for the variables processed after it by the same worker:
+#   cmorSession - runs cmor.setup when the worker starts, when the table path or log file
+#                 changes, after session_vars variables (APP_CMOR_SESSION_VARS), as CMOR
+#                 keeps the axes, grids and variables of a session until it is set up again
+#                 and limits how many there can be, or after a variable failed
+#   cmorTable   - loads a table once per session, for each json file (the dataset is
+#                 defined again with cmor.dataset_json only when the json file changes)
+# The attributes set for each variable (notes etc.) are still set by app_setup, and each
+# variable is closed by app_close, so only the per-variable state changes between variables.
+#
+import os
+import cmor
+
+#variables set up in a session before it is set up again
+try: session_vars=max(1,int(os.environ.get('APP_CMOR_SESSION_VARS')))
+except: session_vars=50
+#tables loaded in a session before it is set up again (CMOR can't load more than 30)
+max_tables=25
+#state of the session: setup arguments, current json file, loaded tables ((json_file_path,
+#table path) -> table id), number of variables set up, and whether it must be set up again
+session={'setup':None,'json_file_path':None,'tables':dict(),'variables':0,'reset':True}
+#statistics of the session: setups, datasets defined, tables loaded and reused
+session_stats={'setups':0,'datasets':0,'loaded':0,'reused':0}
+
+#set up cmor, unless the session with the same arguments can be used
+def cmorSession(table_path,logfile):
+    if session['reset'] or session['setup'] != (table_path,logfile) \
+            or session['variables'] >= session_vars or len(session['tables']) >= max_tables:
+        cmor.setup(inpath=table_path,
+            netcdf_file_action=cmor.CMOR_REPLACE_4,
+            set_verbosity=cmor.CMOR_NORMAL,
+            exit_control=cmor.CMOR_NORMAL,
+            #exit_control=cmor.CMOR_EXIT_ON_MAJOR,
+            logfile=logfile,create_subdirectories=1)
+        session.update({'setup':(table_path,logfile),'json_file_path':None,'tables':dict(),
+            'variables':0,'reset':False})
+        session_stats['setups']+=1
+
+#define the dataset, if it isn't the current one
+def cmorDataset(json_file_path):
+    if session['json_file_path'] != json_file_path:
+        cmor.dataset_json(json_file_path)
+        session['json_file_path']=json_file_path
+        session_stats['datasets']+=1
+
+#load a table (path of the json file of the table), or return it if it is already loaded
+#for the current dataset
+def cmorTable(table):
+    key=(session['json_file_path'],table)
+    if key in session['tables']:
+        session_stats['reused']+=1
+        cmor.set_table(session['tables'][key])
+    else:
+        session['tables'][key]=cmor.load_table(table)
+        session_stats['loaded']+=1
+    return session['tables'][key]
+
+#count a variable set up in the session
+def sessionVariable():
+    session['variables']+=1
+
+#set up cmor again before the next variable (e.g. after a variable failed, leaving its
+#axes and variable defined)
+def resetSession():
+    session['reset']=True
+
+def sessionStats():
+    return 'cmor setups: {setups}, datasets: {datasets}, tables loaded: {loaded}, reused: {reused}'.format(**session_stats)
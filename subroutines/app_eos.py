@@ -0,0 +1,127 @@
+# Seawater equation of state for the ACCESS Post Processor
+#
+# Density from potential temperature, salinity and pressure, the pressure field of
+# an ocean grid, and the global thermosteric/steric sea level change (zostoga, zossga).
+#
+# The pressure and reference density (4 degC, 35 psu) of a grid are worked out once and
+# kept for later calls. Sea level is summed over all the time steps at once, in blocks
+# of grid cells, so the temporary arrays stay within eos_block_size values.
+#
+import hashlib
+import numpy as np
+
+#number of values (time steps x grid cells) in each block of the sea level calculation
+eos_block_size=2**22
+#pressure and reference density of each grid (by a hash of the depth and latitude values)
+reference_states=dict()
+
+#function to calculate density from temp, salinity and pressure
+def rho_from_theta(th,s,p):
+    th2 = th*th
+    if np.ma.isMaskedArray(s):
+        sqrts = np.ma.sqrt(s)
+    else:
+        sqrts = np.sqrt(s)
+    anum =          9.9984085444849347e+02 +    \
+               th*( 7.3471625860981584e+00 +    \
+               th*(-5.3211231792841769e-02 +    \
+               th*  3.6492439109814549e-04)) +  \
+                s*( 2.5880571023991390e+00 -    \
+               th*  6.7168282786692355e-03 +    \
+                s*  1.9203202055760151e-03)
+    aden =          1.0000000000000000e+00 +    \
+               th*( 7.2815210113327091e-03 +    \
+               th*(-4.4787265461983921e-05 +    \
+               th*( 3.3851002965802430e-07 +    \
+               th*  1.3651202389758572e-10))) + \
+                s*( 1.7632126669040377e-03 -    \
+               th*( 8.8066583251206474e-06 +    \
+              th2*  1.8832689434804897e-10) +   \
+            sqrts*( 5.7463776745432097e-06 +    \
+              th2*  1.4716275472242334e-09))
+    pmask=(p!=0.0)
+    pth = p*th
+    anum = anum +   pmask*(     p*( 1.1798263740430364e-02 +   \
+                       th2*  9.8920219266399117e-08 +   \
+                         s*  4.6996642771754730e-06 -   \
+                         p*( 2.5862187075154352e-08 +   \
+                       th2*  3.2921414007960662e-12)) )
+    aden = aden +   pmask*(     p*( 6.7103246285651894e-06 -   \
+                  pth*(th2*  2.4461698007024582e-17 +   \
+                         p*  9.1534417604289062e-18)) )
+#    print 'rho',np.min(anum/aden),np.max(anum/aden)
+    return anum/aden
+
+#deprecated funtion, do not use. Use rho_from_theta instead
+def rf_eos(S,T,P):
+    t1 = [ 9.99843699e+2, 7.35212840e+0, -5.45928211e-2, 3.98476704e-4 ]
+    s1 = [ 2.96938239e+0, -7.23268813e-3, 2.12382341e-3 ]
+    p1 = [ 1.04004591e-2, 1.03970529e-7, 5.18761880e-6, -3.24041825e-8, -1.23869360e-11 ]
+
+    t2 = [ 1.0, 7.28606739e-3, -4.60835542e-5, 3.68390573e-7, 1.80809186e-10 ]
+    s2 = [ 2.14691708e-3, -9.27062484e-6, -1.78343643e-10, 4.76534122e-6, 1.63410736e-9 ]
+    p2 = [ 5.30848875e-6, -3.03175128e-16, -1.27934137e-17 ]
+
+    Pn = t1[0] + t1[1]*T + t1[2]*T**2 + t1[3]*T**3 + s1[0]*S + s1[1]*S*T + s1[2]*S**2 \
+      + p1[0]*P + p1[1]*P*T**2 + p1[2]*P*S + p1[3]*P**2 + p1[4]*P**2*T**2
+
+    Pd = t2[0] + t2[1]*T + t2[2]*T**2 + t2[3]*T**3 + t2[4]*T**4 \
+      + s2[0]*S + s2[1]*S*T + s2[2]*S*T**3 + s2[3]*np.sqrt(S**3) + s2[4]*np.sqrt(S**3)*T**2 \
+      + p2[0]*P + p2[1]*P**2*T**3 + p2[2]*P**3*T
+    return Pn/Pd
+
+#Calculates the pressure field from depth and latitude
+def sw_press(dpth,lat):
+#return array on depth,lat,lon
+    pi = 4*np.arctan(1.)
+    deg2rad = pi/180
+    x = np.sin(abs(np.asarray(lat[:]))*deg2rad)  # convert to radians
+    c1 = (5.92e-3+x**2*5.25e-3)[np.newaxis]
+    #depth on the first axis, broadcast over lat and lon
+    dpth=np.asarray(dpth[:]).reshape((-1,)+(1,)*x.ndim)
+    return ((1-c1)-np.sqrt(((1-c1)**2)-(8.84e-6*dpth)))/4.42e-6
+
+#pressure and density at 4 degC, 35 psu (depth,lat,lon) of a grid, worked out once per grid
+def referenceState(depth,lat):
+    key=hashlib.md5(np.ascontiguousarray(depth[:],dtype=np.float64).tostring()+
+        np.ascontiguousarray(lat[:],dtype=np.float64).tostring()).hexdigest()
+    if key not in reference_states:
+        press=sw_press(depth,lat)
+        rho0=rho_from_theta(4.00,35.00,press)
+        reference_states[key]=(np.float32(press),rho0.astype(np.float32))
+    return reference_states[key]
+
+#global mean steric sea level change (m) for each time step, from the change in density
+#relative to 4 degC, 35 psu, of each grid cell
+#T (and S if not a constant) and dz are (t,depth,lat,lon), area is (lat,lon)
+#grid cells are included where T, S and dz are not masked, and the surface of T at the first time isn't masked
+def stericSeaLevel(T,S,dz,area,depth,lat):
+    nt=T.shape[0]
+    press,rho0=referenceState(depth,lat)
+    press=press.reshape(-1)
+    rho0=rho0.reshape(-1)
+    ncells=len(press)
+    #surface cells of the ocean, at the first time step
+    surface=~np.ma.getmaskarray(T[0,0])
+    area=np.where(surface,np.ma.filled(area,0),0).astype(np.float64)
+    cell_area=np.broadcast_to(area,T.shape[1:]).reshape(-1)
+    #grid cells masked at the first time step
+    first=np.ma.getmaskarray(T[0]).reshape(-1)
+    T=T.reshape((nt,ncells))
+    dz=dz.reshape((nt,ncells))
+    if np.ndim(S) > 0:
+        S=S.reshape((nt,ncells))
+    total=np.zeros(nt)
+    block=max(1,eos_block_size//nt)
+    for start in range(0,ncells,block):
+        cells=slice(start,min(start+block,ncells))
+        th=np.float64(np.ma.getdata(T[:,cells]))
+        mask=np.ma.getmaskarray(T[:,cells]) | np.ma.getmaskarray(dz[:,cells]) | first[cells]
+        if np.ndim(S) > 0:
+            s=np.float64(np.ma.getdata(S[:,cells]))
+            mask|=np.ma.getmaskarray(S[:,cells])
+        else:
+            s=S
+        change=(1.-rho_from_theta(th,s,press[cells])/rho0[cells])*np.ma.getdata(dz[:,cells])
+        total+=np.where(mask,0,change*cell_area[cells]).sum(1)
+    return np.float32(total/area.sum())
@@ -0,0 +1,83 @@
+# Pool of open files for the ACCESS Post Processor
+#
+# Input and ancillary files are opened through openFile, which keeps each file open (by path,
+# and the library used to open it: cdms2 or netCDF4) so that the variable search, axis
+# discovery and the reads of each variable, and the variables processed after it by the same
+# worker, use one open file rather than opening it again.
+#
+# A file opened with openFile is in use until it is released with releaseFile (the handle must
+# not be closed by the caller). Files that aren't in use are closed, least recently used first,
+# when there are more than max_open_files (APP_MAX_OPEN_FILES) open, or when closeFile /
+# closeFiles is called. Files in use are never closed, so the pool can grow beyond the maximum
+# while they are.
+#
+import os
+import threading
+import cdms2
+import netCDF4
+from collections import OrderedDict
+
+#maximum number of files kept open by each worker
+try: max_open_files=max(1,int(os.environ.get('APP_MAX_OPEN_FILES')))
+except: max_open_files=16
+#open files, least recently used first: (library,path) -> [handle,number of users]
+open_files=OrderedDict()
+#statistics of the pool: files opened, uses of files already open, files closed
+file_stats={'opened':0,'reused':0,'closed':0}
+files_lock=threading.RLock()
+
+def openHandle(path,library):
+    if library == 'cdms2':
+        return cdms2.open(path,'r')
+    if library == 'netCDF4':
+        return netCDF4.Dataset(path,'r')
+    raise Exception('E: unknown library for opening files: {}'.format(library))
+
+#close files that aren't in use, least recently used first, until there are at most nkeep open
+def evictFiles(nkeep):
+    with files_lock:
+        for key in list(open_files.keys()):
+            if len(open_files) <= nkeep: break
+            if open_files[key][1] == 0:
+                open_files.pop(key)[0].close()
+                file_stats['closed']+=1
+
+#open file (read only) with the library 'cdms2' or 'netCDF4', reusing it if it is already open
+def openFile(path,library='cdms2'):
+    key=(library,os.path.abspath(path))
+    with files_lock:
+        if key in open_files:
+            entry=open_files.pop(key)
+            file_stats['reused']+=1
+        else:
+            entry=[openHandle(path,library),0]
+            file_stats['opened']+=1
+        entry[1]+=1
+        open_files[key]=entry
+        evictFiles(max_open_files)
+        return entry[0]
+
+#finished using a file opened with openFile (it is kept open for reuse)
+def releaseFile(handle):
+    with files_lock:
+        for key, entry in open_files.items():
+            if entry[0] is handle:
+                entry[1]=max(0,entry[1]-1)
+                break
+        evictFiles(max_open_files)
+
+#close a file now (if it isn't in use)
+def closeFile(path,library=None):
+    with files_lock:
+        for key in list(open_files.keys()):
+            if key[1] == os.path.abspath(path) and (library == None or key[0] == library) \
+                    and open_files[key][1] == 0:
+                open_files.pop(key)[0].close()
+                file_stats['closed']+=1
+
+#close all the files that aren't in use
+def closeFiles():
+    evictFiles(0)
+
+def fileStats():
+    return 'files opened: {opened}, reused: {reused}, closed: {closed}'.format(**file_stats)
@@ -5,19 +5,106 @@ import os,sys
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import calendar
 import cdms2
 import warnings
 import cdtime
 import math
+import hashlib
+import json
+import threading
 cdtime.DefaultCalendar=cdtime.GregorianCalendar
-from operator import and_
 from scipy.interpolate import interp1d 
+import scipy.sparse
+from app_files import openFile,releaseFile
+from app_calculations import parseCalculation,evaluateArithmetic
+from app_eos import rho_from_theta,rf_eos,sw_press,stericSeaLevel
+from app_calendar import calendarType,timeComponents,monthLength,dateToTimes,runStarts
 warnings.simplefilter(action='ignore', category=FutureWarning)
 np.set_printoptions(threshold=sys.maxsize)
 
 ancillary_path=os.environ.get('ANCILLARY_FILES')+'/'
 
+#ancillary fields are read from the files in ancillary_path once per process,
+#and kept here for all later calls (and variables)
+ancillary_cache=dict()
+ancillary_stats={'hits':0,'misses':0,'npy':0}
+
+#digest of the code that works out the ancillary fields (this module), recorded in the
+#manifest of the .npy store, as some fields are calculated from the ancillary files
+def ancillaryCodeDigest():
+    with open(os.path.splitext(__file__)[0]+'.py') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+#directory of precomputed ancillary fields in .npy files (built by ancillary_store.py),
+#these are memory-mapped so that all processes on a node share one copy. A store built by
+#other code (or without a digest) isn't used, and the fields are read from the files
+ancillary_npy_version=1
+try:
+    ancillary_npy_dir='{}/v{}'.format(os.environ.get('ANCILLARY_NPY_DIR'),ancillary_npy_version)
+    with open(ancillary_npy_dir+'/manifest.json') as f:
+        if json.load(f).get('code') != ancillaryCodeDigest():
+            print 'ancillary store {} was built by other code, run ancillary_store.py'.format(ancillary_npy_dir)
+            ancillary_npy_dir=None
+except: ancillary_npy_dir=None
+
+#return an ancillary field from the cache (or the .npy store), or None if it hasn't been loaded yet
+def ancillaryLookup(key):
+    try:
+        vals=ancillary_cache[key]
+    except KeyError:
+        vals=loadAncillaryNpy(key)
+        if vals is None:
+            ancillary_stats['misses']+=1
+            return None
+        ancillary_stats['npy']+=1
+        ancillary_cache[key]=vals
+        return vals
+    ancillary_stats['hits']+=1
+    return vals
+
+#store an ancillary field in the cache and return it
+#the values are made read-only, as they are shared by every caller (copy them to modify them)
+def ancillaryStore(key,vals):
+    vals.flags.writeable=False
+    if np.ma.isMaskedArray(vals) and vals.mask is not np.ma.nomask:
+        vals.mask.flags.writeable=False
+    ancillary_cache[key]=vals
+    return vals
+
+#summary of the ancillary cache use
+def ancillaryStats():
+    return 'ancillary cache: {} fields, {} hits, {} misses, {} loaded from .npy store'.format(
+        len(ancillary_cache),ancillary_stats['hits'],ancillary_stats['misses'],ancillary_stats['npy'])
+
+#name of the .npy file(s) holding an ancillary field
+def ancillaryNpyName(key):
+    return '.'.join([os.path.basename(str(k)) for k in key])
+
+#memory-map an ancillary field from the .npy store, or return None if it isn't there
+#(masks of masked arrays are kept in a separate .mask.npy file)
+def loadAncillaryNpy(key):
+    if ancillary_npy_dir == None:
+        return None
+    fname='{}/{}.npy'.format(ancillary_npy_dir,ancillaryNpyName(key))
+    if not os.path.exists(fname):
+        return None
+    vals=np.load(fname,mmap_mode='r')
+    mask_fname='{}/{}.mask.npy'.format(ancillary_npy_dir,ancillaryNpyName(key))
+    if os.path.exists(mask_fname):
+        vals=np.ma.MaskedArray(vals,mask=np.load(mask_fname,mmap_mode='r'),copy=False)
+    return vals
+
+#write all ancillary fields in the cache to .npy files in a directory
+def saveAncillaryNpy(directory):
+    names=[]
+    for key, vals in ancillary_cache.items():
+        name=ancillaryNpyName(key)
+        np.save('{}/{}.npy'.format(directory,name),np.ascontiguousarray(np.ma.getdata(vals)))
+        if np.ma.isMaskedArray(vals) and vals.mask is not np.ma.nomask:
+            np.save('{}/{}.mask.npy'.format(directory,name),np.ascontiguousarray(vals.mask))
+        names.append(name)
+    return sorted(names)
+
 #function to give a sample plot of a variable
 def plotVar(outpath,ret,cmip_table,vcmip,parent_source_id,experiment_id):
     f=cdms2.open(ret,'r')
@@ -91,31 +178,155 @@ def calcRefDate(time):
     ref= re.search('\d{4}-\d{2}-\d{2}', time.units).group(0).split('-')
     return datetime.date(int(ref[0]), int(ref[1]), int(ref[2]))
 
+#lock held while the netCDF library is used (reading input files, writing with CMOR), as it
+#isn't thread safe. Only needed when files are read and written in other threads (see app.py)
+netcdf_lock=threading.RLock()
+
+#key of the values of a variable (time slab, index) in a cache of values read from a file
+def cacheKey(access_file,v,tslice=None,index=None):
+    if tslice == None or not access_file.variables[v].getOrder().startswith('t'):
+        tslice=slice(None)
+    return (v,tslice.start,tslice.stop,repr(index))
+
+#read the values of a variable from an open ACCESS file
+#if tslice is given, only that slab of the time axis is read (for variables with time as the first axis)
+#if index is given (a tuple of indexes of the axes, e.g. (slice(None),0,slice(None),slice(None))), only
+#that hyperslab (of the time slab) is read
+#if a cache is given, values already read from the file are reused (a copy is returned,
+#so that calculations can't modify the values used by other variables). If the cache has
+#'handover' set, the values were read for one calculation, and are removed from the cache
+#rather than copied
+def readVariable(access_file,v,cache=None,tslice=None,index=None):
+    if tslice == None or not access_file.variables[v].getOrder().startswith('t'):
+        tslice=slice(None)
+    if cache != None:
+        key=cacheKey(access_file,v,tslice,index)
+        if key not in cache:
+            cache[key]=readVariable(access_file,v,tslice=tslice,index=index)
+        if cache.get('handover'):
+            return cache.pop(key)
+        return cache[key].copy()
+    with netcdf_lock:
+        if index == None:
+            return access_file.variables[v][tslice]
+        if len(index) > len(access_file.variables[v].shape) or \
+                not all([isinstance(i,(int,long,slice)) for i in index]):
+            return access_file.variables[v][tslice][index]
+        #read the hyperslab of the other axes from the time slab, then take the times from it
+        vals=access_file.variables[v][(tslice,)+index[1:]]
+    if index[0] != slice(None):
+        vals=vals[index[0]]
+    return vals
+
+#
+#Lazy variables: an input variable of a calculation that is only read when it is indexed,
+#so calculations that use a few levels (e.g. extract_lvl, ocean_surface) only read those levels.
+#Operations with constants (var*1e-5, -var) are kept and applied to the values read.
+#Any other operation reads all the values.
+#
+class LazyVariable(object):
+    def __init__(self,access_file,v,cache=None,tslice=None,ops=()):
+        self.access_file,self.v,self.cache,self.tslice,self.ops=access_file,v,cache,tslice,ops
+        shape=list(access_file.variables[v].shape)
+        if tslice != None and access_file.variables[v].getOrder().startswith('t'):
+            shape[0]=len(range(*tslice.indices(shape[0])))
+        self.shape=tuple(shape)
+        self.ndim=len(shape)
+
+    def __getitem__(self,index):
+        if not isinstance(index,tuple): index=(index,)
+        vals=readVariable(self.access_file,self.v,self.cache,self.tslice,index)
+        for op in self.ops:
+            vals=op(vals)
+        return vals
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self,dtype=None):
+        return np.asarray(self[:],dtype=dtype)
+
+    #lazy for constants, otherwise the operation is on all the values
+    def operation(self,other,op):
+        if np.isscalar(other):
+            return LazyVariable(self.access_file,self.v,self.cache,self.tslice,self.ops+(lambda vals: op(vals,other),))
+        return op(self[:],other)
+
+    def __add__(self,other): return self.operation(other,lambda a,b: a+b)
+    def __radd__(self,other): return self.operation(other,lambda a,b: b+a)
+    def __sub__(self,other): return self.operation(other,lambda a,b: a-b)
+    def __rsub__(self,other): return self.operation(other,lambda a,b: b-a)
+    def __mul__(self,other): return self.operation(other,lambda a,b: a*b)
+    def __rmul__(self,other): return self.operation(other,lambda a,b: b*a)
+    def __div__(self,other): return self.operation(other,lambda a,b: a/b)
+    def __rdiv__(self,other): return self.operation(other,lambda a,b: b/a)
+    def __truediv__(self,other): return self.operation(other,lambda a,b: np.true_divide(a,b))
+    def __rtruediv__(self,other): return self.operation(other,lambda a,b: np.true_divide(b,a))
+    def __pow__(self,other): return self.operation(other,lambda a,b: a**b)
+    def __neg__(self): return LazyVariable(self.access_file,self.v,self.cache,self.tslice,self.ops+(lambda vals: -vals,))
+    def __pos__(self): return self
+
+#function that reads the values of an input variable (or axis) of a calculation
+def inputReader(access_file,v,cache=None,tslice=None):
+    if v in access_file.variables:
+        return lambda: readVariable(access_file,v,cache,tslice)
+    return lambda: np.array(access_file.axes[v][:])
+
+#names (functions, modules) that calculations can use
+def calculationNames():
+    return globals()
+
 #function to call the calculation defined in the 'calculation' string in the database
-def calculateVals(access_file,varNames,calculation):
+#the calculation is compiled once, and only the input variables and coordinates it uses are read
+#(the input variables that aren't used are None). Inputs that are only sliced by the calculation
+#are read lazily. If lazy is True, a result that is still lazy is returned as a LazyVariable
+#arithmetic calculations (e.g. sums of the inputs) are run by evaluateArithmetic, reading each
+#input as it is needed
+def calculateVals(access_file,varNames,calculation,cache=None,tslice=None,lazy=False):
+    parsed=parseCalculation(calculation)
+    if parsed['arithmetic'] != None and not lazy:
+        inputs=[]
+        for i,v in enumerate(varNames):
+            print 'variable[{}] = {}'.format(i,v)
+            inputs.append(inputReader(access_file[0],v,cache,tslice))
+        try:
+            return evaluateArithmetic(parsed['arithmetic'],inputs)
+        except Exception, e:
+            print 'error evaluating calculation: {}'.format(calculation)
+            raise
     #Set array for coordinates if used by calculation
-    if calculation.find('times')!=-1:
+    if 'times' in parsed['coords']:
         times=access_file[0].variables[varNames[0]].getTime()
-    if calculation.find('depth')!=-1:
+    if 'depth' in parsed['coords']:
         depth=access_file[0].variables[varNames[0]].getAxis(1)
-    if calculation.find('lat')!=-1:
+    if 'lat' in parsed['coords']:
         lat=access_file[0].variables[varNames[0]].getLatitude()
-    if calculation.find('lon')!=-1:
-        lon=access_file[0].variables[varNames[0]].getLatitude()
+    if 'lon' in parsed['coords']:
+        lon=access_file[0].variables[varNames[0]].getLongitude()
     var=[]
-    for v in varNames:
-        print 'variable[{}] = {}'.format(varNames.index(v),v)
+    for i,v in enumerate(varNames):
+        if parsed['vars'] != None and i not in parsed['vars']:
+            print 'variable[{}] = {} (not used)'.format(i,v)
+            var.append(None)
+            continue
+        print 'variable[{}] = {}'.format(i,v)
+        if v in access_file[0].variables and (parsed['lazy'] == None or i in parsed['lazy']):
+            var.append(LazyVariable(access_file[0],v,cache,tslice))
+            continue
         try: 
             #extract variable out of file
-            var.append(access_file[0].variables[v][:])
+            var.append(readVariable(access_file[0],v,cache,tslice))
         except: 
             #try to find variable in axes
             var.append(access_file[0].axes[v][:])
     try:
-        return eval(calculation)
+        vals=eval(parsed['code'])
     except Exception, e:
         print 'error evaluating calculation: {}'.format(calculation)
         raise
+    if isinstance(vals,LazyVariable) and not lazy:
+        vals=vals[:]
+    return vals
 
 #Calculate the y_overturning mass streamfunction
 #For three basins: 
@@ -123,49 +334,46 @@ def calculateVals(access_file,varNames,calculation):
 #1 Indian-Pacific basin
 #2 Global Basin
 def meridionalOverturning(transList,typ,om2=1):
-#TODO remove masks once satified with these calculations
     ty_trans=transList[0]
-    #print type(ty_trans), np.shape(ty_trans) ,np.shape(ty_trans.mask)
     #initialise array
     dims=list(np.shape(ty_trans[:,:,:,0])) +[3] #remove x, add dim for 3 basins
     transports= np.ma.zeros(dims,dtype=np.float32)
     #first calculate for global basin
     #2: global basin
     transports[:,:,:,2]=calcOverturning(transList,typ)
-    try:
-        if ty_trans.mask==False: 
-        #if there is no mask: set masks to arrays of zeros
-            for trans in transList:
-                trans.mask=np.zeros(np.shape(trans),dtype=bool)
-    except: pass
     #grab land mask out of ty_trans file (assuming the only masked values are land)
-    landMask=np.array(ty_trans.mask[0,:,:,:],dtype=bool)
-    #Get basin masks
-    if om2 == 025:
-        mask=getBasinMask_025()
-    else:
-        mask=getBasinMask()
-    #0: atlantic arctic basin
-    #set masks
-    #atlantic and arctic basin are given by mask values 2 and 4 #TODO double check this
-    atlantic_arctic_mask=np.ma.make_mask(np.logical_and(mask!=2.0,mask!=4.0))
-    for t in range(np.shape(ty_trans)[0]):
-        for z in range(np.shape(ty_trans)[1]):
-            for trans in transList:
-                trans.mask[t,z,:,:]=np.ma.mask_or(atlantic_arctic_mask,landMask[z,:,:])
-    #calculate MOC with atlantic basin mask
-    transports[:,:,:,0]=calcOverturning(transList,typ)
-    #1: indoPacific basin:
-    #set masks
-    #Indian and Pacific basin are given by mask values 3 and 5 #TODO double check this
-    indoPac_mask=np.ma.make_mask(np.logical_and(mask!=3.0,mask!=5.0))
-    for t in range(np.shape(ty_trans)[0]):
-        for z in range(np.shape(ty_trans)[1]):
-            for trans in transList:
-                trans.mask[t,z,:,:]=np.ma.mask_or(indoPac_mask,landMask[z,:,:])
-    transports[:,:,:,1]=calcOverturning(transList,typ)
+    landMask=np.ma.getmaskarray(ty_trans)[0,:,:,:]
+    #zonal sums over the atlantic arctic (0) and indoPacific (1) basins
+    sums=[basinZonalSums(trans,basinWeights(om2),landMask) for trans in transList]
+    for b in range(2):
+        transports[:,:,:,b]=combineOverturning([s[b] for s in sums],typ)
     return transports
 
+#weights for the zonal sums over ocean basins, 0: atlantic arctic basin, 1: indoPacific basin
+#(1 for points in the basin, 0 outside it), worked out once per grid
+def basinWeights(om2=1):
+    key=('basinweights',str(om2))
+    weights=ancillaryLookup(key)
+    if weights is None:
+        if om2 == 025:
+            basin=np.ma.filled(getBasinMask_025(),0)
+        else:
+            basin=np.ma.filled(getBasinMask(),0)
+        #atlantic and arctic basin are given by mask values 2 and 4 #TODO double check this
+        #Indian and Pacific basin are given by mask values 3 and 5 #TODO double check this
+        weights=ancillaryStore(key,np.float32([(basin==2.0)|(basin==4.0),(basin==3.0)|(basin==5.0)]))
+    return weights
+
+#sums over longitude (last axis) of trans (t,...,lat,lon) for each basin, excluding the land
+#points in landMask (...,lat,lon). The masks of trans aren't changed.
+#returns the sums (basin,t,...,lat), masked where a basin has no ocean points at a latitude
+def basinZonalSums(trans,weights,landMask):
+    keep=weights.reshape(weights.shape[:1]+(1,)*(landMask.ndim-2)+weights.shape[1:])*~landMask
+    vals=np.ma.filled(trans,0).astype(np.float32)
+    sums=np.einsum('t...x,b...x->bt...',vals,keep)
+    mask=np.broadcast_to((keep == 0).all(-1)[:,np.newaxis],sums.shape)
+    return np.ma.array(sums,mask=mask)
+
 #calculate overturning circulation depending on what inputs are given    
 def calcOverturning(transList,typ):
     #assumes transList is a list of variables:
@@ -177,103 +385,70 @@ def calcOverturning(transList,typ):
     #sum over the longditudes and 
     #for ty_trans run a cumalative sum over depths (not for gm or submeso)
     #The result for each variable in transList are added together
+    return combineOverturning([trans.sum(3) for trans in transList],typ)
+
+#combine the zonal sums of the variables in transList into the overturning circulation
+def combineOverturning(sums,typ):
     typ=typ.split('_')
-    n=len(transList)
+    n=len(sums)
     print('type = ',typ)
     print('n = ',n)
-    if len(typ)==1:
-        #normal case for cmip5, need to convert units
-        # gm and submeso quantities are output in Sv so need to be multiplied by 10**9
+    #normal case for cmip5, or case from old diagnostics, units all in sieverts
+    #(gm and submeso quantities are output in Sv so may need to be multiplied by 10**9)
+    if len(typ)==1 or typ[1]=='Sv':
         typ=typ[0]
-        if n==1:
-            if typ=='bolus':
-                #should be bolus transport for rho levels 
-                return transList[0].sum(3) #*10**9
-        elif n==2:
-            if typ=='bolus':
-                #bolus advection is sum of gm and submeso
-                return ( transList[0].sum(3)+transList[1].sum(3) ) #*10**9
-            elif typ=='full':
-                #full y overturning on rho levels, where trans and trans_gm are present (no submeso)
-                tmp= transList[0].sum(3).cumsum(1)+transList[1].sum(3) #*10**9
-                s=transList[0].sum(3).sum(1)
-                for i in range(tmp.shape[1]):
-                    tmp[:,i,:]=tmp[:,i,:]-s
-                return tmp
-        elif n==3:
-            #assume full y overturning:
-            #trans + trans_gm +trans_submeso
-            if typ=='full':
-                tmp=transList[0].sum(3).cumsum(1)+transList[1].sum(3)+transList[2].sum(3)
-                s=transList[0].sum(3).sum(1)
-                for i in range(tmp.shape[1]):
-                    tmp[:,i,:]=tmp[:,i,:]-s
-                return tmp
-    elif typ[1]=='Sv':
-        #case from old diagnostics, units all in sieverts 
-        typ=typ[0]
-        if n==1:
-            if typ=='bolus':
-                #should be bolus transport for rho levels 
-                return transList[0].sum(3)
-        elif n==2:
-            if typ=='bolus':
-                #bolus advection is sum of gm and submeso
-                return transList[0].sum(3)+transList[1].sum(3)
-            elif typ=='full':
-                #full y overturning on rho levels, where trans and trans_gm are present (no submeso)
-                tmp= transList[0].sum(3).cumsum(1)+transList[1].sum(3)
-                s=transList[0].sum(3).sum(1)
-                for i in range(tmp.shape[1]):
-                    tmp[:,i,:]=tmp[:,i,:]-s
-                return tmp
-        elif n==3:
-            #assume full y overturning:
-            #trans + trans_gm +trans_submeso
-            if typ=='full':
-                tmp=transList[0].sum(3).cumsum(1)+transList[1].sum(3)+transList[2].sum(3)
-                s=transList[0].sum(3).sum(1)
-                for i in range(tmp.shape[1]):
-                    tmp[:,i,:]=tmp[:,i,:]-s
-                return tmp
+        if typ=='bolus' and (n==1 or n==2):
+            #bolus transport for rho levels, or bolus advection is sum of gm and submeso
+            return sum(sums[1:],sums[0]) #*10**9
+        elif typ=='full' and (n==2 or n==3):
+            #full y overturning on rho levels, where trans and trans_gm are present (and trans_submeso)
+            tmp=sum(sums[1:],sums[0].cumsum(1)) #*10**9
+            return tmp-sums[0].sum(1)[:,np.newaxis,:]
+
+#calendar of a time axis (proleptic gregorian, as used by the APP, unless the axis is noleap)
+def axisCalendar(time):
+    try:
+        if calendarType(time.calendar) == 'noleap': return 'noleap'
+    except: pass
+    return 'proleptic_gregorian'
+
+#sum over the first (time) axis, masked where any of the values summed are masked
+#(the same as adding the values one at a time)
+def sumFirstAxis(vals):
+    total=vals.sum(0)
+    if np.ma.is_masked(vals):
+        total=np.ma.masked_where(np.ma.getmaskarray(vals).any(0),total)
+    return total
+
+#weights for each time step, shaped to multiply an array with time as the first axis
+def timeWeights(weights,var):
+    return np.asarray(weights,dtype=var.dtype).reshape((-1,)+(1,)*(np.ndim(var)-1))
 
 #Compute monthly average of daily values (for 2D variables)
 def monthAve(var,time):
-    datelist=time.asComponentTime()
+    y,m,d,frac=timeComponents(time[:],time.units,axisCalendar(time))
     monthave=[]
-    #get month, value of first date
-    month=datelist[0].month
-    val_sum=var[0,:,:]
-    count=1
-    #loop over all dates
-    for index, d in enumerate(datelist[1:]):
-        if d.month==month: #same month 
-            count+=1
-            val_sum+=var[index+1,:,:] #add value to sum
-        else: #new month
-            monthave.append(val_sum/count) #calculate average for previous month and add to list
-            val_sum=var[index+1,:,:] #get first value for the new month
-            count=1
-            month=d.month
-    #append last month to list 
-    monthave.append(val_sum/count)
+    #average each run of dates in the same month
+    starts=runStarts(m)
+    ends=np.append(starts[1:],len(m))
+    for start, end in zip(starts,ends):
+        monthave.append(sumFirstAxis(var[start:end])/(end-start))
     print 'monthly ave has shape:',np.shape(np.array(monthave))
     return np.array(monthave)
 
 #calculate a climatology of monthly means
 def monthClim(var,time,vals_wsum,clim_days):
-    datelist=time.asComponentTime()
+    y,m,d,frac=timeComponents(time[:],time.units,axisCalendar(time))
+    #number of days in the month of each date
+    days=monthLength(y,m,axisCalendar(time))
     print 'calculating climatology...'
-    #loop over all dates,
+    var=np.ma.asarray(var)
     try:
-        for index, d in enumerate(datelist):
-            m=d.month #month
-            #add the number of days for this month
-            dummy,days=calendar.monthrange(d.year,m)
-#            print index,d,m,days
-            clim_days[m-1]+=days
+        for month in np.unique(m):
+            index=np.nonzero(m == month)[0]
+            clim_days[month-1]+=days[index].sum()
             #add values weighted by the number of days in this month
-            vals_wsum[m-1,:]+=(var[index,:]*days)
+            vals_wsum[month-1,:]+=sumFirstAxis(var[index]*timeWeights(days[index],var))
     except Exception,e:
         print e
         raise
@@ -282,18 +457,15 @@ def monthClim(var,time,vals_wsum,clim_days):
 
 #calculate a average monthly means (average is vals_wsum/clim_days)
 def ave_months(var,time,vals_wsum,clim_days):
-    datelist=time.asComponentTime()
+    y,m,d,frac=timeComponents(time[:],time.units,axisCalendar(time))
+    #number of days in the month of each date
+    days=monthLength(y,m,axisCalendar(time))
     print 'calculating climatology...'
-    #loop over all dates,
+    var=np.ma.asarray(var)
     try:
-        for index, d in enumerate(datelist):
-            m=d.month #month
-            #add the number of days for this month
-            dummy,days=calendar.monthrange(d.year,m)
-#            print index,d,m,days
-            clim_days+=days
-            #add values weighted by the number of days in this month
-            vals_wsum[:]+=(var[index,:]*days)
+        clim_days+=days.sum()
+        #add values weighted by the number of days in this month
+        vals_wsum[:]+=sumFirstAxis(var*timeWeights(days,var))
     except Exception,e:
         print e
         raise
@@ -301,139 +473,69 @@ def ave_months(var,time,vals_wsum,clim_days):
     return vals_wsum,clim_days
 
 
-#def daysInMonth(time):
-#    tvals=time[:]
-#        
-#    days=np.zeros([len(tvals)])
-#    for i,t in enumerate(tvals):    
-#        d=datetime.timedelta(int(t))+refdate
-#        dummy,days[i]=calendar.monthrange(d.year,d.month)
-#    print days
-#    return days[0]
-
 # returns days in month for time variable
 def daysInMonth(time):
     tvals=time[:]
-    refdate=calcRefDate(time)
+    y,m,d,frac=timeComponents(np.trunc(tvals),time.units,axisCalendar(time))
+    days=monthLength(y,m,axisCalendar(time))
     if len(tvals)==1:
-        d=datetime.timedelta(int(tvals[0]))+refdate
-        dummy,days=calendar.monthrange(d.year,d.month)
-    else:
-        days=[]
-        for t in tvals:
-            d=datetime.timedelta(int(t))+refdate
-            dummy,d=calendar.monthrange(d.year,d.month)
-            days.append(d)
-    return days        
+        return int(days[0])
+    return days
 
 #convert daily time values to monthly
 #returns time values, 
 #and the min and max time for each month (bounds)
 #assumes time is in the gregorian calandar, relative to date reference date
 def day2mon(tvals,ref):
-    datelist=[]
-    for t in tvals: 
-        datelist.append(datetime.datetime(ref,1,1)+ datetime.timedelta(t))
-    #get month, value of first date
-    month=datelist[0].month
-    val_sum=tvals[0]
-    count=1
-    tmonth=[] #List of average time value for each month
-    tmin=[] #list of start of month bounds
-    tmax=[] #list of end of month bounds
-    tmin.append(np.floor(tvals[0]))
-    #loop over all dates
-    for index, d in enumerate(datelist[1:]):
-        if d.month==month: #same month 
-            count+=1
-            val_sum+=tvals[index+1] #add value to sum
-        else: #new month
-            tmonth.append(val_sum/count) #calculate average for previous month and add to list
-            val_sum=tvals[index+1] #get first value for the new month
-            count=1
-            month=d.month
-            tmin.append(np.floor(tvals[index+1]))
-            tmax.append(np.floor(tvals[index+1]))
-    #append last month to list 
-    tmonth.append(val_sum/count)
+    tvals=np.asarray(tvals)
+    y,m,d,frac=timeComponents(tvals,'days since {:04d}-01-01'.format(int(ref)))
+    #each run of dates in the same month
+    starts=runStarts(m)
+    counts=np.diff(np.append(starts,len(tvals)))
+    tmonth=np.add.reduceat(tvals,starts)/counts #average time value for each month
+    tmin=np.floor(tvals[starts]) #start of month bounds
+    tmax=np.append(np.floor(tvals[starts[1:]]),np.floor(tvals[-1])+1) #end of month bounds
     print tmonth
-    tmax.append(np.floor(tvals[index+1])+1)
-    return np.array(tmonth), tmin,tmax
+    return tmonth,tmin,tmax
 
+#convert monthly time values to annual
+#returns the middle of each year, and the start and end of each year (bounds)
 def mon2yr(tvals,refString):
-    tyr=[]
-    tmin=[]
-    tmax=[]
-    starttime=cdtime.reltime(tvals[0],refString).tocomp(cdtime.DefaultCalendar)
-    year=starttime.year
-    tmin.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)
-    for i in tvals:
-        yearnew=cdtime.reltime(i,refString).tocomp(cdtime.DefaultCalendar).year
-        if yearnew==year:
-            pass
-        else:
-            tyr.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value+(cdtime.comptime(year+1,1,1).torel(refString,cdtime.DefaultCalendar).value - cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)/2)
-            year=yearnew
-            tmin.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)
-            tmax.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)
-    tyr.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value + (cdtime.comptime(year+1,1,1).torel(refString,cdtime.DefaultCalendar).value - cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)/2)
-    tmax.append(cdtime.comptime(year+1,1,1).torel(refString,cdtime.DefaultCalendar).value)
-    print 'tvals: {}'.format(np.array(tyr))
-    return np.array(tyr),tmin,tmax
-
+    y,m,d,frac=timeComponents(tvals,refString)
+    years=y[runStarts(y)]
+    ystart=dateToTimes(years,1,1,refString)
+    yend=dateToTimes(years+1,1,1,refString)
+    tyr=ystart+(yend-ystart)/2
+    tmin=ystart
+    tmax=np.append(ystart[1:],yend[-1])
+    print 'tvals: {}'.format(tyr)
+    return tyr,tmin,tmax
+
+#convert monthly time values to the last time in each year
+#returns the time values, and the start and end of each year (bounds)
 def yrpoint(tvals,refString):
-    tyr=[]
-    tmin=[]
-    tmax=[]
-    starttime=cdtime.reltime(tvals[0],refString).tocomp(cdtime.DefaultCalendar)
-    year=starttime.year
-    tmin.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)
-    for i,tval in enumerate(tvals):
-        yearnew=cdtime.reltime(tval,refString).tocomp(cdtime.DefaultCalendar).year
-        if yearnew==year:
-            pass
-        else:
-            tyr.append(tvals[i-1])
-            year=yearnew
-            tmin.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)
-            tmax.append(cdtime.comptime(year,1,1).torel(refString,cdtime.DefaultCalendar).value)
-    tyr.append(tvals[-1])
-    tmax.append(cdtime.comptime(year+1,1,1).torel(refString,cdtime.DefaultCalendar).value)
-    print 'tvals: {}'.format(np.array(tyr))
-    return np.array(tyr),tmin,tmax
+    tvals=np.asarray(tvals)
+    y,m,d,frac=timeComponents(tvals,refString)
+    starts=runStarts(y)
+    years=y[starts]
+    ystart=dateToTimes(years,1,1,refString)
+    yend=dateToTimes(years+1,1,1,refString)
+    tyr=tvals[np.append(starts[1:],len(tvals))-1]
+    tmin=ystart
+    tmax=np.append(ystart[1:],yend[-1])
+    print 'tvals: {}'.format(tyr)
+    return tyr,tmin,tmax
 
 def zonal_mean(var):
     return var.mean(axis=-1)
 
+#sum of the variables (3 to 6 aerosol components) at pseudo level lbplev
 def optical_depth(lbplev,var):
     idx=lbplev-1
-    var0=np.array(var[0][:,idx,:,:])
-    var1=np.array(var[1][:,idx,:,:])
-    var2=np.array(var[2][:,idx,:,:])
-    try: 
-        var3=np.array(var[3][:,idx,:,:])
-    except:
-        pass
-    try:
-        var4=np.array(var[4][:,idx,:,:])
-    except:
-        pass
-    try:
-        var5=np.array(var[5][:,idx,:,:])
-    except: 
-        pass
-    if len(var) == 6: 
-        print('6 variables')
-        vout=var0+var1+var2+var3+var4+var5
-    elif len(var) == 5: 
-        print('5 variables')
-        vout=var0+var1+var2+var3+var4
-    elif len(var) == 4: 
-        print('4 variables')
-        vout=var0+var1+var2+var3
-    else:
-        print('3 variables')
-        vout=var0+var1+var2
+    print('{} variables'.format(len(var)))
+    vout=np.array(var[0][:,idx,:,:])
+    for v in var[1:]:
+        vout+=np.ma.getdata(v[:,idx,:,:])
     return vout
     
 #List of strings giving the names of the straits used in the mass transports across lines
@@ -446,112 +548,101 @@ def getTransportLines():
 def geticeTransportLines():
     return ['fram_strait','canadian_archipelago','barents_opening','bering_strait']
 
+#segments of each line used in the transports across lines, on the 1 degree ocean/ice grid (300x360):
+#(field, i_start, i_end, j_start, j_end), with either i_start=i_end or j_start=j_end,
+#summing the x ('x') or y ('y') transports of the field over the cells of the segment
+#'x_euc' is the x transport of the upper 350m (eastward values only)
+transport_lines_1deg={
+    'barents_opening':[('y',292,300,271,271),('x',300,300,260,271)],
+    'bering_strait':[('y',110,111,246,246)],
+    'canadian_archipelago':[('y',206,212,285,285),('x',235,235,287,288)],
+    'denmark_strait':[('x',249,249,248,251),('y',250,255,247,247)],
+    'drake_passage':[('x',212,212,32,49)],
+    #english channel is unresolved by the access model
+    'english_channel':[],
+    #specified down to 350m not the whole depth
+    'pacific_equatorial_undercurrent':[('x_euc',124,124,128,145)],
+    'faroe_scotland_channel':[('y',273,274,238,238),('x',274,274,232,238)],
+    'florida_bahamas_strait':[('y',200,205,192,192)],
+    'fram_strait':[('x',267,267,279,279),('y',268,284,278,278)],
+    'iceland_faroe_channel':[('y',266,268,243,243),('x',268,268,240,243),('y',269,272,239,239),('x',272,272,239,239)],
+    'indonesian_throughflow':[('x',31,31,117,127),('y',35,36,110,110),('y',43,44,110,110),('x',46,46,111,112),('y',47,57,113,113)],
+    'mozambique_channel':[('y',320,323,91,91)],
+    'taiwan_luzon_straits':[('y',38,39,190,190),('x',40,40,184,188)],
+    'windward_passage':[('y',205,206,185,185)]}
+#sparse line operators, by grid, lines and fields
+line_operators=dict()
+
+#sparse operator summing the cells of the segments of each line, from the fields in the given order
+#returns the cells (index of lat*nlon+lon) used from each field, and the operator (lines x cells used)
+def lineOperator(lines,fields,shape):
+    key=(tuple(lines),tuple(fields),shape)
+    if key in line_operators:
+        return line_operators[key]
+    ny,nx=shape
+    if nx != 360:
+        raise Exception('E: transport lines are not defined for the grid {}'.format(shape))
+    line_cells=dict((field,([],[])) for field in fields)
+    for n, line in enumerate(lines):
+        for field,i_start,i_end,j_start,j_end in transport_lines_1deg[line]:
+            if i_start!=i_end and j_start!=j_end:
+                raise Exception('ERROR: Transport across a line needs to be calculated for a single value of i or j')
+            j,i=np.mgrid[j_start:j_end+1,i_start:i_end+1]
+            line_cells[field][0].append(np.zeros(j.size,dtype=int)+n)
+            line_cells[field][1].append(j.ravel()*nx+i.ravel())
+    cells=[]
+    rows=[]
+    cols=[]
+    for field in fields:
+        field_rows=np.concatenate(line_cells[field][0]+[np.zeros(0,dtype=int)])
+        field_cells,field_cols=np.unique(np.concatenate(line_cells[field][1]+[np.zeros(0,dtype=int)]),return_inverse=True)
+        rows.append(field_rows)
+        cols.append(field_cols+sum([len(c) for c in cells]))
+        cells.append(field_cells)
+    rows=np.concatenate(rows)
+    operator=scipy.sparse.csr_matrix((np.ones(len(rows),dtype=np.float32),(rows,np.concatenate(cols))),
+        shape=(len(lines),sum([len(c) for c in cells])))
+    line_operators[key]=(cells,operator)
+    return cells,operator
+
+#transports across each line, for all times at once
+#fields is a dictionary of transports (t,...,lat,lon) by field name, summed over all axes apart from time
+#(masked values are not included). Fields in positive only include positive values
+def lineSums(lines,fields,positive=[]):
+    names=sorted(fields.keys())
+    cells,operator=lineOperator(lines,names,np.shape(fields[names[0]])[-2:])
+    vals=[]
+    for name, field_cells in zip(names,cells):
+        #values of the cells used, summed over any axes between time and lat,lon
+        shape=np.shape(fields[name])
+        field=fields[name].reshape((shape[0],-1,shape[-2]*shape[-1]))[:,:,field_cells]
+        if name in positive:
+            field=np.ma.masked_where(field<0,field)
+        vals.append(np.ma.filled(field,0).sum(1))
+    return np.float32(operator.dot(np.concatenate(vals,axis=1).T).T)
+
 #Calculates the mass transports across lines
 #for each line requested in cmip5
 #
 def lineTransports(tx_trans,ty_trans):
-    #print tx_trans[0,:,34,64], tx_trans[0,:,34,64].sum()
-    #initialise array
-    transports= np.zeros([len(tx_trans[:,0,0,0]),len(getTransportLines())],dtype=np.float32)
-    #0 barents opening
-    transports[:,0]=transAcrossLine(ty_trans,292,300,271,271)
-    transports[:,0]+=transAcrossLine(tx_trans,300,300,260,271)
-    #1 bering strait
-    transports[:,1]=transAcrossLine(ty_trans,110,111,246,246)
-    #2 canadian archipelago
-    transports[:,2]=transAcrossLine(ty_trans,206,212,285,285)
-    transports[:,2]+=transAcrossLine(tx_trans,235,235,287,288)
-    #3 denmark strait
-    transports[:,3]=transAcrossLine(tx_trans,249,249,248,251)
-    transports[:,3]+=transAcrossLine(ty_trans,250,255,247,247)
-    #4 drake passage
-    transports[:,4]=transAcrossLine(tx_trans,212,212,32,49)
-    #5 english channel is unresolved by the access model
-    #6 pacific equatorial undercurrent
-    #specified down to 350m not the whole depth
-    transports[:,6]=transAcrossLine(np.ma.masked_where(\
-        tx_trans[:,0:25,:]<0,tx_trans[:,0:25,:]),124,124,128,145)
-    #7 faroe scotland channel    
-    transports[:,7]=transAcrossLine(ty_trans,273,274,238,238)
-    transports[:,7]+=transAcrossLine(tx_trans,274,274,232,238)
-    #8 florida bahamas strait
-    transports[:,8]=transAcrossLine(ty_trans,200,205,192,192)
-    #9 fram strait
-    transports[:,9]=transAcrossLine(tx_trans,267,267,279,279)
-    transports[:,9]+=transAcrossLine(ty_trans,268,284,278,278)
-    #10 iceland faroe channel
-    transports[:,10]=transAcrossLine(ty_trans,266,268,243,243)
-    transports[:,10]+=transAcrossLine(tx_trans,268,268,240,243)
-    transports[:,10]+=transAcrossLine(ty_trans,269,272,239,239)
-    transports[:,10]+=transAcrossLine(tx_trans,272,272,239,239)
-    #11 indonesian throughflow
-    transports[:,11]=transAcrossLine(tx_trans,31,31,117,127)
-    transports[:,11]+=transAcrossLine(ty_trans,35,36,110,110)
-    transports[:,11]+=transAcrossLine(ty_trans,43,44,110,110)
-    transports[:,11]+=transAcrossLine(tx_trans,46,46,111,112)
-    transports[:,11]+=transAcrossLine(ty_trans,47,57,113,113)
-    #12 mozambique channel    
-    transports[:,12]=transAcrossLine(ty_trans,320,323,91,91)
-    #13 taiwan luzon straits
-    transports[:,13]=transAcrossLine(ty_trans,38,39,190,190)
-    transports[:,13]+=transAcrossLine(tx_trans,40,40,184,188)
-    #14 windward passage
-    transports[:,14]=transAcrossLine(ty_trans,205,206,185,185)
-    return transports
+    #upper 350m only, positive values only for the equatorial undercurrent
+    fields={'x':tx_trans,'y':ty_trans,'x_euc':tx_trans[:,0:25,:]}
+    return lineSums(getTransportLines(),fields,positive=['x_euc'])
 
 def icelineTransports(ice_thickness,velx,vely):
-    #ice mass transport across fram strait
-    tx_trans=iceTransport(ice_thickness,velx,'x').filled(0)
-    ty_trans=iceTransport(ice_thickness,vely,'y').filled(0)
-    transports= np.zeros([len(tx_trans[:,0,0]),len(geticeTransportLines())],dtype=np.float32)
-    #0 fram strait
-    transports[:,0]=transAcrossLine(tx_trans,267,267,279,279)
-    transports[:,0]+=transAcrossLine(ty_trans,268,284,278,278)
-    #1 canadian archipelago
-    transports[:,1]=transAcrossLine(ty_trans,206,212,285,285)
-    transports[:,1]+=transAcrossLine(tx_trans,235,235,287,288)
-    #2 barents opening
-    transports[:,2]=transAcrossLine(ty_trans,292,300,271,271)
-    transports[:,2]+=transAcrossLine(tx_trans,300,300,260,271)
-    #3 bering strait
-    transports[:,3]=transAcrossLine(ty_trans,110,111,246,246)
-    return transports
+    #ice mass transport across lines
+    fields={'x':iceTransport(ice_thickness,velx,'x').filled(0),'y':iceTransport(ice_thickness,vely,'y').filled(0)}
+    return lineSums(geticeTransportLines(),fields)
 
 def snowlineTransports(snow_thickness,velx,vely):
-    #ice mass transport across fram strait
-    tx_trans=snowTransport(snow_thickness,velx,'x').filled(0)
-    ty_trans=snowTransport(snow_thickness,vely,'y').filled(0)
-    transports= np.zeros([len(tx_trans[:,0,0]),len(geticeTransportLines())],dtype=np.float32)
-    #0 fram strait
-    transports[:,0]=transAcrossLine(tx_trans,267,267,279,279)
-    transports[:,0]+=transAcrossLine(ty_trans,268,284,278,278)
-    #1 canadian archipelago
-    transports[:,1]=transAcrossLine(ty_trans,206,212,285,285)
-    transports[:,1]+=transAcrossLine(tx_trans,235,235,287,288)
-    #2 barents opening
-    transports[:,2]=transAcrossLine(ty_trans,292,300,271,271)
-    transports[:,2]+=transAcrossLine(tx_trans,300,300,260,271)
-    #3 bering strait
-    transports[:,3]=transAcrossLine(ty_trans,110,111,246,246)
-    return transports
+    #snow mass transport across lines
+    fields={'x':snowTransport(snow_thickness,velx,'x').filled(0),'y':snowTransport(snow_thickness,vely,'y').filled(0)}
+    return lineSums(geticeTransportLines(),fields)
 
 def icearealineTransports(ice_fraction,velx,vely):
-    #ice mass transport across fram strait
-    tx_trans=iceareaTransport(ice_fraction,velx,'x').filled(0)
-    ty_trans=iceareaTransport(ice_fraction,vely,'y').filled(0)
-    transports= np.zeros([len(tx_trans[:,0,0]),len(geticeTransportLines())],dtype=np.float32)
-    #0 fram strait
-    transports[:,0]=transAcrossLine(tx_trans,267,267,279,279)
-    transports[:,0]+=transAcrossLine(ty_trans,268,284,278,278)
-    #1 canadian archipelago
-    transports[:,1]=transAcrossLine(ty_trans,206,212,285,285)
-    transports[:,1]+=transAcrossLine(tx_trans,235,235,287,288)
-    #2 barents opening
-    transports[:,2]=transAcrossLine(ty_trans,292,300,271,271)
-    transports[:,2]+=transAcrossLine(tx_trans,300,300,260,271)
-    #3 bering strait
-    transports[:,3]=transAcrossLine(ty_trans,110,111,246,246)
-    return transports
+    #ice area transport across lines
+    fields={'x':iceareaTransport(ice_fraction,velx,'x').filled(0),'y':iceareaTransport(ice_fraction,vely,'y').filled(0)}
+    return lineSums(geticeTransportLines(),fields)
 
 #Calculate the mass trasport across a line
 #either i_start=i_end and the line goes from j_start to j_end 
@@ -576,48 +667,35 @@ def msftbarot(psiu,tx_trans):
         psiu[i,:]=psiu[i,:]+trans
     return psiu
 
-#Calculate ice_mass transport. assumes only one time value
-def iceTransport(ice_thickness,vel,xy):
+#length of the ice grid cell edges (m) crossed by x or y velocities
+def iceEdgeLength(xy):
     gridfile=ancillary_path+'cice_grid_20101208.nc' #file with grids specifications
-    f=cdms2.open(gridfile,'r')
     if xy=='y':
         #for y_vel use length dx
-        L=np.float32(f.variables['hun'][:]/100) #grid cell length in m (from cm)
+        name='hun'
     elif xy=='x':
         #for x_vel use length dy
-        L=np.float32(f.variables['hue'][:]/100) #grid cell length in m (from cm)
+        name='hue'
     else: raise Exception('need to supply value either \'x\' or \'y\' for ice Transports')
+    L=ancillaryLookup((gridfile,name))
+    if L is None:
+        f=openFile(gridfile)
+        L=ancillaryStore((gridfile,name),np.float32(f.variables[name][:]/100)) #grid cell length in m (from cm)
+        releaseFile(f)
+    return L
+
+#Calculate ice_mass transport. assumes only one time value
+def iceTransport(ice_thickness,vel,xy):
     ice_density=900 #kg/m3
-    f.close()
-    return (ice_density*ice_thickness*vel*L)
+    return (ice_density*ice_thickness*vel*iceEdgeLength(xy))
 
 #Calculate ice_mass transport. assumes only one time value
 def snowTransport(snow_thickness,vel,xy):
-    gridfile=ancillary_path+'cice_grid_20101208.nc' #file with grids specifications
-    f=cdms2.open(gridfile,'r')
-    if xy=='y':
-        #for y_vel use length dx
-        L=np.float32(f.variables['hun'][:]/100) #grid cell length in m (from cm)
-    elif xy=='x':
-        #for x_vel use length dy
-        L=np.float32(f.variables['hue'][:]/100) #grid cell length in m (from cm)
-    else: raise Exception('need to supply value either \'x\' or \'y\' for ice Transports')
     snow_density=300 #kg/m3
-    f.close()
-    return (snow_density*snow_thickness*vel*L)
+    return (snow_density*snow_thickness*vel*iceEdgeLength(xy))
 
 def iceareaTransport(ice_fraction,vel,xy):
-    gridfile=ancillary_path+'cice_grid_20101208.nc' #file with grids specifications
-    f=cdms2.open(gridfile,'r')
-    if xy=='y':
-        #for y_vel use length dx
-        L=np.float32(f.variables['hun'][:]/100) #grid cell length in m (from cm)
-    elif xy=='x':
-        #for x_vel use length dy
-        L=np.float32(f.variables['hue'][:]/100) #grid cell length in m (from cm)
-    else: raise Exception('need to supply value either \'x\' or \'y\' for ice Transports')
-    f.close()
-    return (ice_fraction*vel*L)
+    return (ice_fraction*vel*iceEdgeLength(xy))
 
 #
 #Calculate the heights of each atmospheric level at any lat and lon
@@ -830,9 +908,11 @@ def getHybridLevels(zgrid,mod_levs):
 #gets the ACCESS model orography from a file and returns it
 def getOrog():
     orog_fName=ancillary_path+'cm2_orog.nc'
-    orog_file=cdms2.open(orog_fName, 'r')
-    orog_vals=np.float32(orog_file.variables['fld_s00i033'][0,:,:])
-    orog_file.close()
+    orog_vals=ancillaryLookup((orog_fName,'fld_s00i033'))
+    if orog_vals is None:
+        orog_file=openFile(orog_fName)
+        orog_vals=ancillaryStore((orog_fName,'fld_s00i033'),np.float32(orog_file.variables['fld_s00i033'][0,:,:]))
+        releaseFile(orog_file)
     return orog_vals
 
 def areacella(nlat):
@@ -840,9 +920,11 @@ def areacella(nlat):
         fName=ancillary_path+'esm_areacella.nc'
     elif nlat == 144:
         fName=ancillary_path+'cm2_areacella.nc'
-    f=cdms2.open(fName, 'r')
-    vals=np.float32(f.variables['areacella'][:,:])
-    f.close()
+    vals=ancillaryLookup((fName,'areacella'))
+    if vals is None:
+        f=openFile(fName)
+        vals=ancillaryStore((fName,'areacella'),np.float32(f.variables['areacella'][:,:]))
+        releaseFile(f)
     return vals
 
 def landFrac(nlat):
@@ -850,9 +932,11 @@ def landFrac(nlat):
         fName=ancillary_path+'esm_landfrac.nc'
     if nlat == 144:
         fName=ancillary_path+'cm2_landfrac.nc'
-    f=cdms2.open(fName, 'r')
-    vals=np.float32(f.variables['fld_s03i395'][0,:,:]).filled(0)
-    f.close()
+    vals=ancillaryLookup((fName,'fld_s03i395'))
+    if vals is None:
+        f=openFile(fName)
+        vals=ancillaryStore((fName,'fld_s03i395'),np.float32(f.variables['fld_s03i395'][0,:,:]).filled(0))
+        releaseFile(f)
     return vals
 
 def fracLut(var,nwd):
@@ -861,34 +945,17 @@ def fracLut(var,nwd):
     vout=np.ma.zeros([t,4,y,x],dtype=np.float32)
     #p_a_s_land tiles 1-7,11,14 (+8,16,17?)
     if nwd == 0:
-        for i in [1,2,3,4,5,6,7,11,14]: 
-            t=i-1
-            vout[:,0,:,:]+=var[:,t,:,:]
+        vout[:,0,:,:]=tileSelectSum(var,[1,2,3,4,5,6,7,11,14])
     elif nwd == 1:
-        for i in [6,7,11]: 
-            t=i-1
-            vout[:,0,:,:]+=var[:,t,:,:]
+        vout[:,0,:,:]=tileSelectSum(var,[6,7,11])
     #no pastures
-    vout[:,1,:,:]=vout[:,1,:,:]
     #crop tile 9
     vout[:,2,:,:]=var[:,8,:,:]
     #urban tile 15
     if nwd == 0:
         vout[:,3,:,:]=var[:,14,:,:]
-    elif nwd == 1:
-        vout[:,3,:,:]=vout[:,3,:,:]
-    if vout.shape[2] == 145:
-        landfrac=landFrac(145)
-        vout[:,0,:,:]=vout[:,0,:,:]*landfrac
-        vout[:,1,:,:]=vout[:,1,:,:]*landfrac
-        vout[:,2,:,:]=vout[:,2,:,:]*landfrac
-        vout[:,3,:,:]=vout[:,3,:,:]*landfrac
-    elif vout.shape[2] == 144:
-        landfrac=landFrac(144)
-        vout[:,0,:,:]=vout[:,0,:,:]*landfrac
-        vout[:,1,:,:]=vout[:,1,:,:]*landfrac
-        vout[:,2,:,:]=vout[:,2,:,:]*landfrac
-        vout[:,3,:,:]=vout[:,3,:,:]*landfrac
+    if vout.shape[2] == 145 or vout.shape[2] == 144:
+        vout=vout*landFrac(vout.shape[2])
     else:
         raise Exception('could not apply landFrac')
     return vout
@@ -935,138 +1002,90 @@ def calc_mrfso(var,model):
         out+=var[:,z,:,:]*thickness[z]*1000
     return out
 
-def calc_global_ave_ocean(var,rho_dzt,area_t):
-    mass=rho_dzt*area_t
-    print np.shape(var)
-    try: vnew=np.average(var,axis=(1,2,3),weights=mass)
-    except: vnew=np.average(var,axis=(1,2),weights=mass[:,0,:,:])
-    return vnew
-
-def calc_global_ave_ocean_om2(var,rho_dzt,deg):
-    if deg == 1:
-        fname=ancillary_path+'om2_grid.nc' #file with grids specifications
-    elif deg == 025:
-        fname=ancillary_path+'om2-025_grid.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    area_t=np.float32(f.variables['area_t'][:])
-    mass=rho_dzt*area_t
-    print np.shape(var)
-    try: vnew=np.average(var,axis=(1,2,3),weights=mass)
-    except: vnew=np.average(var,axis=(1,2),weights=mass[:,0,:,:])
-    return vnew
-
-def calc_hemi_seaice_area_vol(var,tarea,lat,hemi):
-    lat=np.array(lat,dtype='float32')
-    var=np.array(np.ma.filled(var[0],0),dtype='float64')
-    tarea=np.array(tarea,dtype='float64')
-    nhlati = np.where(lat>=0.)
-    shlati = np.where(lat<0.)
-    var=var[:]*tarea[:]
-    if hemi.find('north') != -1:
-        var=var[nhlati]
-    elif hemi.find('south') != -1:
-        var=var[shlati]
-    varn=np.sum(var)
-    return [varn]
-
-def calc_hemi_seaice_extent(aice,tarea,lat,hemi):
-    lat=np.array(lat,dtype='float32')
-    aice=np.array(np.ma.filled(aice[0],0),dtype='float64')
-    tarea=np.array(tarea,dtype='float64')
-    nhlatiext=np.where((aice>=.15)&(aice<=1.)&(lat>=0.))
-    shlatiext=np.where((aice>=.15)&(aice<=1.)&(lat<0.))
-    if hemi.find('north') != -1:
-        var=tarea[nhlatiext]
-    elif hemi.find('south') != -1:
-        var=tarea[shlatiext]
-    varn=np.sum(var)
-    return [varn]
+#land fraction on the grid of a field (latitude is the second last axis)
+def gridLandFrac(vals):
+    nlat=np.shape(vals)[-2]
+    if nlat == 145 or nlat == 144:
+        return landFrac(nlat)
+    raise Exception('could not apply landFrac')
+
+#weights for averaging over tiles: the tile fractions (t,tile,lat,lon), multiplied by the
+#land fraction if lfrac == 1. The weights for the CM2 tile fractions ('317') are the same
+#for every time, and are worked out once per process
+def tileWeights(tileFrac,lfrac=1):
+    if isinstance(tileFrac,str) and tileFrac == '317':
+        key=('tileweights','317',lfrac)
+        weights=ancillaryLookup(key)
+        if weights is None:
+            weights=tileFraci317()
+            if lfrac == 1:
+                weights=weights*gridLandFrac(weights)
+            weights=ancillaryStore(key,np.ma.asarray(weights,dtype=np.float32))
+        return weights
+    if lfrac == 1:
+        return tileFrac*gridLandFrac(tileFrac)
+    return tileFrac
+
+#sum over the tile axis (second axis) of var multiplied by weights (from tileWeights).
+#weights without a time axis are used for every time. Extra levels in var after the tile
+#axis (e.g. soil levels) use the same weights. Masked where the weights of any tile are masked
+def tileContract(var,weights):
+    vals=np.asarray(np.ma.getdata(var),dtype=np.float32)
+    w=np.ma.asarray(weights)
+    if w.ndim < 4:
+        w=w[np.newaxis]
+    w=w.reshape(w.shape[:2]+(1,)*(vals.ndim-w.ndim)+w.shape[2:])
+    mask=np.ma.getmaskarray(w).any(1)
+    w=np.broadcast_to(np.asarray(w.filled(0),dtype=np.float32),vals.shape)
+    vout=np.einsum('ij...,ij...->i...',vals,w)
+    mask=np.broadcast_to(mask,vout.shape)
+    return np.ma.array(vout,mask=mask)
+
+#sum over the selected tiles (numbered from 1) of the tile axis (second axis),
+#masked where any of the values are masked
+def tileSelectSum(var,tiles):
+    vals=var[:,np.asarray(tiles)-1]
+    vout=np.asarray(np.ma.getdata(vals).sum(1),dtype=np.float32)
+    return np.ma.array(vout,mask=np.ma.getmaskarray(vals).any(1))
 
 #calculate weighted average using tile fractions
 #sum of variable for each tile 
 # multiplied by tile fraction
 def tileAve(var,tileFrac,lfrac=1):
-    var=np.asarray(var[:])
-    t,z,y,x=np.shape(var)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    try:
-        if tileFrac == '317':
-            tileFrac=tileFraci317()
-            #loop over pft tiles and sum
-            for k in range(t):
-                for i in range(z):
-                    vout+=var[k,i,:,:]*tileFrac[i,:,:]
-        else: raise Exception
-    except:
-        #loop over pft tiles and sum
-        for i in range(z):
-            vout+=var[:,i,:,:]*tileFrac[:,i,:,:]
-    if lfrac == 1:
-        if vout.shape[1] == 145:
-            landfrac=landFrac(145)
-            vout=vout*landfrac
-        elif vout.shape[1] == 144:
-            landfrac=landFrac(144)
-            vout=vout*landfrac
-        else:
-            raise Exception('could not apply landFrac')
-    return vout
+    return tileContract(var[:],tileWeights(tileFrac,lfrac))
 
 def tileFraci317():
     fName=ancillary_path+'cm2_tilefrac.nc' # surface tile fractions from CM2 piControl
-    f=cdms2.open(fName, 'r')
-    vals=np.float32(f.variables['fld_s03i317'][0,:,:,:]) #.filled(0)
-    f.close()
+    vals=ancillaryLookup((fName,'fld_s03i317'))
+    if vals is None:
+        f=openFile(fName)
+        vals=ancillaryStore((fName,'fld_s03i317'),np.float32(f.variables['fld_s03i317'][0,:,:,:])) #.filled(0)
+        releaseFile(f)
     return vals
 
 def tileSum(var,lfrac=1):
-    t,z,y,x=np.shape(var)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    for i in range(z):
-        vout+=var[:,i,:,:]
+    vout=tileSelectSum(var,np.arange(np.shape(var)[1])+1)
     if lfrac == 1:
-        if vout.shape[1] == 145:
-            landfrac=landFrac(145)
-            vout=vout*landfrac
-        elif vout.shape[1] == 144:
-            landfrac=landFrac(144)
-            vout=vout*landfrac
-        else:
-            raise Exception('could not apply landFrac')
+        vout=vout*gridLandFrac(vout)
     return vout
  
 def tileFracExtract(tileFrac,tilenum):
-    t,z,y,x=np.shape(tileFrac)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
     if isinstance(tilenum, int) == 1:
-        n=tilenum-1
-        vout+=tileFrac[:,n,:,:]
+        vout=tileSelectSum(tileFrac,[tilenum])
     elif isinstance(tilenum, list):
-        for i,t in enumerate(tilenum):
-            n=t-1
-            vout+=tileFrac[:,n,:,:]
+        vout=tileSelectSum(tileFrac,tilenum)
     else:
         raise Exception('E: tile number must be integer or list')
-    if vout.shape[1] == 145:
-        landfrac=landFrac(145)
-        vout=vout*landfrac
-    elif vout.shape[1] == 144:
-        landfrac=landFrac(144)
-        vout=vout*landfrac
-    else:
-        raise Exception('could not apply landFrac')
-    return vout
+    return vout*gridLandFrac(vout)
     
+#mask (t,lat,lon) values where the land fraction is 0 (ocean) or 1 (land)
+def landFracMask(var,frac):
+    landfrac=landFrac(np.shape(var)[1])
+    mask=np.ma.getmaskarray(var) | (landfrac == frac)
+    return np.ma.array(np.ma.getdata(var),mask=mask,dtype=np.float32)
+
 def landmask(var):
-    t,y,x=np.shape(var)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    if var.shape[1] == 145:
-        landfrac=landFrac(145)
-    elif var.shape[1] == 144:
-        landfrac=landFrac(144)
-    for i in range(t):
-        vout[i,:,:]=np.ma.masked_where(landfrac == 0,var[i,:,:])
-    return vout
+    return landFracMask(var,0)
 
 def topsoil(var):
     return var[:,0,:,:]+var[:,1,:,:]+var[:,2,:,:]*.012987
@@ -1075,23 +1094,11 @@ def topsoil_tsl(var):
     return (var[:,0,:,:]+var[:,1,:,:])/2
 
 def tslsi(sf_temp,si_temp):
-    tileFrac=tileFraci317()
-    t,z,y,x=np.shape(sf_temp)
-    sf_temp_sum=np.ma.zeros([t,y,x],dtype=np.float32)
-    #loop over pft tiles and sum
-    for i in range(z):
-        sf_temp_sum+=sf_temp[:,i,:,:]*tileFrac[i,:,:]
-    if sf_temp_sum.shape[1] == 145:
-        landfrac=landFrac(145)
-        sf_temp_sum=sf_temp_sum*landfrac
-    elif sf_temp_sum.shape[1] == 144:
-        landfrac=landFrac(144)
-        sf_temp_sum=sf_temp_sum*landfrac
-    else:
-        raise Exception('could not apply landFrac')
+    sf_temp_sum=tileContract(sf_temp,tileWeights('317'))
     si_temp_mask=np.ma.masked_values(si_temp,271.35)
     #vout=sf_temp_sum
-    vout=np.ma.array(sf_temp_sum.data+si_temp_mask.data,mask=map(and_,sf_temp_sum.mask,si_temp_mask.mask))
+    vout=np.ma.array(sf_temp_sum.data+si_temp_mask.data,
+        mask=np.ma.getmaskarray(sf_temp_sum) & np.ma.getmaskarray(si_temp_mask))
     return vout
 
 #temp for land or sea ice
@@ -1113,31 +1120,15 @@ def hfbasin(transList,om2=1):
     dims=list(np.shape(transList[0][:,:,0])) +[3] #remove x add dim for 3 basins
     output= np.ma.zeros(dims,dtype=np.float32)
     #grab land mask from first var (assuming the only masked values are land)
-    landMask=np.array(transList[0].mask[0,:,:],dtype=bool)
-    #Get basin masks
-    if om2 == 025:
-        print('025deg')
-        basin=getBasinMask_025()
-    else:
-        print('1deg')
-        basin=getBasinMask()
-    #2 global basin
+    landMask=np.ma.getmaskarray(transList[0])[0,:,:]
+    weights=basinWeights(om2)
     for trans in transList:
+        #2 global basin
         output[:,:,2]+=trans.sum(2)
-    #0: atlantic arctic basin
-    #atlantic and arctic basin are given by mask values 2 and 4 #TODO double check this
-    atlantic_arctic_mask=np.ma.make_mask(np.logical_and(basin!=2.0,basin!=4.0))
-    for trans in transList:
-        for t in range(np.shape(trans)[0]):
-                trans.mask[t,:,:]=np.ma.mask_or(atlantic_arctic_mask,landMask)    
-        output[:,:,0]+=trans.sum(2)
-    #1: indoPacific basin:
-    #Indian and Pacific basin are given by mask values 3 and 5 #TODO double check this
-    indoPac_mask=np.ma.make_mask(np.logical_and(basin!=3.0,basin!=5.0))
-    for trans in transList:
-        for t in range(np.shape(trans)[0]):
-                trans.mask[t,:,:]=np.ma.mask_or(indoPac_mask,landMask)    
-        output[:,:,1]+=trans.sum(2)        
+        #0: atlantic arctic basin, 1: indoPacific basin
+        sums=basinZonalSums(trans,weights,landMask)
+        output[:,:,0]+=sums[0]
+        output[:,:,1]+=sums[1]
     return output
     
 #calculates the northward meridional fluxes for each basin
@@ -1162,16 +1153,7 @@ def tos_degC(var):
     return var
     
 def tos_3hr(var):
-    var=tos_degC(var)
-    t,y,x=np.shape(var)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    if var.shape[1] == 145:
-        landfrac=landFrac(145)
-    elif var.shape[1] == 144:
-        landfrac=landFrac(144)
-    for i in range(t):
-         vout[i,:,:]=np.ma.masked_where(landfrac == 1,var[i,:,:])
-    return vout
+    return landFracMask(tos_degC(var),1)
     
 def tossq_degC(var):
     var=np.ma.asarray(var[:])
@@ -1183,25 +1165,77 @@ def tossq_degC(var):
 def ocean_surface(var):
     return var[:,0,:,:]
 
+#
+#Column integrals: functions of the levels (second axis) of (t,z,lat,lon) fields, for all times at once
+#
+#sum over levels of vals multiplied by weights (e.g. layer thickness, density), as float32
+#masked values are included as 0. The sum is masked where mask (lat,lon or t,lat,lon) is True,
+#or if mask isn't given, where vals or the weights are masked on all levels
+def columnIntegral(vals,weights=[],mask=None):
+    arrays=[vals]+list(weights)
+    letters='tz...'
+    sums=np.einsum(','.join([letters]*len(arrays))+'->t...',
+        *[np.asarray(np.ma.filled(a,0),dtype=np.float32) for a in arrays])
+    if mask is None:
+        mask=np.zeros(np.broadcast(*arrays).shape,dtype=bool)
+        for a in arrays:
+            mask=mask|np.ma.getmaskarray(a)
+        mask=mask.all(1)
+    return np.ma.array(sums,mask=np.broadcast_to(mask,sums.shape))
+
+#difference between each level and the level below it (z-1 levels)
+def layerDiff(vals):
+    return vals[:,:-1]-vals[:,1:]
+
+#index of the bottom level of each column (lat,lon): the last level that isn't masked or NaN
+#at the first time, -1 where there are no levels
+def bottomIndex(vals):
+    first=vals[0]
+    wet=~(np.ma.getmaskarray(first) | np.isnan(np.ma.getdata(first)))
+    return wet.sum(0)-1
+
+#whether the bottom index (kmt-1) of a grid is that of a field: at the first time, the level
+#at the index is wet (not masked or NaN) and the level below it is dry
+def bottomMatches(vals,kmt):
+    first=np.ma.asarray(vals[0])
+    z=first.shape[0]
+    data=np.ma.getdata(first).reshape(-1)
+    mask=np.ma.getmaskarray(first).reshape(-1)
+    kmt=np.ravel(kmt)
+    columns=np.arange(kmt.size)
+    def wetAt(level):
+        index=np.clip(level,0,z-1)*kmt.size+columns
+        return ~(np.take(mask,index) | np.isnan(np.take(data,index)))
+    return ((wetAt(kmt) == (kmt >= 0)) & ((kmt+1 >= z) | ~wetAt(kmt+1))).all()
+
+#bottom index of the columns of a field, kept in the ancillary cache for its grid (levels,lat,lon),
+#so each time slab only checks it (bottomMatches) instead of counting the wet levels again.
+#The grids of different models have the same shape, so a field with another mask replaces it
+def gridBottomIndex(vals):
+    key=('kmt',)+tuple(np.shape(vals)[1:])
+    kmt=ancillaryLookup(key)
+    if kmt is None or not bottomMatches(vals,kmt):
+        kmt=ancillaryStore(key,bottomIndex(vals))
+    return kmt
+
+#values of the bottom level of each column, using the bottom index (kmt-1) if given
+def columnBottom(vals,kmt=None):
+    vals=np.ma.asarray(vals)
+    if kmt is None:
+        kmt=bottomIndex(vals)
+    index=np.broadcast_to(kmt,(vals.shape[0],)+np.shape(kmt))[:,None]
+    return np.take_along_axis(vals,index,axis=1)[:,0]
+
+#bottom values (t,lat,lon), keeping the time axis of slabs of one time step
 def ocean_floor(var):
-    var=np.ma.asarray(var)
-    lv=(~np.isnan(var)).sum(axis=1)-1
-    vout=np.take_along_axis(var,lv[:,None,:,:],axis=1).squeeze()
-    return vout
+    return columnBottom(var,gridBottomIndex(var))
     
 def depth100(d95,d105):
-    vout=(d95+d105)/2
-    vout=np.ma.masked_where(np.ma.is_masked(d105),d105)
-    return vout
+    return np.ma.masked_where(np.ma.getmaskarray(d105),(d95+d105)/2)
 
 def calcrsdoabsorb(heat,flux):
-    t,z,y,x=np.shape(heat)
-    vout=np.ma.zeros([t,z,y,x],dtype=np.float32)
-    for i in range(z):
-        if i == 0:
-            vout[:,0,:,:]=heat[:,0,:,:]+flux[:,:,:]
-        else:
-            vout[:,i,:,:]=heat[:,i,:,:]
+    vout=np.ma.array(heat,dtype=np.float32,copy=True)
+    vout[:,0,:,:]=heat[:,0,:,:]+flux[:,:,:]
     return vout
 
 def ocnrmadvect_offine(var,tempsalt):
@@ -1232,54 +1266,49 @@ def ocnrmadvect_offine(var,tempsalt):
     return vout
 
 def ocndepthint(var,rho,dz):
-    landmask=oceanFrac()
-    var=tos_degC(var)
-    var=np.ma.filled(var[:],0)
-    rho=np.ma.filled(rho[:],0)
-    dz=np.ma.filled(dz[:],0)
-    t,z,y,x=np.shape(var)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    vmul=var*rho*dz
-    for i in range(z):
-        vout+=vmul[:,i,:,:]
-    for i in range(t):
-        vout[i,:,:]=np.ma.masked_where(landmask == 0,vout[i,:,:])
-    return vout
+    return columnIntegral(tos_degC(var),[rho,dz],mask=(oceanFrac() == 0))
 
 def ocndepthint_025(var,rho,dz):
-    landmask=oceanFrac_025()
-    var=tos_degC(var)
-    var=np.ma.filled(var[:],0)
-    rho=np.ma.filled(rho[:],0)
-    dz=np.ma.filled(dz[:],0)
-    t,z,y,x=np.shape(var)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    vmul=var*rho*dz
-    for i in range(z):
-        vout+=vmul[:,i,:,:]
-    for i in range(t):
-        vout[i,:,:]=np.ma.masked_where(landmask == 0,vout[i,:,:])
-    return vout
+    return columnIntegral(tos_degC(var),[rho,dz],mask=(oceanFrac_025() == 0))
+
+#frozen soil moisture: sum over soil levels of the soil moisture (var[0]) times the frozen
+#fraction (var[1]). calc_mrfso(var,model) is the form using the soil level thicknesses
+def calc_mrfso_frac(var):
+    return columnIntegral(var[0],[var[1]])
 
 def oceanFrac():
     fname=ancillary_path+'grid_spec.auscom.20110618.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    ofrac=np.float32(f.variables['wet'][:,:])
+    ofrac=ancillaryLookup((fname,'wet'))
+    if ofrac is None:
+        f=openFile(fname)
+        ofrac=ancillaryStore((fname,'wet'),np.float32(f.variables['wet'][:,:]))
+        releaseFile(f)
     return ofrac
 
 def oceanFrac_025():
     fname=ancillary_path+'om2-025_ocean_mask.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    ofrac=np.float32(f.variables['mask'][:,:])
+    ofrac=ancillaryLookup((fname,'mask'))
+    if ofrac is None:
+        f=openFile(fname)
+        ofrac=ancillaryStore((fname,'mask'),np.float32(f.variables['mask'][:,:]))
+        releaseFile(f)
     return ofrac
 
 def getBasinMask():
     mask_file=ancillary_path+'lsmask_ACCESS-OM2_1deg_20110618.nc'
-    return cdms2.open(mask_file,'r').variables['mask_ttcell'][0,:,:]
+    return readBasinMask(mask_file)
 
 def getBasinMask_025():
     mask_file=ancillary_path+'lsmask_ACCESS-OM2_025deg_20201130.nc'
-    return cdms2.open(mask_file,'r').variables['mask_ttcell'][0,:,:]
+    return readBasinMask(mask_file)
+
+def readBasinMask(mask_file):
+    mask=ancillaryLookup((mask_file,'mask_ttcell'))
+    if mask is None:
+        f=openFile(mask_file)
+        mask=ancillaryStore((mask_file,'mask_ttcell'),np.ma.array(f.variables['mask_ttcell'][0,:,:]))
+        releaseFile(f)
+    return mask
 
 def calc_rsds(sw_heat,swflx):
     sw_heat[:,0,:,:]=swflx+sw_heat[:,0,:,:] #correct surface level
@@ -1289,6 +1318,69 @@ def maskSeaIce(var,sic):
     #return np.ma.masked_where((np.array(var[1])==0).__and__(landFrac()==0),var[0])
     return np.ma.masked_where(sic==0,var)
 
+#
+#Global and hemispheric sums: the weights of each grid are worked out once, and kept in the
+#ancillary cache (by a hash of the grid fields), then applied to all times at once
+#
+#hash of the values and masks of grid fields (areas, latitudes)
+def gridKey(*fields):
+    h=hashlib.md5()
+    for field in fields:
+        h.update(np.ascontiguousarray(np.ma.getdata(field[:])).tostring())
+        h.update(np.ascontiguousarray(np.ma.getmaskarray(field[:])).tostring())
+    return h.hexdigest()
+
+#cell areas in a hemisphere ('north': lat >= 0, 'south': lat < 0), 0 outside it and where masked
+def hemisphereAreas(area,lat,hemi):
+    key=('hemisphere_areas',hemi,gridKey(area,lat))
+    areas=ancillaryLookup(key)
+    if areas is None:
+        lat=np.ma.filled(np.ma.asarray(lat[:],dtype=np.float64),np.nan)
+        if hemi == 'north':
+            inside=(lat >= 0)
+        elif hemi == 'south':
+            inside=(lat < 0)
+        else:
+            raise Exception("E: hemisphere must be 'north' or 'south'")
+        areas=ancillaryStore(key,np.where(inside,np.ma.filled(np.ma.asarray(area[:],dtype=np.float64),0),0))
+    return areas
+
+#sum over all axes apart from time of vals multiplied by weights (the same for all times, or
+#for each time), masked values are included as 0
+def gridSum(vals,weights):
+    vals=np.ma.asarray(vals)
+    weights=np.broadcast_to(np.ma.filled(weights,0),vals.shape)
+    nt=vals.shape[0]
+    return np.einsum('ti,ti->t',np.float64(vals.filled(0)).reshape((nt,-1)),np.float64(weights).reshape((nt,-1)))
+
+#sea ice area (from concentration) or volume (from thickness) of a hemisphere, for each time
+def calc_hemi_seaice_area_vol(vals,area,lat,hemi):
+    return np.float32(gridSum(vals,hemisphereAreas(area,lat,hemi)))
+
+#sea ice extent of a hemisphere: total area of the cells with 15-100% ice, for each time
+def calc_hemi_seaice_extent(aice,area,lat,hemi):
+    aice=np.ma.asarray(aice)
+    extent=np.ma.filled((aice >= 0.15) & (aice <= 1.),False)
+    return np.float32(gridSum(extent,hemisphereAreas(area,lat,hemi)))
+
+#mass weighted global average of an ocean variable (t,z,lat,lon or t,lat,lon for surface fields),
+#weighted by rho_dzt (t,z,lat,lon) times the cell area, for each time
+def calc_global_ave_ocean(var,rho_dzt,area):
+    var=np.ma.asarray(var)
+    mass=np.ma.asarray(rho_dzt)*np.ma.filled(area[:],0)
+    if var.ndim == 3:
+        mass=mass[:,0,:,:]
+    #only the cells with values
+    mass=np.ma.filled(mass,0)*~np.ma.getmaskarray(var)
+    return np.float32(gridSum(var,mass)/gridSum(np.ones(mass.shape),mass))
+
+def calc_global_ave_ocean_om2(var,rho_dzt,deg):
+    if deg == 1:
+        fname=ancillary_path+'om2_grid.nc' #file with grids specifications
+    elif deg == 025:
+        fname=ancillary_path+'om2-025_grid.nc' #file with grids specifications
+    return calc_global_ave_ocean(var,rho_dzt,om2Grid(fname,'area_t'))
+
 def sithick(hi,aice):
     aice=np.ma.masked_where(aice<=1e-3,aice)
     vout=hi/aice
@@ -1307,16 +1399,19 @@ def get_vertices(name):
         vertexname=dictionary[name]
     except:
         raise Exception('app_funcs.get_vertices: ocean grid specification unknown, '+name)
-    try: #ocean grid
-        fname=ancillary_path+'grid_spec.auscom.20110618.nc'
-        f=cdms2.open(fname,'r')
+    vert=ancillaryLookup(('vertices',vertexname))
+    if vert is not None:
+        return vert
+    f=openFile(ancillary_path+'grid_spec.auscom.20110618.nc')
+    if vertexname in f.variables: #ocean grid
         vert=np.array(f.variables[vertexname][:],dtype='float32').transpose((1,2,0))
-    except: #cice grid (convert from rad to degrees)
-        fname=ancillary_path+'cice_grid_20101208.nc'
-        f=cdms2.open(fname,'r')
+    else: #cice grid (convert from rad to degrees)
+        releaseFile(f)
+        f=openFile(ancillary_path+'cice_grid_20101208.nc')
         vert=np.array(f.variables[vertexname][:],dtype='float32').transpose((1,2,0))*57.2957795
+    releaseFile(f)
     #restrict longditudes to the range0-360
-    return vert[:]
+    return ancillaryStore(('vertices',vertexname),vert[:])
 
 def get_vertices_025(name):
     #dictionary to map grid names to names of vertex variables
@@ -1326,25 +1421,40 @@ def get_vertices_025(name):
         vertexname=dictionary[name]
     except:
         raise Exception('app_funcs.get_vertices: ocean grid specification unknown, '+name)
-    try: #ocean grid
-        fname=ancillary_path+'grid_spec.auscom.20150514.nc'
-        f=cdms2.open(fname,'r')
+    vert=ancillaryLookup(('vertices_025',vertexname))
+    if vert is not None:
+        return vert
+    f=openFile(ancillary_path+'grid_spec.auscom.20150514.nc')
+    if vertexname in f.variables: #ocean grid
         vert=np.ma.array(f.variables[vertexname][:],dtype='float32').transpose((1,2,0))
-    except: #cice grid (convert from rad to degrees)
-        fname=ancillary_path+'cice_grid_20150514.nc'
-        f=cdms2.open(fname,'r')
+    else: #cice grid (convert from rad to degrees)
+        releaseFile(f)
+        f=openFile(ancillary_path+'cice_grid_20150514.nc')
         vert=np.ma.array(f.variables[vertexname][:],dtype='float32').transpose((1,2,0))*57.2957795
+    releaseFile(f)
     #restrict longditudes to the range0-360
-    return vert[:]
+    return ancillaryStore(('vertices_025',vertexname),vert[:])
+
+#vertex longitudes restricted to the range 0-360
+def get_lon_vertices(name):
+    vert=ancillaryLookup(('vertices_360',name))
+    if vert is None:
+        vert=ancillaryStore(('vertices_360',name),np.mod(get_vertices(name),360))
+    return vert
+
+def get_lon_vertices_025(name):
+    vert=ancillaryLookup(('vertices_025_360',name))
+    if vert is None:
+        vert=ancillaryStore(('vertices_025_360',name),np.ma.asarray(np.mod(get_vertices_025(name),360)).filled())
+    return vert
 
 #first variable is dummy tsoil (on soil levels)
 #second variable is tile frac
 #the rest of the variables are the soil temp for one level, for each tile
 def calc_tsl(var):
     vout=var[0]*0
-    #loop over soil levels, calculate tile average for each.
-    for i in range(6):
-        vout[:,i,:,:]=tileAve(var[i+2],var[1])
+    #tile average of all soil levels at once, with the tile fraction weights worked out once
+    vout[:,0:6,:,:]=tileContract(np.ma.stack(var[2:8],axis=2),tileWeights(var[1]))
     return vout
 
 def calc_areacello(area,mask_v):
@@ -1356,19 +1466,19 @@ def calc_areacello_om2(deg):
         fname=ancillary_path+'om2_grid.nc' #file with grids specifications
     elif deg == 025:
         fname=ancillary_path+'om2-025_grid.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    area=np.float32(f.variables['area_t'][:])
-    mask_v=np.float32(f.variables['ht'][:])
-    area.mask=mask_v.mask
-    return area.filled(0)
+    areacello=ancillaryLookup((fname,'areacello'))
+    if areacello is None:
+        area=om2Grid(fname,'area_t').copy()
+        area.mask=om2Grid(fname,'ht').mask
+        areacello=ancillaryStore((fname,'areacello'),area.filled(0))
+    return areacello
 
 def calc_volcello_om2(dht,deg):
     if deg == 1:
         fname=ancillary_path+'om2_grid.nc' #file with grids specifications
     elif deg == 025:
         fname=ancillary_path+'om2-025_grid.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    area=np.float32(f.variables['area_t'][:])
+    area=om2Grid(fname,'area_t')
     return area*dht
     
 def getdeptho(deg):
@@ -1376,31 +1486,91 @@ def getdeptho(deg):
         fname=ancillary_path+'om2_grid.nc' #file with grids specifications
     elif deg == 025:
         fname=ancillary_path+'om2-025_grid.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    deptho=np.float32(f.variables['ht'][:])
+    deptho=om2Grid(fname,'ht')
     return deptho
+
+#read a field from an OM2 grid specification file
+def om2Grid(fname,vname):
+    vals=ancillaryLookup((fname,vname))
+    if vals is None:
+        f=openFile(fname)
+        vals=ancillaryStore((fname,vname),np.float32(f.variables[vname][:]))
+        releaseFile(f)
+    return vals
+
+#latitude of the t-cells of an OM2 grid specification file
+def om2GridLat(fname):
+    lat=ancillaryLookup((fname,'area_t_lat'))
+    if lat is None:
+        f=openFile(fname)
+        lat=ancillaryStore((fname,'area_t_lat'),np.array(f.variables['area_t'].getLatitude()[:]))
+        releaseFile(f)
+    return lat
     
-def plevinterp(var,pmod,heavy,lat,lat_v):
-    plev,bounds=plev19()
+#interpolate values on model levels to pressure levels, for all columns at once
+#vals and pvals (pressure of the model levels) have z as the second axis, and levels are the target pressures
+#logp: interpolate linearly in log(pressure)
+#extrapolate: for levels outside the model levels in a column,
+#   'linear' extends the top and bottom model layers (as interp1d with fill_value="extrapolate"),
+#   'nearest' uses the value of the nearest model level, 'mask' masks the values
+#psurf: surface pressure (t,lat,lon), levels below the surface (pressure > psurf) are masked
+def verticalInterp(vals,pvals,levels,logp=False,extrapolate='linear',psurf=None):
+    if extrapolate not in ('linear','nearest','mask'):
+        raise Exception('E: unknown extrapolation: {}'.format(extrapolate))
+    vals=np.ma.asarray(vals)
+    pvals=np.asarray(pvals,dtype=np.float64)
+    levels=np.asarray(levels,dtype=np.float64)
+    #order the model levels by increasing pressure
+    if pvals[(0,0)+(0,)*(pvals.ndim-2)] > pvals[(0,-1)+(0,)*(pvals.ndim-2)]:
+        vals=vals[:,::-1]
+        pvals=pvals[:,::-1]
+    nz=pvals.shape[1]
+    if logp:
+        coord=np.log(pvals)
+        targets=np.log(levels)
+    else:
+        coord=pvals
+        targets=levels
+    vout=np.ma.zeros((vals.shape[0],len(levels))+vals.shape[2:],dtype=np.float32)
+    for i, target in enumerate(targets):
+        #index of the model level above the target level (clipped so the top and bottom layers extrapolate)
+        upper=np.clip((coord < target).sum(1),1,nz-1)[:,np.newaxis]
+        c0=np.take_along_axis(coord,upper-1,axis=1)[:,0]
+        c1=np.take_along_axis(coord,upper,axis=1)[:,0]
+        v0=np.take_along_axis(vals,upper-1,axis=1)[:,0]
+        v1=np.take_along_axis(vals,upper,axis=1)[:,0]
+        weight=(target-c0)/(c1-c0)
+        if extrapolate == 'nearest':
+            weight=np.clip(weight,0,1)
+        level=v0+weight*(v1-v0)
+        if extrapolate == 'mask':
+            level=np.ma.masked_where((weight < 0) | (weight > 1),level)
+        if psurf is not None:
+            level=np.ma.masked_where(levels[i] > np.asarray(psurf).reshape(level.shape),level)
+        vout[:,i]=level
+    return vout
+
+#pressure levels (and bounds) by name
+def plevLevels(name):
+    try:
+        return {'plev19':plev19,'plev39':plev39,'plev8':plev8}[name]()
+    except KeyError:
+        raise Exception('E: unknown pressure levels: {}'.format(name))
+
+#interpolate a variable from model levels to pressure levels, and mask it with the heaviside function
+#(var, pmod: t,z,lat,lon; heavy: t,plev,lat,lon, possibly on the lat_v grid of lat)
+def plevinterp(var,pmod,heavy,lat,lat_v,levels='plev19',logp=False,extrapolate='linear'):
+    plev,bounds=plevLevels(levels)
     t,z,x,y=np.shape(var)
     th,zh,xh,yh=np.shape(heavy)
     if xh != x:
         print 'heavyside not on same grid as variable; interpolating...'
-        hout=np.ma.zeros([th,zh,len(lat_v),yh],dtype=np.float32)
-        for k in range(th):
-            for i in range(zh):
-                for j in range(yh):
-                    hint=interp1d(lat,heavy[k,i,:,j],kind="linear",fill_value="extrapolate")
-                    hout[k,i,:,j]=hint(lat_v)
-    hout=np.where(hout<=0.5,0,hout)
-    hout=np.where(hout>0.5,1,hout)
-    vout=np.ma.zeros([t,len(plev),x,y],dtype=np.float32)
-    print 'interpolating var from model levels to plev19...'
-    for k in range(t):
-        for i in range(x):
-            for j in range(y):
-                vint=interp1d(pmod[k,:,i,j],var[k,:,i,j],kind="linear",fill_value="extrapolate")
-                vout[k,:,i,j]=vint(plev)
+        hout=interp1d(lat,heavy,kind="linear",axis=2,fill_value="extrapolate")(lat_v)
+    else:
+        hout=np.asarray(heavy)
+    hout=np.where(hout<=0.5,0,1)
+    print 'interpolating var from model levels to {}...'.format(levels)
+    vout=verticalInterp(var,pmod,plev,logp=logp,extrapolate=extrapolate)
     return vout/hout
 
 def plev19():
@@ -1420,34 +1590,48 @@ def plev19():
     plev19b=np.column_stack((plev19min,plev19max))
     return np.flip(plev19),plev19b
 
+#pressure levels between the middle of each level (and beyond the first and last levels)
+def levelBounds(levels):
+    mid=(levels[1:]+levels[:-1])/2
+    return np.column_stack((np.append(2*levels[0]-mid[0],mid),np.append(mid,2*levels[-1]-mid[-1])))
+
+def plev39():
+    plev39=np.array([100000, 92500, 85000, 70000,
+        60000, 50000, 40000, 30000,
+        25000, 20000, 17000, 15000,
+        13000, 11500, 10000, 9000,
+        8000, 7000, 5000, 3000,
+        2000, 1500, 1000, 700,
+        500, 300, 200, 150,
+        100, 70, 50, 40,
+        30, 20, 15, 10,
+        7, 5, 3],dtype=np.float32)
+    plev39=np.flip(plev39)
+    return plev39,levelBounds(plev39)
+
+def plev8():
+    plev8=np.array([100000, 85000, 70000, 50000,
+        25000, 10000, 5000, 1000],dtype=np.float32)
+    plev8=np.flip(plev8)
+    return plev8,levelBounds(plev8)
+
 #calculate clwvi by integrating over water collumn
-#assumes only one time step
+#var is pressure, then the mixing ratios of the condensed water species (on the same levels)
 def calc_clwvi(var):
     press=var[0]
-    print press.shape
-    out=np.ma.zeros([1]+list(press.shape[2:]),dtype=np.float32)
-    for z in range(press.shape[1]-1):
-        mix=np.ma.zeros(press.shape[2:],dtype=np.float32)        
-        for v in var[1:]:
-            mix[:,:]+=v[0,z,:,:]
-        out[:,:]+=mix*(press[0,z,:]-press[0,z+1,:])
-    return out*0.101972
+    mix=var[1]
+    for v in var[2:]:
+        mix=mix+v
+    dp=layerDiff(press)
+    #masked where any level is masked
+    mask=np.ma.getmaskarray(mix[:,:-1]).any(1) | np.ma.getmaskarray(dp).any(1)
+    return columnIntegral(mix[:,:-1],[dp],mask=mask)*0.101972
 
 #calculates zostga from T and pressure
 def calc_zostoga(var,depth,lat):
     #extract variables
     [T,dz,areacello]=var
-    [nt,nz,ny,nx]=T.shape #dimension lengths
-    zostoga=np.zeros([nt],dtype=np.float32)
-    #calculate pressure field
-    press=np.ma.array(sw_press(depth,lat))
-    press.mask=T[0,:].mask
-    #do calculation for each time step
-    for t in range(nt):
-        tmp=((1. - rho_from_theta(T[t,:],35.00,press)/rho_from_theta(4.00,35.00,press))*dz[t,:]).sum(0)
-        areacello.mask=T[0,0,:].mask
-        zostoga[t]=(tmp*areacello).sum(0).sum(0)/areacello.sum()
-    return zostoga
+    return stericSeaLevel(T,35.00,dz,areacello,depth,lat)
 
 #calculates zostga from T and pressure
 def calc_zostoga_om2(var,depth,lat,deg):
@@ -1457,105 +1641,15 @@ def calc_zostoga_om2(var,depth,lat,deg):
         fname=ancillary_path+'om2_grid.nc' #file with grids specifications
     elif deg == 025:
         fname=ancillary_path+'om2-025_grid.nc' #file with grids specifications
-    f=cdms2.open(fname,'r')
-    areacello=np.float32(f.variables['area_t'][:])
-    lat=f.variables['area_t'].getLatitude()
-    print 'lat: ',lat
-    [nt,nz,ny,nx]=T.shape #dimension lengths
-    zostoga=np.zeros([nt],dtype=np.float32)
-    #calculate pressure field
-    press=np.ma.array(sw_press(depth,lat))
-    press.mask=T[0,:].mask
-    #do calculation for each time step
-    for t in range(nt):
-        tmp=((1. - rho_from_theta(T[t,:],35.00,press)/rho_from_theta(4.00,35.00,press))*dz[t,:]).sum(0)
-        areacello.mask=T[0,0,:].mask
-        zostoga[t]=(tmp*areacello).sum(0).sum(0)/areacello.sum()
-    return zostoga
+    areacello=om2Grid(fname,'area_t')
+    lat=om2GridLat(fname)
+    return stericSeaLevel(T,35.00,dz,areacello,depth,lat)
     
 #calculates zossga from T,S and pressure
 def calc_zossga(var,depth,lat):
     #extract variables
     [T,S,dz,areacello]=var
-    [nt,nz,ny,nx]=T.shape
-    zossga=np.zeros([nt],dtype=np.float32)
-    #calculate pressure field
-    press=np.ma.array(sw_press(depth,lat))
-    press.mask=T[0,:].mask
-    #do calculation for each time step
-    for t in range(nt):
-        tmp=((1. - rho_from_theta(T[t,:],S[t,:],press)/rho_from_theta(4.00,35.00,press))*dz[t,:]).sum(0)
-        areacello.mask=T[0,0,:].mask
-        zossga[t]=(tmp*areacello).sum(0).sum(0)/areacello.sum()
-    return zossga
-
-#function to calculate density from temp, salinity and pressure
-def rho_from_theta(th,s,p):
-    th2 = th*th
-    sqrts = np.ma.sqrt(s)
-    anum =          9.9984085444849347e+02 +    \
-               th*( 7.3471625860981584e+00 +    \
-               th*(-5.3211231792841769e-02 +    \
-               th*  3.6492439109814549e-04)) +  \
-                s*( 2.5880571023991390e+00 -    \
-               th*  6.7168282786692355e-03 +    \
-                s*  1.9203202055760151e-03)
-    aden =          1.0000000000000000e+00 +    \
-               th*( 7.2815210113327091e-03 +    \
-               th*(-4.4787265461983921e-05 +    \
-               th*( 3.3851002965802430e-07 +    \
-               th*  1.3651202389758572e-10))) + \
-                s*( 1.7632126669040377e-03 -    \
-               th*( 8.8066583251206474e-06 +    \
-              th2*  1.8832689434804897e-10) +   \
-            sqrts*( 5.7463776745432097e-06 +    \
-              th2*  1.4716275472242334e-09))
-    pmask=(p!=0.0)
-    pth = p*th
-    anum = anum +   pmask*(     p*( 1.1798263740430364e-02 +   \
-                       th2*  9.8920219266399117e-08 +   \
-                         s*  4.6996642771754730e-06 -   \
-                         p*( 2.5862187075154352e-08 +   \
-                       th2*  3.2921414007960662e-12)) )
-    aden = aden +   pmask*(     p*( 6.7103246285651894e-06 -   \
-                  pth*(th2*  2.4461698007024582e-17 +   \
-                         p*  9.1534417604289062e-18)) )
-#    print 'rho',np.min(anum/aden),np.max(anum/aden)
-    return anum/aden
-
-#deprecated funtion, do not use. Use rho_from_theta instead
-def rf_eos(S,T,P):
-    t1 = [ 9.99843699e+2, 7.35212840e+0, -5.45928211e-2, 3.98476704e-4 ]
-    s1 = [ 2.96938239e+0, -7.23268813e-3, 2.12382341e-3 ]
-    p1 = [ 1.04004591e-2, 1.03970529e-7, 5.18761880e-6, -3.24041825e-8, -1.23869360e-11 ]
-
-    t2 = [ 1.0, 7.28606739e-3, -4.60835542e-5, 3.68390573e-7, 1.80809186e-10 ]
-    s2 = [ 2.14691708e-3, -9.27062484e-6, -1.78343643e-10, 4.76534122e-6, 1.63410736e-9 ]
-    p2 = [ 5.30848875e-6, -3.03175128e-16, -1.27934137e-17 ]
-
-    Pn = t1[0] + t1[1]*T + t1[2]*T**2 + t1[3]*T**3 + s1[0]*S + s1[1]*S*T + s1[2]*S**2 \
-      + p1[0]*P + p1[1]*P*T**2 + p1[2]*P*S + p1[3]*P**2 + p1[4]*P**2*T**2
-
-    Pd = t2[0] + t2[1]*T + t2[2]*T**2 + t2[3]*T**3 + t2[4]*T**4 \
-      + s2[0]*S + s2[1]*S*T + s2[2]*S*T**3 + s2[3]*np.sqrt(S**3) + s2[4]*np.sqrt(S**3)*T**2 \
-      + p2[0]*P + p2[1]*P**2*T**3 + p2[2]*P**3*T
-    return Pn/Pd
-
-#Calculates the pressure field from depth and latitude
-def sw_press(dpth,lat):
-#return array on depth,lat,lon    
-    pi = 4*np.arctan(1.)
-    deg2rad = pi/180
-    x = np.sin(abs(lat[:])*deg2rad)  # convert to radians
-    c1 = 5.92e-3+x**2*5.25e-3
-    #expand arrays into 3 dimensions
-    nd,=dpth.shape
-    nlat,nlon=lat.shape
-    dpth=np.expand_dims(np.expand_dims(dpth[:],1),2)
-    dpth=np.tile(dpth,(1,nlat,nlon))
-    c1=np.expand_dims(c1,0)
-    c1=np.tile(c1,(nd,1,1))
-    return ((1-c1)-np.sqrt(((1-c1)**2)-(8.84e-6*dpth)))/4.42e-6
+    return stericSeaLevel(T,S,dz,areacello,depth,lat)
 
 def fix_packing_division(num,den):
     vout=num/den
@@ -1569,16 +1663,29 @@ def column_max(var):
 def extract_lvl(var,lvl):
     return var[:,lvl,:,:]
 
+#ozone above the tropopause: total column (o3mod) less the column interpolated (linearly in
+#pressure, constant beyond the levels) from the columns on pressure levels (o3plev) to the
+#tropopause pressure, for all columns at once
 def tropoz(o3plev,o3mod,troppres,plev):
     t,z,y,x=np.shape(o3plev)
     print(t,z,y,x)
-    vout=np.ma.zeros([t,y,x],dtype=np.float32)
-    for k in range(t):
-        for i in range(x):
-            for j in range(y):
-                vint=np.interp(troppres[k,j,i],plev[::-1],o3plev[k,::-1,j,i])
-                vout[k,j,i]=np.max(o3mod[k,0,j,i])-vint
-    return vout
+    #pressure levels increasing (levels from the surface up, or from the top down)
+    xp=np.asarray(plev[:],dtype=np.float64)
+    fp=np.float64(np.ma.getdata(o3plev[:]))
+    if xp[0] > xp[-1]:
+        xp=xp[::-1]
+        fp=fp[:,::-1]
+    p=np.float64(np.ma.getdata(troppres[:]))
+    p=np.clip(p,xp[0],xp[-1])
+    hi=np.clip(np.searchsorted(xp,p,side='right'),1,z-1)[:,None]
+    lo=hi-1
+    flo=np.take_along_axis(fp,lo,axis=1)[:,0]
+    fhi=np.take_along_axis(fp,hi,axis=1)[:,0]
+    vint=flo+(p-xp[lo[:,0]])*(fhi-flo)/(xp[hi[:,0]]-xp[lo[:,0]])
+    #at the top level (and above it), use the value of the top level
+    vint=np.where(p == xp[-1],fp[:,-1],vint)
+    o3col=np.ma.asarray(o3mod[:,0,:,:])
+    return np.ma.array(np.ma.getdata(o3col)-vint,mask=np.ma.getmaskarray(o3col),dtype=np.float32)
 
 def toz(o3):
     if len(np.shape(o3)) == 4:
@@ -1586,33 +1693,25 @@ def toz(o3):
     else:
         return o3
 
-def mcu_gravity(var):
-    t,z,y,x=np.shape(var)
-    a_theta_85,b_theta_85,dim_val_bounds_theta_85,b_bounds_theta_85=getHybridLevels('theta',85)
+#gravity (m s-2) at the heights of the theta levels
+def levelGravity(nlev):
+    a_theta,b_theta,dim_val_bounds_theta,b_bounds_theta=getHybridLevels('theta',nlev)
     R_e=6.378E+06
-    grav_h=np.ma.zeros([len(a_theta_85)],dtype=np.float32)
-    for i in range(len(a_theta_85)):
-        grav_h[i]=9.8*(R_e/(R_e+a_theta_85[i]))**2
-    mcu=np.ma.zeros([t,z,y,x],dtype=np.float32)
-    for k in range(z):
-        mcu[:,k,:,:]=var[:,k,:,:]/grav_h[k]
-    return mcu
+    return np.float32(9.8*(R_e/(R_e+np.asarray(a_theta)))**2)
+
+#mass from the values on each level divided by the gravity at that level
+def divideGravity(var,nlev):
+    grav_h=levelGravity(nlev)
+    z=np.shape(var)[1]
+    return (np.ma.asarray(var)/grav_h[:z].reshape(1,z,1,1)).astype(np.float32)
+
+def mcu_gravity(var):
+    return divideGravity(var,85)
 
 def mc_gravity(var):
-    t,z,y,x=np.shape(var)
-    if z == 85:
-        a_theta,b_theta,dim_val_bounds_theta,b_bounds_theta=getHybridLevels('theta',85)
-    elif z == 38:
-        a_theta,b_theta,dim_val_bounds_theta,b_bounds_theta=getHybridLevels('theta',38)
-    else: sys.exit('levels undefined in mc_gravity')
-    R_e=6.378E+06
-    grav_h=np.ma.zeros([len(a_theta)],dtype=np.float32)
-    for i in range(len(a_theta)):
-        grav_h[i]=9.8*(R_e/(R_e+a_theta[i]))**2
-    mc=np.ma.zeros([t,z,y,x],dtype=np.float32)
-    for k in range(z):
-        mc[:,k,:,:]=var[:,k,:,:]/grav_h[k]
-    return mc
+    z=np.shape(var)[1]
+    if z not in (85,38): sys.exit('levels undefined in mc_gravity')
+    return divideGravity(var,z)
 
 
 #calculates an average over southern or northern hemisphere
@@ -0,0 +1,184 @@
+# Work queue of the file_master rows in the APP database
+#
+# Rows were fetched by app_wrapper.py when it started, so two jobs couldn't share an
+# experiment. Each row is now claimed before it is processed: the claim sets its status to
+# 'running', with the worker_id of the app_wrapper.py process and a lease_expiry time, only if
+# the row is still unprocessed, or is running with a lease that has expired (a job or node that
+# stopped). So any number of app_wrapper.py processes, PBS array subjobs or nodes can process
+# the rows of the same database, each row once.
+#
+# The status of each row was written as a line of python to database_updater.py, which was run
+# after the job, committing each status on its own (and lost if the job stopped first). The
+# workers now put the status of each row on status_queue (queueStatus), and a status writer
+# thread of app_wrapper.py writes them to the database, with the time (status_time), in one
+# transaction for each batch of statuses (those received within status_wait seconds). Setting
+# the status ends the lease of the row; a row whose lease expired and was claimed by another
+# job is left to that job. Rows that are finished without a status (e.g. outside
+# the years of the data request) are returned to 'unprocessed' (releaseRow).
+# The status writer also renews the leases of the rows being processed every quarter of
+# APP_LEASE seconds (default 600), so a lease only expires when its process has stopped.
+#
+# The database can be used in WAL mode (APP_DB_WAL, default false), so the statuses are written
+# without blocking the jobs reading it. WAL needs all the processes using the database to be
+# on the same node, so it is only for jobs on one node. The journal mode is stored in the
+# database: it can't be changed back from WAL while another job has the database open, and
+# app_wrapper.py stops if the database is still in WAL mode when APP_DB_WAL is false.
+#
+import os
+import socket
+import sqlite3
+import threading
+import time
+import Queue
+import multiprocessing as mp
+
+#columns of file_master rows, in the order of the rows used by app_wrapper.py (ROWID is added)
+row_columns=['experiment_id','realization_idx','initialization_idx','physics_idx','forcing_idx',
+    'infile','outpath','file_name','vin','vcmip','cmip_table','frequency','tstart','tend','status',
+    'file_size','local_exp_id','calculation','axes_modifier','in_units','positive','timeshot','years',
+    'var_notes','cfname','activity_id','institution_id','source_id','grid_label','access_version',
+    'json_file_path','reference_date','version']
+#seconds a claim lasts without being renewed
+try: lease_seconds=max(60.,float(os.environ.get('APP_LEASE')))
+except: lease_seconds=600.
+#the process claiming rows (its workers set the status of the rows it claimed)
+worker_id='{}:{}:{}'.format(os.environ.get('PBS_JOBID',''),socket.gethostname(),os.getpid())
+#use the database in WAL mode (only for jobs on one node)
+try: wal=os.environ.get('APP_DB_WAL').lower() in ['true','yes']
+except: wal=False
+#seconds the status writer waits for more statuses to write in the same transaction
+status_wait=1.0
+#most statuses written in one transaction
+status_batch=500
+#statuses of rows from the workers: (status, or None to return the row to the queue, ROWID, time)
+status_queue=mp.Queue()
+#rows claimed and being processed, whose leases are renewed
+held_rows=set()
+held_lock=threading.Lock()
+
+#add the columns of the queue to a file_master table made without them
+def queueSetup(conn):
+    cursor=conn.cursor()
+    cursor.execute('pragma table_info(file_master)')
+    columns=[column[1] for column in cursor.fetchall()]
+    if 'worker_id' not in columns:
+        cursor.execute('alter table file_master add column worker_id text')
+    if 'lease_expiry' not in columns:
+        cursor.execute('alter table file_master add column lease_expiry real')
+    if 'status_time' not in columns:
+        cursor.execute('alter table file_master add column status_time real')
+    conn.commit()
+    #the mode can't be changed while other jobs have the database open: the current mode is used
+    try: cursor.execute('pragma journal_mode={}'.format('wal' if wal else 'delete'))
+    except sqlite3.OperationalError, e:
+        print 'unable to set the database journal mode: {}'.format(e)
+        cursor.execute('pragma journal_mode')
+    mode=cursor.fetchone()[0].lower()
+    print 'database journal mode: {}'.format(mode)
+    if mode == 'wal' and not wal:
+        raise Exception('E: the database is in WAL mode (set by another job that still has it open), '\
+            'which is unsafe for jobs on several nodes: set APP_DB_WAL=true if all jobs are on one node')
+
+#rows of an experiment that can be claimed: unprocessed, or running with an expired lease
+def claimableRows(cursor,exp):
+    cursor.execute('''select {},ROWID from file_master where local_exp_id==? and (status==\'unprocessed\'
+        or (status==\'running\' and (lease_expiry is null or lease_expiry<?))) order by ROWID'''.format(
+        ','.join(row_columns)),[exp,time.time()])
+    return cursor.fetchall()
+
+#claim rows (by ROWID), returning the ROWIDs of those claimed
+def claimRows(conn,rowids):
+    cursor=conn.cursor()
+    now=time.time()
+    claimed=[]
+    for rowid in rowids:
+        cursor.execute('''update file_master set status=\'running\',worker_id=?,lease_expiry=?
+            where ROWID=? and (status==\'unprocessed\'
+            or (status==\'running\' and (lease_expiry is null or lease_expiry<?)))''',
+            [worker_id,now+lease_seconds,rowid,now])
+        if cursor.rowcount == 1: claimed.append(rowid)
+    conn.commit()
+    with held_lock:
+        held_rows.update(claimed)
+    return claimed
+
+#rows that have finished being processed, whose leases are no longer renewed
+def endClaims(rowids):
+    with held_lock:
+        held_rows.difference_update(rowids)
+
+#set the status of a row (from any process), ending its lease
+def queueStatus(status,rowid):
+    status_queue.put((status,rowid,time.time()))
+
+#return a row finished without a status to the queue
+def releaseRow(rowid):
+    status_queue.put((None,rowid,time.time()))
+
+#write a batch of statuses in one transaction
+def writeStatuses(conn,statuses):
+    for status, rowid, status_time in statuses:
+        if status == None:
+            conn.execute('''update file_master set status=\'unprocessed\',worker_id=null,lease_expiry=null
+                where ROWID=? and status==\'running\' and worker_id==?''',[rowid,worker_id])
+        else:
+            conn.execute('''update file_master set status=?,status_time=?,worker_id=null,lease_expiry=null
+                where ROWID=? and status==\'running\' and worker_id==?''',[status,status_time,rowid,worker_id])
+    conn.commit()
+
+#renew the leases of the rows held
+def renewLeases(conn):
+    with held_lock:
+        rowids=list(held_rows)
+    for rowid in rowids:
+        conn.execute('''update file_master set lease_expiry=?
+            where ROWID=? and status==\'running\' and worker_id==?''',[time.time()+lease_seconds,rowid,worker_id])
+    conn.commit()
+
+#write the statuses from status_queue in batches, and renew the leases of the rows held,
+#until the end of the queue (None)
+def statusWriter(database):
+    conn=sqlite3.connect(database,timeout=200.0)
+    renewal=time.time()+lease_seconds/4
+    finished=False
+    #statuses not written yet (kept if the database can't be written)
+    statuses=[]
+    failures=0
+    while not finished:
+        try:
+            item=status_queue.get(True,max(0.,renewal-time.time()))
+            deadline=time.time()+status_wait
+            while item != None:
+                statuses.append(item)
+                if len(statuses) >= status_batch: break
+                item=status_queue.get(True,max(0.,deadline-time.time()))
+            finished=item == None
+        except Queue.Empty: pass
+        try:
+            if statuses != []: writeStatuses(conn,statuses)
+            statuses=[]
+            failures=0
+            if time.time() >= renewal:
+                renewLeases(conn)
+                renewal=time.time()+lease_seconds/4
+        except sqlite3.Error, e:
+            print 'E: unable to write the statuses of rows: {}'.format(e)
+            conn.rollback()
+            failures+=1
+            #at the end, try again before giving up (the rows are processed again by a later job)
+            if finished and failures < 10 and statuses != []:
+                time.sleep(status_wait)
+                finished=False
+                status_queue.put(None)
+    conn.close()
+
+def startStatusWriter(database):
+    thread=threading.Thread(target=statusWriter,args=(database,))
+    thread.daemon=True
+    thread.start()
+    return thread
+
+#write the statuses queued and stop the status writer (once the workers have finished)
+def stopStatusWriter(thread):
+    status_queue.put(None)
+    thread.join()
@@ -0,0 +1,279 @@
+# Scheduling of the file_master rows over the workers of app_wrapper.py
+#
+# Rows were given to the workers of an mp.Pool in database order, so a few 3Docean or 3Dalev
+# rows running together could run out of the memory of the node, unless enough memory was
+# requested for the largest row on every CPU. The peak memory of each row (or group of rows,
+# with GROUP_INFILES) is now estimated (rowMemory), and rows are started only while the
+# estimates of the rows running fit within the memory of the job (NUM_MEM, GB):
+#   - whenever a worker is free, the first row (in the order of the policy) that fits in the
+#     memory left is started, so small rows run alongside the large ones and the CPUs are kept busy
+#   - a row larger than the memory of the job is run on its own
+# Without NUM_MEM, a row is started whenever a worker is free.
+#
+# The estimate is the memory of a worker (python, cdms2, cmor and their tables), plus the input
+# values of a year of the row (read one input file at a time) with their masks, copies and
+# temporary arrays, limited to APP_MEM_BUDGET where the values are read in time slabs.
+#
+# The order rows are started in is set by APP_SCHEDULE_POLICY:
+#   lpt    - longest expected time first (default), so the job doesn't end with one worker
+#            processing a long row while the others are idle
+#   memory - largest estimated memory first
+#   rowid  - database order
+# The expected time of a row is the size of its input values (grid points x years x time steps
+# per year x input variables, rowCost) times the seconds per GB the variable took in earlier
+# runs (recorded in timings.csv in OUT_DIR), or all the variables took if it hasn't been run
+# before. The planned makespan of the schedule and the actual one are printed at the end.
+#
+# A worker killed while processing a row (e.g. by the kernel when the node is out of memory)
+# never returns its result, and mp.Pool replaces it without telling the scheduler. Each worker
+# reports its process id when it starts a task, and the scheduler, when no task has finished
+# for poll_seconds, checks the workers of the tasks running are still alive: the task of a
+# worker that died is finished with an error (so its rows are no longer held by the job).
+#
+import os
+import csv
+import errno
+import time
+import Queue
+import multiprocessing as mp
+from multiprocessing.queues import SimpleQueue
+from app_calculations import parseCalculation
+
+#memory (GB) of a worker before it reads any values
+worker_memory=1.5
+#memory (GB) of the job kept for app_wrapper.py itself
+wrapper_memory=2.0
+#memory (GB) of the job, for the rows running at once
+try: memory_ceiling=float(os.environ.get('NUM_MEM'))-wrapper_memory
+except: memory_ceiling=None
+#memory (GB) for the values each worker reads at once (see slabLength in app.py)
+try: mem_budget=float(os.environ.get('APP_MEM_BUDGET'))
+except: mem_budget=None
+#order the rows are started in: 'lpt', 'memory' or 'rowid'
+try: schedule_policy=os.environ.get('APP_SCHEDULE_POLICY').lower()
+except: schedule_policy='lpt'
+if schedule_policy not in ['lpt','memory','rowid']:
+    print 'E: unknown schedule policy {}, using lpt'.format(schedule_policy)
+    schedule_policy='lpt'
+#time steps in a year of each frequency
+steps_per_year={'yr':1,'mon':12,'monClim':12,'day':365,'10day':36,'6hr':1460,'3hr':2920,'fx':1}
+#grid points of the inputs of dimension classes that are reduced from larger fields
+#(global means and sums of ocean and sea ice variables)
+reduced_dimensions={'scalar':5400000}
+#seconds the scheduler waits for a task to finish before checking the workers are alive
+poll_seconds=30.
+#tasks started by the workers: (schedule, task index, process id of the worker), written
+#before the task is run (mp.Queue writes from a thread, so a worker killed at once is missed)
+started_queue=SimpleQueue()
+
+#size (GB) of the input values of a year of a row of file_master, with the dimension class
+#of its variable (from the champions table)
+def rowValues(row,dimension):
+    frequency=row[11]
+    axes_modifier=row[18]
+    #output values for a year
+    if dimension in reduced_dimensions:
+        size=steps_per_year.get(frequency,12)*reduced_dimensions[dimension]*4/1024.**3
+    else:
+        try: size=max(0.,float(row[15]))/1024.
+        except: size=0.
+        if frequency not in ['monClim','fx']:
+            size/=max(1,row[13]-row[12]+1)
+    #inputs with more time steps than the output
+    if axes_modifier.find('day2mon') != -1: size*=30
+    elif axes_modifier.find('mon2yr') != -1: size*=12
+    return size*max(1,len(row[8].split()))
+
+#size (GB) of all the input values of a row, the measure of the time it takes
+def rowCost(row,dimension):
+    if row[11] in ['monClim','fx']: return rowValues(row,dimension)
+    return rowValues(row,dimension)*max(1,row[13]-row[12]+1)
+
+#estimated peak memory (GB) of processing a row of file_master
+def rowMemory(row,dimension):
+    calculation=row[17].strip().strip('"')
+    size=rowValues(row,dimension)
+    #the mask, a copy of the values and temporary arrays used in calculations
+    if calculation == '': size*=2
+    else: size*=4
+    #values read in time slabs (as slabLength), unless all the values of a file are needed
+    slabs=row[18].find('day2mon') == -1
+    try:
+        if calculation != '' and 'times' in parseCalculation(calculation)['coords']: slabs=False
+    except: pass
+    if slabs and mem_budget != None:
+        size=min(size,mem_budget)
+    return worker_memory+size
+
+#estimated peak memory (GB) of processing a group of rows together
+def groupMemory(rows,dimensions):
+    return worker_memory+sum([rowMemory(row,dimension)-worker_memory for row, dimension in zip(rows,dimensions)])
+
+#run a task in a worker, returning its result, or the message of an exception (so that
+#the scheduler is always told the task has finished). run is (schedule, task index), reported
+#with the process id of the worker
+def runTask(function,task,run=None):
+    if run != None: started_queue.put(run+(os.getpid(),))
+    try:
+        return function(task)
+    except Exception, e:
+        return 'E: task failed: {}'.format(e)
+
+#seconds per GB of input values (rowCost) each variable (by table and variable) took in
+#earlier runs, recorded in a timings file, and of all the variables (None if there are none)
+def readTimings(path):
+    totals=dict()
+    try:
+        with open(path,'r') as f:
+            for line in csv.reader(f):
+                if len(line) < 4 or line[0].startswith('#'): continue
+                key=(line[0],line[1])
+                cost,seconds=totals.get(key,(0.,0.))
+                totals[key]=(cost+float(line[2]),seconds+float(line[3]))
+    except IOError: pass
+    rates=dict((key,seconds/cost) for key, (cost,seconds) in totals.items() if cost > 0)
+    cost=sum([total[0] for total in totals.values()])
+    overall=sum([total[1] for total in totals.values()])/cost if cost > 0 else None
+    return rates,overall
+
+#expected time (s) of rows (by table and variable) with the given costs, from the rates
+#of readTimings. Without earlier timings, the time is in units of the cost
+def expectedTime(keys,costs,rates,overall):
+    if overall == None: overall=1.
+    return sum([cost*rates.get(key,overall) for key, cost in zip(keys,costs)])
+
+#add the time taken by rows (by table and variable) to a timings file, shared out by cost
+def writeTimings(path,keys,costs,seconds):
+    total=sum(costs)
+    with open(path,'a') as f:
+        for key, cost in zip(keys,costs):
+            share=seconds*cost/total if total > 0 else seconds/len(keys)
+            f.write('{},{},{:.6g},{:.6g}\n'.format(key[0],key[1],cost,share))
+
+#order of the tasks for the schedule policy
+def taskOrder(estimates,durations):
+    if schedule_policy == 'lpt':
+        return sorted(range(len(estimates)),key=lambda i: -durations[i])
+    if schedule_policy == 'memory':
+        return sorted(range(len(estimates)),key=lambda i: -estimates[i])
+    return range(len(estimates))
+
+#tasks to start from those pending (in order): the first that fits in the memory left, while
+#there are free workers. running is the estimated memory of each task running
+def admitTasks(pending,running,estimates,nworkers):
+    started=[]
+    used=sum(running.values())
+    while len(pending) > len(started) and len(running)+len(started) < nworkers:
+        waiting=[i for i in pending if i not in started]
+        fits=[i for i in waiting if memory_ceiling == None or used+estimates[i] <= memory_ceiling]
+        if fits == []:
+            if running != {} or started != []: break
+            #a task larger than the memory of the job runs on its own
+            fits=waiting[:1]
+        started.append(fits[0])
+        used+=estimates[fits[0]]
+    return started
+
+#whether a process is still running
+def processAlive(pid):
+    try: os.kill(pid,0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+#record the process id of the worker of each task of the schedule run that has started (pids),
+#emptying started_queue: a worker can't start its task while the pipe of the queue is full
+def startedTasks(run,pids):
+    while not started_queue.empty():
+        started=started_queue.get()
+        if started[0] == run: pids[started[1]]=started[2]
+
+#tasks running (handles: AsyncResult of each task) that will never return a result: those
+#whose worker (pids: process id of the worker of each task, from startedTasks) has died, or
+#that failed in the pool (e.g. their result couldn't be returned). Returns (task, message)
+def failedTasks(run,running,handles,pids):
+    startedTasks(run,pids)
+    failed=[]
+    for i in running:
+        if handles[i].ready():
+            if not handles[i].successful():
+                try: handles[i].get(0)
+                except Exception, e:
+                    failed.append((i,'E: task failed: {}'.format(e)))
+        elif i in pids and not processAlive(pids[i]):
+            failed.append((i,'E: task failed: its worker (process {}) died'.format(pids[i])))
+    return failed
+
+#makespan of running the tasks in order, if each takes its expected time
+def plannedMakespan(order,estimates,durations,nworkers):
+    pending=list(order)
+    running=dict()
+    ends=dict()
+    now=0.
+    while pending != [] or running != {}:
+        for i in admitTasks(pending,running,estimates,nworkers):
+            pending.remove(i)
+            running[i]=estimates[i]
+            ends[i]=now+durations[i]
+        now=min([ends[i] for i in running])
+        for i in [i for i in running if ends[i] <= now]: del running[i]
+    return now
+
+#run function(task) for each task on nworkers workers, in the order of the schedule policy
+#(durations is the expected time of each task), keeping the total of the estimated memory
+#(GB) of the tasks running within the memory of the job
+#claim(i), if given, is called before task i is started, and returns the task to run, or None
+#if it is not to be run (e.g. it has been claimed by another job)
+#finished(i,result,seconds) is called as each task finishes, or fails without a result (its
+#result is then an error message). Returns the results in the order the tasks finished
+def schedule(function,tasks,estimates,nworkers,durations=None,finished=None,claim=None):
+    if durations == None: durations=estimates
+    order=taskOrder(estimates,durations)
+    planned=plannedMakespan(order,estimates,durations,nworkers)
+    pool=mp.Pool(nworkers)
+    done=Queue.Queue()
+    #tasks reported by the workers of this schedule
+    run=(os.getpid(),time.time())
+    pending=list(order)
+    running=dict()
+    started=dict()
+    handles=dict()
+    pids=dict()
+    failures=0
+    results=[]
+    print 'scheduling {} tasks on {} workers ({} first), memory: {} GB, estimated peak of the largest task: {:.1f} GB'.format(
+        len(tasks),nworkers,schedule_policy,memory_ceiling,max(estimates+[0]))
+    start=time.time()
+    while pending != [] or running != {}:
+        #tasks that aren't claimed free their workers for the next tasks
+        skipped=True
+        while skipped:
+            skipped=False
+            for i in admitTasks(pending,running,estimates,nworkers):
+                pending.remove(i)
+                task=tasks[i] if claim == None else claim(i)
+                if task == None:
+                    skipped=True
+                    continue
+                running[i]=estimates[i]
+                started[i]=time.time()
+                handles[i]=pool.apply_async(runTask,(function,task,(run,i)),
+                    callback=lambda result, i=i: done.put((i,result)))
+        if running == {}: continue
+        startedTasks(run,pids)
+        try: ended=[done.get(True,poll_seconds)]
+        except Queue.Empty:
+            ended=failedTasks(run,running,handles,pids)
+            for i, result in ended: print result
+            failures+=len(ended)
+        for i, result in ended:
+            if i not in running: continue
+            del running[i]
+            results.append(result)
+            if finished != None: finished(i,result,time.time()-started[i])
+    #the pool waits for the results of tasks whose workers died, so it is stopped
+    if failures > 0: pool.terminate()
+    else: pool.close()
+    pool.join()
+    print 'makespan: planned {:.0f}, actual {:.0f}s'.format(planned,time.time()-start)
+    return results
@@ -1,4 +1,7 @@
-from app import app
+from app import app,app_group
+from app_functions import ancillaryStats
+from app_scheduler import rowCost,groupMemory,readTimings,expectedTime,writeTimings,schedule
+from app_queue import queueSetup,claimableRows,claimRows,endClaims,queueStatus,releaseRow,startStatusWriter,stopStatusWriter
 #from app_functions import plotVar
 import sqlite3
 import traceback
@@ -28,7 +31,8 @@ if not database:
 conn=sqlite3.connect(database,timeout=200.0)
 conn.text_factory=str
 cursor=conn.cursor()
-database_updater='{}/database_updater.py'.format(out_dir)
+#time taken by each variable, for the order rows are processed in
+timings_file='{}/timings.csv'.format(out_dir)
 if os.environ.get('MODE').lower() == 'custom': mode='custom'
 elif os.environ.get('MODE').lower() == 'ccmi': mode='ccmi'
 else: mode='cmip6'
@@ -42,13 +46,19 @@ else: overRideFiles=False
 if os.environ.get('DREQ_YEARS').lower() == 'true': dreq_years=True
 else: dreq_years=False
 print 'dreq years = ',dreq_years
+#process rows that share an input file pattern and range of years together,
+#reading each input file only once for all of their variables
+try:
+    if os.environ.get('GROUP_INFILES').lower() in ['true','yes']: group_infiles=True
+    else: group_infiles=False
+except: group_infiles=False
+print 'group infiles = ',group_infiles
 
 #
-#function to process set of rows in the database
-#if overRideFiles is true, write over files that already exist
-#otherwise they will be skipped
+#function to map a row in the database to the options passed to the app
+#returns a message instead if the row is not to be processed
 #
-def process_row(row):
+def row_dictionary(row):
     #set version number
     #date=datetime.today().strftime('%Y%m%d')
     #set location of cmor tables
@@ -91,7 +101,6 @@ def process_row(row):
     json_file_path=row[30]
     reference_date=row[31]
     version=row[32]
-    rowid=row[33]
     notes='Local exp ID: {le}; Variable: {v1} ({v2})'.format(le=local_exp_id,v1=vcmip,v2=vin)
     try: exp_description=os.environ.get('EXP_DESCRIPTION')
     except: exp_description='Exp: {}'.format(experiment_id)
@@ -152,106 +161,181 @@ def process_row(row):
     print 'exp_description = {}'.format(exp_description)
     print 'expected file name = {}'.format(file_name)
     print 'status = {}'.format(status)
+    #version_number='v{date}'.format(date=version)
+    dictionary={'vcmip':vcmip,'vin':vin,'cmip_table':cmip_table,'infile':infile,'tstart':tstart,'tend':tend,\
+    'notes':notes,'cmip_table_path':cmip_table_path,'frequency':frequency,\
+    'calculation':calculation,'axes_modifier':axes_modifier,'in_units':in_units,'positive':positive,\
+    'json_file_path':json_file_path,'timeshot':timeshot,'access_version':access_version,\
+    'reference_date':reference_date,'mode':mode,'exp_description':exp_description,\
+    'database':database}
+    return dictionary
+
+#
+#function to set the status of a row in the database (by the status writer), which ends its claim
+#
+def record_status(status,rowid):
+    queueStatus(status,rowid)
+
+#
+#function to record the return code from the app for a row
+#
+def record_return(row,dictionary,ret):
+    table=row[10]
+    expected_file=row[7]
+    rowid=row[33]
+    vcmip=dictionary['vcmip']
+    tstart=dictionary['tstart']
+    tend=dictionary['tend']
+    try: os.chmod(ret,0644)
+    except: pass
+    #
+    #check different return codes from the APP. 
+    #
+    if ret == 0:
+        msg='\ndata incomplete for variable: {}\n'.format(vcmip)    
+        record_status('data_Unavailable',rowid)
+    elif ret == -1:
+        msg='\nreturn status from the APP shows an error\n'
+        record_status('unknown_return_code',rowid)
+    else:
+        insuccesslist=0
+        with open('{}/{}_success.csv'.format(successlists,exp),'a+') as c:
+            reader=csv.reader(c, delimiter=',')
+            for row in reader:
+                if row[0] == table and row[1] == vcmip and row[2] == tstart and row[3] == tend: insuccesslist=1
+                else: pass
+            if insuccesslist == 0:
+                c.write('{},{},{},{},{}\n'.format(table,vcmip,tstart,tend,ret))
+                print 'added \'{},{},{},{},...\' to {}/{}_success.csv'.format(table,vcmip,tstart,tend,successlists,exp)
+            else: pass
+        c.close()
+        #Assume processing has been successful
+        #Check if output file matches what we expect
+        #
+        print 'output file:   {}'.format(ret)
+        if ret == expected_file:
+            print 'expected and cmor file paths match'
+            msg='\nsuccessfully processed variable: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
+            #modify file permissions to globally readable
+            #os.chmod(ret,493)
+            record_status('processed',rowid)
+            #plot variable
+            #try:
+            #    if plot:
+            #        plotVar(outpath,ret,cmip_table,vcmip,source_id,experiment_id)
+            #except: 
+            #    msg='{},plot_fail: '.format(msg)
+            #    traceback.print_exc()
+        else :
+            print 'expected file: {}'.format(expected_file)
+            print 'expected and cmor file paths do not match'
+            msg='\nproduced but file name does not match expected: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
+            record_status('file_mismatch',rowid)
+    return msg
+
+#
+#function to record a row whose file already exists
+#
+def record_existing(row,dictionary):
+    table=row[10]
+    expected_file=row[7]
+    rowid=row[33]
+    vcmip=dictionary['vcmip']
+    tstart=dictionary['tstart']
+    tend=dictionary['tend']
+    #
+    #we are not processing because the file already exists.     
     #
+    msg='\nskipping because file already exists for variable: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
+    print 'file: {}'.format(expected_file)
+    record_status('processed',rowid)
+    return msg
+
+#
+#function to record a row that failed to process
+#
+def record_failure(row,dictionary):
+    table=row[10]
+    rowid=row[33]
+    vcmip=dictionary['vcmip']
+    tstart=dictionary['tstart']
+    tend=dictionary['tend']
+    infailedlist=0
+    with open('{}/{}_failed.csv'.format(successlists,exp),'a+') as c:
+        reader=csv.reader(c, delimiter=',')
+        for row in reader:
+            if row[0] == vcmip and row[1] == table and row[2] == tstart and row[3] == tend:infailedlist=1
+            else: pass
+        if infailedlist == 0:
+            c.write('{},{},{},{}\n'.format(table,vcmip,tstart,tend))
+            print 'added \'{},{},{},{}\' to {}/{}_failed.csv'.format(table,vcmip,tstart,tend,successlists,exp)
+        else: pass
+    c.close()
+    msg='\ncould not process file for variable: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
+    record_status('processing_failed',rowid)
+    return msg
+
+#
+#function to process set of rows in the database
+#if overRideFiles is true, write over files that already exist
+#otherwise they will be skipped
+#
+def process_row(row):
+    dictionary=row_dictionary(row)
+    if isinstance(dictionary,str):
+        releaseRow(row[33])
+        return dictionary
     try:
         #Do the processing:
         #
-        expected_file=file_name
-        #if not os.path.exists(outpath):
-        #    print 'creating outpath directory: {}'.format(outpath)
-        #    os.makedirs(outpath)
+        expected_file=row[7]
         if overRideFiles or not os.path.exists(expected_file):
             #if file doesn't already exist (and we're not overriding), run the app
             #
-            #version_number='v{date}'.format(date=version)
-            dictionary={'vcmip':vcmip,'vin':vin,'cmip_table':cmip_table,'infile':infile,'tstart':tstart,'tend':tend,\
-            'notes':notes,'cmip_table_path':cmip_table_path,'frequency':frequency,\
-            'calculation':calculation,'axes_modifier':axes_modifier,'in_units':in_units,'positive':positive,\
-            'json_file_path':json_file_path,'timeshot':timeshot,'access_version':access_version,\
-            'reference_date':reference_date,'mode':mode,'exp_description':exp_description}
             #process the file,
             ret=app(dictionary)
-            try: os.chmod(ret,0644)
-            except: pass
             print '\nreturning to app_wrapper...'
-            #
-            #check different return codes from the APP. 
-            #
-            if ret == 0:
-                msg='\ndata incomplete for variable: {}\n'.format(vcmip)    
-                with open(database_updater,'a+') as dbu:
-                    dbu.write("setStatus('data_Unavailable',{})\n".format(rowid))
-                dbu.close()
-            elif ret == -1:
-                msg='\nreturn status from the APP shows an error\n'
-                with open(database_updater,'a+') as dbu:
-                    dbu.write("setStatus('unknown_return_code',{})\n".format(rowid))
-                dbu.close()
-            else:
-                insuccesslist=0
-                with open('{}/{}_success.csv'.format(successlists,exp),'a+') as c:
-                    reader=csv.reader(c, delimiter=',')
-                    for row in reader:
-                        if row[0] == table and row[1] == vcmip and row[2] == tstart and row[3] == tend: insuccesslist=1
-                        else: pass
-                    if insuccesslist == 0:
-                        c.write('{},{},{},{},{}\n'.format(table,vcmip,tstart,tend,ret))
-                        print 'added \'{},{},{},{},...\' to {}/{}_success.csv'.format(table,vcmip,tstart,tend,successlists,exp)
-                    else: pass
-                c.close()
-                #Assume processing has been successful
-                #Check if output file matches what we expect
-                #
-                print 'output file:   {}'.format(ret)
-                if ret == expected_file:
-                    print 'expected and cmor file paths match'
-                    msg='\nsuccessfully processed variable: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
-                    #modify file permissions to globally readable
-                    #os.chmod(ret,493)
-                    with open(database_updater,'a+') as dbu:
-                        dbu.write("setStatus('processed',{})\n".format(rowid))
-                    dbu.close()
-                    #plot variable
-                    #try:
-                    #    if plot:
-                    #        plotVar(outpath,ret,cmip_table,vcmip,source_id,experiment_id)
-                    #except: 
-                    #    msg='{},plot_fail: '.format(msg)
-                    #    traceback.print_exc()
-                else :
-                    print 'expected file: {}'.format(expected_file)
-                    print 'expected and cmor file paths do not match'
-                    msg='\nproduced but file name does not match expected: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
-                    with open(database_updater,'a+') as dbu:
-                        dbu.write("setStatus('file_mismatch',{})\n".format(rowid))
-                    dbu.close()
+            msg=record_return(row,dictionary,ret)
         else :
-            #
-            #we are not processing because the file already exists.     
-            #
-            msg='\nskipping because file already exists for variable: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
-            print 'file: {}'.format(expected_file)
-            with open(database_updater,'a+') as dbu:
-                dbu.write("setStatus('processed',{})\n".format(rowid))
-            dbu.close()
+            msg=record_existing(row,dictionary)
     except     Exception, e: #something has gone wrong in the processing
         print e
         traceback.print_exc()
-        infailedlist=0
-        with open('{}/{}_failed.csv'.format(successlists,exp),'a+') as c:
-            reader=csv.reader(c, delimiter=',')
-            for row in reader:
-                if row[0] == vcmip and row[1] == table and row[2] == tstart and row[3] == tend:infailedlist=1
-                else: pass
-            if infailedlist == 0:
-                c.write('{},{},{},{}\n'.format(table,vcmip,tstart,tend))
-                print 'added \'{},{},{},{}\' to {}/{}_failed.csv'.format(table,vcmip,tstart,tend,successlists,exp)
-            else: pass
-        c.close()
-        msg='\ncould not process file for variable: {},{},{},{}\n'.format(table,vcmip,tstart,tend)
-        with open(database_updater,'a+') as dbu:
-            dbu.write("setStatus('processing_failed',{})\n".format(rowid))
-        dbu.close()
+        msg=record_failure(row,dictionary)
+    print msg
+    return msg
+
+#
+#function to process a group of rows sharing the same input files in one pass
+#
+def process_group(rows):
+    msgs=[]
+    group_rows=[]
+    dictionaries=[]
+    for row in rows:
+        dictionary=row_dictionary(row)
+        if isinstance(dictionary,str):
+            releaseRow(row[33])
+            msgs.append(dictionary)
+        elif overRideFiles or not os.path.exists(row[7]):
+            group_rows.append(row)
+            dictionaries.append(dictionary)
+        else: msgs.append(record_existing(row,dictionary))
+    if group_rows != []:
+        try: results=app_group(dictionaries)
+        except Exception, e: #something has gone wrong for the whole group
+            print e
+            traceback.print_exc()
+            results=[e]*len(group_rows)
+        print '\nreturning to app_wrapper...'
+        for row, dictionary, ret in zip(group_rows,dictionaries,results):
+            try:
+                if isinstance(ret,Exception): raise ret
+                msgs.append(record_return(row,dictionary,ret))
+            except Exception, e:
+                print 'E: {},{}: {}'.format(row[10],dictionary['vcmip'],e)
+                msgs.append(record_failure(row,dictionary))
+    msg=''.join(msgs)
     print msg
     return msg
 
@@ -265,15 +349,87 @@ def process_experiment(row):
     print 'processing row:'
     print row
     msg=process_row(row)
+    print ancillaryStats()
+    print 'end time: {}'.format(time.time()-t1)
+    return msg
+
+def process_group_experiment(rows):
+    varlogfile=varlogs+'/varlog_group_{}_{}_{}-{}.txt'.format(rows[0][10],rows[0][9],rows[0][12],rows[0][13])
+    sys.stdout = open(varlogfile, 'w')
+    sys.stderr = open(varlogfile, 'w')
+    print 'process: ',mp.Process()
+    t1=time.time()
+    print 'start time: {}'.format(time.time()-t1)
+    print 'processing {} rows with input files: {}'.format(len(rows),rows[0][5])
+    for row in rows: print row
+    msg=process_group(rows)
+    print ancillaryStats()
     print 'end time: {}'.format(time.time()-t1)
     return msg
 
+#
+#group rows by input file pattern and range of years
+#
+def group_rows(rows):
+    groups=dict()
+    order=[]
+    for row in rows:
+        key=(row[5],row[12],row[13],row[30])
+        if key not in groups:
+            groups[key]=[]
+            order.append(key)
+        groups[key].append(row)
+    return [groups[k] for k in order]
+
+#
+#dimension class of each variable (by variable and table) from the champions table
+#
+def row_dimensions():
+    try: cursor.execute('select cmip_variable,cmip_table,dimension from champions')
+    except Exception, e:
+        print 'E: no dimension classes for scheduling rows: {}'.format(e)
+        return dict()
+    return dict(((vcmip,table),dimension) for vcmip, table, dimension in cursor.fetchall())
+
+#
+#process the rows on ncpus workers, starting rows while their estimated memory fits within
+#the memory of the job, in the order of the schedule policy (see app_scheduler.py)
+#
 def pool_handler(rows):
-    p=mp.Pool(ncpus)
-    results=p.imap_unordered(process_experiment,((row) for row in rows))
-    p.close()
-    p.join()
-    return results
+    dimensions=row_dimensions()
+    rates,overall=readTimings(timings_file)
+    if overall == None: print 'no earlier timings, expected times are relative (GB of input values)'
+    else: print 'expected times from earlier timings of {} variables'.format(len(rates))
+    if group_infiles:
+        tasks=group_rows(rows)
+        print 'number of row groups: ',len(tasks)
+        function=process_group_experiment
+    else:
+        tasks=[[row] for row in rows]
+        function=process_experiment
+    keys=[[(row[10],row[9]) for row in task] for task in tasks]
+    costs=[[rowCost(row,dimensions.get((row[9],row[10]))) for row in task] for task in tasks]
+    estimates=[groupMemory(task,[dimensions.get((row[9],row[10])) for row in task]) for task in tasks]
+    durations=[expectedTime(keys[i],costs[i],rates,overall) for i in range(len(tasks))]
+    #claim the rows of a task before it is started, processing those that haven't been
+    #claimed by another job
+    def claim(i):
+        claimed=claimRows(conn,[row[33] for row in tasks[i]])
+        if len(claimed) < len(tasks[i]):
+            print 'rows claimed by another job: {}'.format(len(tasks[i])-len(claimed))
+        task=[row for row in tasks[i] if row[33] in claimed]
+        if task == []: return None
+        if group_infiles: return task
+        return task[0]
+    #record the time taken by rows that were processed, for the expected times of later runs
+    #the rows of a task whose worker died (e.g. out of memory) are set as failed
+    def finished(i,msg,seconds):
+        if msg.startswith('E: task failed: its worker'):
+            for row in tasks[i]: record_status('processing_failed',row[33])
+        endClaims([row[33] for row in tasks[i]])
+        if msg.count('successfully processed') == len(tasks[i]):
+            writeTimings(timings_file,keys[i],costs[i],seconds)
+    return schedule(function,tasks,estimates,ncpus,durations,finished,claim)
 
 #
 #Main method to select and process variables
@@ -284,15 +440,26 @@ def main():
     print 'cmip6 table being processed: {}'.format(table)
     print 'cmip6 variable being processed: {}'.format(var)
     #process only one file per mp process
-    cursor.execute('select *,ROWID  from file_master where status==\'unprocessed\'\
-                    and local_exp_id==?',[exp])
-    #fetch rows
-    try: rows=cursor.fetchall()
-    except: print 'no more rows to process'
-    conn.commit()
-    #process rows
-    print 'number of rows: ',len(rows)
-    results=pool_handler(rows)
+    #rows are claimed as they are processed, so other jobs can process the same database,
+    #until there are no rows left that can be claimed (see app_queue.py)
+    queueSetup(conn)
+    status_thread=startStatusWriter(database)
+    results=[]
+    handled=set()
+    try:
+        while True:
+            #fetch rows
+            rows=[row for row in claimableRows(cursor,exp) if row[33] not in handled]
+            conn.commit()
+            if rows == []:
+                print 'no more rows to process'
+                break
+            handled.update([row[33] for row in rows])
+            #process rows
+            print 'number of rows: ',len(rows)
+            results.extend(pool_handler(rows))
+    finally:
+        stopStatusWriter(status_thread)
     print 'app_wrapper finished!\n'
     #summarise what was processed:
     print "RESULTS:"
@@ -19,6 +19,7 @@ import csv
 import hashlib
 import time
 import json
+from file_catalog import addCatalogFile
 exptoprocess=os.environ.get('EXP_TO_PROCESS')
 out_dir=os.environ.get('OUT_DIR')
 if os.environ.get('MODE').lower() == 'custom': mode='custom'
@@ -64,6 +65,9 @@ def master_setup(conn):
             json_file_path text,
             reference_date integer,
             version text,
+            worker_id text,
+            lease_expiry real,
+            status_time real,
             primary key(local_exp_id,experiment_id,vcmip,cmip_table,realization_idx,initialization_idx,physics_idx,forcing_idx,tstart))''')
     except Exception,e:
         print 'Unable to create the APP file_master table.'
@@ -71,6 +75,43 @@ def master_setup(conn):
         raise e
     conn.commit()
 
+def catalog_setup(conn):
+    cursor=conn.cursor()
+    #The catalog tables describe the ACCESS history files used by the file_master rows
+    #(see file_catalog.py). They are rebuilt each time the database is created.
+    cursor.execute('drop table if exists file_catalog')
+    cursor.execute('drop table if exists catalog_variables')
+    cursor.execute('drop table if exists catalog_times')
+    try:
+        cursor.execute('''create table if not exists file_catalog(
+            pattern text,
+            filename text,
+            yearstamp integer,
+            monstamp integer,
+            primary key(pattern,filename))''')
+        cursor.execute('''create table if not exists catalog_variables(
+            filename text,
+            variable text,
+            dimensions text,
+            units text,
+            missing_value real,
+            axis text,
+            primary key(filename,variable))''')
+        cursor.execute('''create table if not exists catalog_times(
+            filename text,
+            time_dimension text,
+            units text,
+            dtype text,
+            tmin real,
+            tmax real,
+            tvals text,
+            primary key(filename,time_dimension))''')
+    except Exception,e:
+        print 'Unable to create the APP catalog tables.'
+        print e
+        raise e
+    conn.commit()
+
 def grids_setup(conn,grid_file):
     cursor=conn.cursor()
     #The grids table describes the number of gridpoints for different classes of variables
@@ -490,23 +531,28 @@ def read_json_file(path):
     f.close()
     return json_dict
 
-def create_database_updater():
-    database_updater='{}/database_updater.py'.format(out_dir)
-    with open(database_updater,'w+') as dbu:
-        dbu.write('import os\n'\
-            'import sqlite3\n'\
-            'database=os.environ.get("DATABASE")\n'\
-            'print(database)\n'\
-            'out_dir=os.environ.get("OUT_DIR")\n'\
-            'conn=sqlite3.connect(database)\n'\
-            'conn.text_factory=str\n'\
-            'cursor=conn.cursor()\n'\
-            'def setStatus(status,rowid):\n'\
-            '    cursor.execute("update file_master set status=? where ROWID=?",[status,rowid])\n'\
-            #'    print "set status: ",status\n'\
-            '    conn.commit()\n'\
-            'print "updating database..."\n')
-    dbu.close()
+#scan every history file matching the input file patterns of the experiment once,
+#and store the results in the catalog tables
+def populate_catalog(conn):
+    cursor=conn.cursor()
+    cursor.execute('select access_version from experiments where local_exp_id==?',[exptoprocess])
+    access_version=cursor.fetchone()[0]
+    cursor.execute('select distinct infile from file_master where local_exp_id==?',[exptoprocess])
+    patterns=set()
+    for infile in cursor.fetchall():
+        patterns.update(infile[0].split())
+    scanned=set()
+    for pattern in sorted(patterns):
+        files=glob.glob(pattern)
+        files.sort()
+        for fn in files:
+            try:
+                addCatalogFile(cursor,pattern,fn,access_version,scanned)
+            except Exception, e:
+                print 'W: unable to add file to catalog: {}, {}'.format(fn,e)
+        conn.commit()
+        print 'catalogued {} files for pattern: {}'.format(len(files),pattern)
+    print 'number of history files in catalog: {}'.format(len(scanned))
 
 def count_rows(conn):
     cursor=conn.cursor()
@@ -548,7 +594,8 @@ def main():
     grids_setup(conn,grid_file)
     champions_setup(champions_dir,conn)
     populate(conn)
-    create_database_updater()
+    catalog_setup(conn)
+    populate_catalog(conn)
     count_rows(conn)
     print 'max total file size is: {} GB'.format(sumFileSizes(conn)/1024)
 
@@ -12,6 +12,8 @@ import re
 import sys
 import ast
 import argparse
+from app_calculations import checkCalculation
+from app_functions import calculationNames
 np.set_printoptions(threshold=sys.maxsize)
 
 parser = argparse.ArgumentParser(description='Create variable mapping files')
@@ -462,6 +464,12 @@ def find_matches(table,master_map,cmorname,realm,freq,cfname,years,dimensions,ma
                 freq,axes_modifier,calculation,realm,realm2,timeshot,access_vars,skip=\
                     special_cases(exptoprocess,cmipvar,freq,axes_modifier,calculation,realm,realm2,\
                     table,timeshot,access_vars,skip,access_version,varnotes)
+                #report calculations that can't be run now, rather than when the variable is processed
+                problems=checkCalculation(calculation,len(access_vars.split()),calculationNames())
+                if problems != []:
+                    for problem in problems:
+                        print 'E: {}, {}: {}'.format(table,cmipvar,problem)
+                    skip=True
                 try: dimension=determine_dimension(freq,dimensions,timeshot,realm,table,skip)
                 except: raise Exception('E: realm not identified')
                 priority_ret=priority_check(cmipvar,table)
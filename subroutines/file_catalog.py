@@ -0,0 +1,145 @@
+# This script scans ACCESS history files and reads the input file catalog
+# that is stored in the APP database alongside the file_master table.
+#
+# For each history file the catalog holds the year/month stamp from the file name,
+# the variables in the file (dimensions, units, missing value, axis) and the values
+# and units of each time axis. The catalog is built once per experiment by
+# database_manager.py, so that app() can find the files and time values it needs
+# without globbing and opening every history file for every row.
+#
+import sqlite3
+import os
+import re
+import json
+import numpy as np
+from app_files import openFile,releaseFile
+
+#returns the year and month stamp of an ACCESS history file from its file name
+#month is None where it can't be determined from the file name (ocean, ice files)
+def fileDateStamp(fn,access_version):
+    base=os.path.basename(fn)
+    monstamp=None
+    if base.startswith('ice') or base.startswith('ocean'):
+        yearstamp=int(re.search("\d{4}",base).group())
+    else:
+        if access_version.find('CM2') != -1:
+            yearstamp=int(base.split('.')[1][2:6])
+            try: monstamp=int(base.split('.')[1][6:8])
+            except: pass
+        elif access_version.find('ESM') != -1:
+            yearstamp=int(base.split('.')[1][3:7])
+            try: monstamp=int(base.split('.')[1][8:10])
+            except:
+                try: monstamp=int(base.split('.')[1][7:9])
+                except: pass
+        else:
+            raise Exception('E: ACCESS_version not identified')
+    return yearstamp,monstamp
+
+#open a history file and record its variables and time axes
+def scanFile(fn):
+    entry={'variables':{},'times':{}}
+    f=openFile(fn,'netCDF4')
+    try:
+        for name, v in f.variables.items():
+            try: units=v.units
+            except: units=None
+            try: missing=float(v.missing_value)
+            except:
+                try: missing=float(v._FillValue)
+                except: missing=None
+            try: axis=v.axis
+            except: axis=None
+            entry['variables'][name]={'dimensions':list(v.dimensions),'units':units,
+                'missing_value':missing,'axis':axis}
+            #time axes: store all values so that time ranges can be found without the file
+            if len(v.dimensions) == 1 and (name.find('time') != -1 or axis == 'T'):
+                entry['times'][name]={'units':units,'values':np.array(v[:])}
+    finally:
+        releaseFile(f)
+    return entry
+
+#find the time dimension of a variable in a catalog entry
+#(first dimension named 'time', or with the axis attribute 'T')
+def findTimeDimension(entry,vname):
+    time_dimension=None
+    for var_dim in entry['variables'][vname]['dimensions']:
+        if var_dim.find('time') != -1:
+            time_dimension=var_dim
+        elif (var_dim not in entry['variables']) or (entry['variables'][var_dim]['axis'] == None):
+            break
+        elif entry['variables'][var_dim]['axis'] == 'T':
+            time_dimension=var_dim
+    return time_dimension
+
+#return the catalog entry for a file, scanning the file if it isn't in the catalog
+def catalogEntry(catalog,fn):
+    try:
+        entry=catalog[fn]
+        if entry['variables']: return entry
+    except KeyError:
+        entry={}
+        catalog[fn]=entry
+    entry.update(scanFile(fn))
+    return entry
+
+#return the year and month stamp of a file, from the catalog if possible
+def catalogStamp(catalog,fn,access_version):
+    try:
+        if catalog[fn]['yearstamp'] != None:
+            return catalog[fn]['yearstamp'],catalog[fn]['monstamp']
+    except KeyError: pass
+    return fileDateStamp(fn,access_version)
+
+#add a history file to the catalog tables for the given input file pattern
+def addCatalogFile(cursor,pattern,fn,access_version,scanned):
+    try: yearstamp,monstamp=fileDateStamp(fn,access_version)
+    except Exception, e:
+        print 'W: no date stamp for {}: {}'.format(fn,e)
+        yearstamp,monstamp=None,None
+    cursor.execute('insert or replace into file_catalog values (?,?,?,?)',[pattern,fn,yearstamp,monstamp])
+    if fn in scanned: return
+    entry=scanFile(fn)
+    scanned.add(fn)
+    for name, v in entry['variables'].items():
+        cursor.execute('insert or replace into catalog_variables values (?,?,?,?,?,?)',
+            [fn,name,' '.join(v['dimensions']),v['units'],v['missing_value'],v['axis']])
+    for name, t in entry['times'].items():
+        tvals=t['values']
+        if len(tvals) == 0: continue
+        cursor.execute('insert or replace into catalog_times values (?,?,?,?,?,?,?)',
+            [fn,name,t['units'],str(tvals.dtype),float(tvals.min()),float(tvals.max()),
+            json.dumps([float(x) for x in tvals])])
+
+#read the catalog entries of all files matching an input file pattern
+#returns None if there is no catalog for this pattern
+def readCatalog(database,pattern):
+    if not database or not os.path.exists(database):
+        return None
+    conn=sqlite3.connect(database,timeout=200.0)
+    conn.text_factory=str
+    cursor=conn.cursor()
+    try:
+        cursor.execute('select filename,yearstamp,monstamp from file_catalog where pattern==?',[pattern])
+        rows=cursor.fetchall()
+        if rows == []:
+            return None
+        catalog=dict()
+        for fn,yearstamp,monstamp in rows:
+            catalog[fn]={'yearstamp':yearstamp,'monstamp':monstamp,'variables':{},'times':{}}
+        cursor.execute('select v.filename,v.variable,v.dimensions,v.units,v.missing_value,v.axis \
+            from catalog_variables v join file_catalog c on v.filename==c.filename where c.pattern==?',[pattern])
+        for fn,name,dims,units,missing,axis in cursor.fetchall():
+            catalog[fn]['variables'][name]={'dimensions':dims.split(),'units':units,
+                'missing_value':missing,'axis':axis}
+        cursor.execute('select t.filename,t.time_dimension,t.units,t.dtype,t.tvals \
+            from catalog_times t join file_catalog c on t.filename==c.filename where c.pattern==?',[pattern])
+        for fn,name,units,dtype,tvals in cursor.fetchall():
+            catalog[fn]['times'][name]={'units':units,'values':np.array(json.loads(tvals),dtype=dtype)}
+    except sqlite3.OperationalError, e:
+        #database without catalog tables
+        print 'W: unable to read input file catalog: {}'.format(e)
+        return None
+    finally:
+        conn.close()
+    return catalog
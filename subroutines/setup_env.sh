@@ -36,6 +36,7 @@ APP_DIR=$(pwd)
 #export APP_DIR=/g/data/p66/$USER/post_processing/APP4
 # Input subdirectories
 ANCILLARY_FILES=/g/data/p66/CMIP6/APP_ancils
+ANCILLARY_NPY_DIR=/g/data/p66/CMIP6/APP_ancils_npy
 if [[ $MODE == ccmi ]]; then
   CMIP_TABLES=${APP_DIR}/input_files/ccmi-2022/Tables
 elif [[ $MODE == custom ]]; then
@@ -72,4 +73,14 @@ DATABASE=${OUT_DIR}/database.db
 # Extra options
 OVERRIDEFILES=true    # override any existing output data files
 DREQ_YEARS=false      # only process variables for the years defined in the data request file
+GROUP_INFILES=false   # process variables that share input files together, reading each input file once
+APP_MEM_BUDGET=8      # memory (GB) for the data each worker reads at once; files are processed in time slabs within it
+APP_CALC_THREADS=1    # threads each worker uses for arithmetic calculations (sums etc. of the input variables)
+APP_PIPELINE=false    # read ahead and write behind in separate threads while values are calculated (normal case)
+APP_PIPELINE_DEPTH=2  # time slabs waiting between the read, calculate and write stages of the pipeline
+APP_MAX_OPEN_FILES=16 # input and ancillary files each worker keeps open for reuse
+APP_CMOR_SESSION_VARS=50 # variables each worker sets up with cmor before setting it up again (tables are loaded once per set up)
+APP_SCHEDULE_POLICY=lpt # order rows are started in: lpt (longest expected time first), memory (largest first) or rowid
+APP_LEASE=600 # seconds a claim on a row lasts without being renewed (rows of a stopped job are processed by other jobs after this)
+APP_DB_WAL=false # write the database in WAL mode (only when all jobs sharing the database are on one node)
 